@@ -7,64 +7,98 @@
 """Cluster collector API endpoints to post/get metric data."""
 
 import argparse
+import hashlib
 import json
 import logging
 import os
 import sys
-from typing import FrozenSet, NewType, NoReturn, Optional, Sequence
+from contextlib import asynccontextmanager
+from functools import partial
+from typing import (
+    AsyncIterator,
+    FrozenSet,
+    NoReturn,
+    Optional,
+    Sequence,
+)
 
 import gunicorn.app.base  # type: ignore[import-untyped]
 import pydantic
-from fastapi import Depends, FastAPI, HTTPException, status
-from fastapi.responses import JSONResponse, RedirectResponse
+from fastapi import Depends, FastAPI, Header, HTTPException, Request, status
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, RedirectResponse, StreamingResponse
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
 from requests import Session
 
+from checkmk_kube_agent import uploads
 from checkmk_kube_agent.common import (
     TCPTimeout,
     collector_argument_parser,
     collector_metadata,
     tcp_session,
 )
+from checkmk_kube_agent.container_metadata import METADATA_DIGEST_HEADER
+from checkmk_kube_agent.content_encoding import accepts_encoding, supported_encodings
 from checkmk_kube_agent.dedup_ttl_cache import DedupTTLCache
+from checkmk_kube_agent.ingestion import (
+    AdmissionControl,
+    IngestionOverloaded,
+    IngestionWriter,
+    UploadPhases,
+)
+from checkmk_kube_agent.machine_sections import (
+    decode_machine_sections,
+    decompress_machine_sections,
+    piggyback_agent_output,
+)
+from checkmk_kube_agent.request_decompression import RequestDecompressionMiddleware
+from checkmk_kube_agent.subscriptions import (
+    SubscriptionEvent,
+    SubscriptionHub,
+    stream_events,
+)
 from checkmk_kube_agent.type_defs import (
     CacheHealth,
     CacheSizeInfo,
+    CacheSnapshot,
     ClusterCollectorMetadata,
     CollectorMetadata,
+    CompressedMachineSections,
     ContainerMetric,
+    ContainerMetricRate,
+    ContentEncoding,
     MachineSections,
-    MachineSectionsCollection,
     Metadata,
-    MetricCollection,
+    MetadataDigest,
     NodeCollectorMetadata,
+    NodeContainerSeries,
     NodeName,
     RaiseFromError,
     Response,
+    StoredUpload,
     TokenError,
     TokenReview,
+    UploadDigest,
+    UploadResponse,
+)
+from checkmk_kube_agent.uploads import (
+    ContainerMetricKey,
+    MetadataKey,
+    container_metric_key,
+    metadata_key,
 )
 
 app = FastAPI()
+app.add_middleware(RequestDecompressionMiddleware)
 LOGGER = logging.getLogger(__name__)
 
 http_bearer_scheme = HTTPBearer()
 
-ContainerMetricKey = NewType("ContainerMetricKey", str)
-MetadataKey = NewType("MetadataKey", str)
 
 KUBERNETES_SERVICE_HOST = os.environ.get("KUBERNETES_SERVICE_HOST")
 KUBERNETES_SERVICE_PORT_HTTPS = os.environ.get("KUBERNETES_SERVICE_PORT_HTTPS")
 
-
-def container_metric_key(metric: ContainerMetric) -> ContainerMetricKey:
-    """Key function to determine unique key for container metrics"""
-    return ContainerMetricKey(f"{metric.container_name}:{metric.metric_name}")
-
-
-def metadata_key(metadata: NodeCollectorMetadata) -> MetadataKey:
-    """Key function to determine unique key for metadata"""
-    return MetadataKey(f"{metadata.node}:{metadata.collector_type}")
+SUBSCRIPTION_KEEPALIVE_INTERVAL = 15.0
 
 
 def read_api_token() -> str:  # pragma: no cover
@@ -157,13 +191,30 @@ def _join_host_port(host: str, port: str) -> str:
     return f"{host}:{port}"
 
 
-def authenticate(
+def _auth_cache_key(token: str, serviceaccount_whitelist: FrozenSet[str]) -> str:
+    """Key of a successful authentication in the auth cache. Tokens are only
+    kept as a digest.
+
+    >>> _auth_cache_key("token", frozenset({"a:b"})) == _auth_cache_key(
+    ...     "token", frozenset({"c:d"}))
+    False
+    """
+    digest = hashlib.sha256()
+    for serviceaccount in sorted(serviceaccount_whitelist):
+        digest.update(f"{serviceaccount}\n".encode("utf-8"))
+    digest.update(b"\n")
+    digest.update(token.encode("utf-8"))
+    return digest.hexdigest()
+
+
+def authenticate(  # pylint: disable=too-many-arguments
     token: HTTPAuthorizationCredentials,
     *,
     kubernetes_service_host: Optional[str],
     kubernetes_service_port_https: Optional[str],
     session: Session,
     serviceaccount_whitelist: FrozenSet[str],
+    auth_cache: Optional[DedupTTLCache[str, str]] = None,
     raise_from_token_error: RaiseFromError = lambda response, token, error: _raise_from_token_error(
         response,
         token,
@@ -176,7 +227,15 @@ def authenticate(
 
     The validity of the `token` is verified by the Kubernetes Token Review API.
     Then, it is verified whether the corresponding Service Account is
-    whitelisted."""
+    whitelisted.
+
+    Successful authentications are remembered in the `auth_cache`, so that
+    the Token Review API is only queried once per token and time to live of
+    the cache. Denied tokens are not cached."""
+    if auth_cache is not None:
+        cache_key = _auth_cache_key(token.credentials, serviceaccount_whitelist)
+        if auth_cache.find(cache_key) is not None:
+            return token
 
     # reference implementation:
     # https://github.com/kubernetes/kubernetes/blob/67bde9a1023d1805e33d698b28aa6fad991dfb39/staging/src/k8s.io/client-go/rest/config.go#L507-L541
@@ -220,6 +279,8 @@ def authenticate(
             token_error,
         )
 
+    if auth_cache is not None:
+        auth_cache.put(cache_key)
     return token
 
 
@@ -230,14 +291,22 @@ async def authenticate_post(
     kubernetes_service_port_https: Optional[str] = KUBERNETES_SERVICE_PORT_HTTPS,
 ) -> HTTPAuthorizationCredentials:
     """Verify whether the requestor has write access to the cluster collector
-    API."""
-
-    return authenticate(
-        token,
-        kubernetes_service_host=kubernetes_service_host,
-        kubernetes_service_port_https=kubernetes_service_port_https,
-        session=app.state.tcp_session,
-        serviceaccount_whitelist=app.state.writer_whitelist,
+    API.
+
+    Endpoints that receive data read the request body only after this
+    dependency was solved, so that unauthorized requests are rejected without
+    reading, decompressing or parsing their body."""
+
+    return await run_in_threadpool(
+        partial(
+            authenticate,
+            token,
+            kubernetes_service_host=kubernetes_service_host,
+            kubernetes_service_port_https=kubernetes_service_port_https,
+            session=app.state.tcp_session,
+            serviceaccount_whitelist=app.state.writer_whitelist,
+            auth_cache=app.state.auth_cache,
+        )
     )
 
 
@@ -250,12 +319,16 @@ async def authenticate_get(
     """Verify whether the requestor has read access to the cluster collector
     API."""
 
-    return authenticate(
-        token,
-        kubernetes_service_host=kubernetes_service_host,
-        kubernetes_service_port_https=kubernetes_service_port_https,
-        session=app.state.tcp_session,
-        serviceaccount_whitelist=app.state.reader_whitelist,
+    return await run_in_threadpool(
+        partial(
+            authenticate,
+            token,
+            kubernetes_service_host=kubernetes_service_host,
+            kubernetes_service_port_https=kubernetes_service_port_https,
+            session=app.state.tcp_session,
+            serviceaccount_whitelist=app.state.reader_whitelist,
+            auth_cache=app.state.auth_cache,
+        )
     )
 
 
@@ -273,14 +346,81 @@ def health() -> JSONResponse:
     return JSONResponse({"status": "available"})
 
 
+@asynccontextmanager
+async def _received_upload(request: Request) -> AsyncIterator[bytes]:
+    """Admit an upload for the duration of the context, and receive its body.
+
+    While the cluster collector is overloaded, uploads are rejected with
+    `429 Too Many Requests`. The Retry-After header tells the node collector
+    when to try again. Uploads are admitted before their body is received,
+    and are only accepted for queueing once it was received, by its size
+    after decompression, which also counts streamed uploads without a
+    Content-Length. This is the size the ingestion writer accounts for while
+    the upload is queued. Uploads that find the queue of the ingestion
+    writer full are rejected as well."""
+    try:
+        with app.state.admission_control.admit():
+            body = await request.body()
+            app.state.admission_control.accept(len(body))
+            yield body
+    except IngestionOverloaded as exception:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail=f"Cluster collector is overloaded: {exception}",
+            headers={"Retry-After": str(exception.retry_after)},
+        ) from exception
+
+
+def _stored_machine_sections() -> Sequence[MachineSections]:
+    return [
+        decode_machine_sections(decompress_machine_sections(machine_sections))
+        for machine_sections in app.state.machine_sections_queue.get_all()
+    ]
+
+
 @app.post("/update_machine_sections")
-def update_machine_sections(
-    machine_sections: MachineSectionsCollection,
+async def update_machine_sections(
+    request: Request,
     token: str = Depends(authenticate_post),  # pylint: disable=unused-argument
-) -> None:
-    """Update sections for the kubernetes machines"""
-    app.state.node_collector_metadata_queue.put(machine_sections.metadata)
-    app.state.machine_sections_queue.put(machine_sections.sections)
+    metadata_digest: Optional[str] = Header(default=None, alias=METADATA_DIGEST_HEADER),
+) -> UploadResponse:
+    """Update sections for the kubernetes machines.
+
+    The request body is a JSON encoded MachineSectionsCollection."""
+    async with _received_upload(request) as body:
+        return await run_in_threadpool(
+            uploads.update_machine_sections,
+            app.state,
+            body,
+            metadata_digest,
+        )
+
+
+@app.post("/update_machine_sections_raw")
+async def update_machine_sections_raw(
+    request: Request,
+    token: str = Depends(authenticate_post),  # pylint: disable=unused-argument
+    node_collector_metadata: Optional[str] = Header(
+        default=None,
+        alias="Checkmk-Node-Collector-Metadata",
+    ),
+    metadata_digest: Optional[str] = Header(default=None, alias=METADATA_DIGEST_HEADER),
+) -> UploadResponse:
+    """Update sections for the kubernetes machines from plain Checkmk agent
+    output.
+
+    The request body is stored as is, without decoding it. The metadata of the
+    node collector is passed as JSON in the Checkmk-Node-Collector-Metadata
+    header. It may be omitted, if the cluster collector knows the metadata of
+    the digest in the Checkmk-Node-Collector-Metadata-Digest header."""
+    async with _received_upload(request) as body:
+        return await run_in_threadpool(
+            uploads.update_machine_sections_raw,
+            app.state,
+            node_collector_metadata,
+            body,
+            metadata_digest,
+        )
 
 
 @app.get("/machine_sections")
@@ -288,18 +428,92 @@ def send_machine_sections(
     token: str = Depends(authenticate_get),  # pylint: disable=unused-argument
 ) -> Sequence[MachineSections]:
     """Get all available host metrics"""
-    return app.state.machine_sections_queue.get_all()
+    return _stored_machine_sections()
+
+
+@app.get("/machine_sections_raw", response_class=StreamingResponse)
+def send_machine_sections_raw(
+    token: str = Depends(authenticate_get),  # pylint: disable=unused-argument
+    accept_encoding: Optional[str] = Header(default=None),
+) -> StreamingResponse:
+    """Get all available host metrics as Checkmk agent output, with a piggyback
+    block for each node.
+
+    Machine sections are stored compressed. They are sent as they are stored if
+    the client accepts their content coding, and decompressed otherwise."""
+    content_encoding = app.state.machine_sections_encoding
+    if not accepts_encoding(accept_encoding, content_encoding):
+        content_encoding = ContentEncoding.IDENTITY
+    return StreamingResponse(
+        piggyback_agent_output(
+            app.state.machine_sections_queue.get_all(), content_encoding
+        ),
+        media_type="text/plain",
+        headers=(
+            {}
+            if content_encoding is ContentEncoding.IDENTITY
+            else {"Content-Encoding": content_encoding.value}
+        ),
+    )
 
 
 @app.post("/update_container_metrics")
-def update_container_metrics(
-    metrics: MetricCollection,
+async def update_container_metrics(
+    request: Request,
     token: str = Depends(authenticate_post),  # pylint: disable=unused-argument
-) -> None:
-    """Update metrics for containers"""
-    app.state.node_collector_metadata_queue.put(metrics.metadata)
-    for metric in metrics.container_metrics:
-        app.state.container_metric_queue.put(metric)
+    metadata_digest: Optional[str] = Header(default=None, alias=METADATA_DIGEST_HEADER),
+) -> UploadResponse:
+    """Update metrics for containers and the rates of container counters.
+
+    The request body is a JSON encoded MetricCollection."""
+    async with _received_upload(request) as body:
+        return await run_in_threadpool(
+            uploads.update_container_metrics,
+            app.state,
+            body,
+            metadata_digest,
+        )
+
+
+@app.post("/v2/update_container_metrics")
+async def update_container_metrics_v2(
+    request: Request,
+    token: str = Depends(authenticate_post),  # pylint: disable=unused-argument
+    metadata_digest: Optional[str] = Header(default=None, alias=METADATA_DIGEST_HEADER),
+) -> UploadResponse:
+    """Update metrics for containers and the rates of container counters.
+
+    The request body is a JSON encoded MetricTableCollection, in which the
+    labels of each container and each metric name are only listed once."""
+    async with _received_upload(request) as body:
+        return await run_in_threadpool(
+            uploads.update_container_metrics_v2,
+            app.state,
+            body,
+            metadata_digest,
+        )
+
+
+@app.post("/v2/update_container_metric_deltas")
+async def update_container_metric_deltas(
+    request: Request,
+    token: str = Depends(authenticate_post),  # pylint: disable=unused-argument
+    metadata_digest: Optional[str] = Header(default=None, alias=METADATA_DIGEST_HEADER),
+) -> UploadResponse:
+    """Merge the container metrics that changed since an earlier upload of
+    the node collector into the series of its node.
+
+    The request body is a JSON encoded ContainerMetricDelta. If the upload
+    is a delta to a different upload than the one merged last, e.g. after a
+    restart of the cluster collector, it is discarded and a keyframe is
+    requested instead."""
+    async with _received_upload(request) as body:
+        return await run_in_threadpool(
+            uploads.update_container_metric_deltas,
+            app.state,
+            body,
+            metadata_digest,
+        )
 
 
 @app.get("/container_metrics")
@@ -310,6 +524,46 @@ def send_container_metrics(
     return app.state.container_metric_queue.get_all()
 
 
+@app.get("/container_metric_rates")
+def send_container_metric_rates(
+    token: str = Depends(authenticate_get),  # pylint: disable=unused-argument
+) -> Sequence[ContainerMetricRate]:
+    """Get per-second rates of all container counter metrics, computed from
+    the two most recent samples"""
+    return app.state.container_metric_rate_queue.get_all()
+
+
+def _cache_snapshot() -> SubscriptionEvent:
+    return SubscriptionEvent(
+        "snapshot",
+        CacheSnapshot(
+            container_metrics=app.state.container_metric_queue.get_all(),
+            machine_sections=_stored_machine_sections(),
+        ).model_dump_json(),
+    )
+
+
+@app.get("/subscribe", response_class=StreamingResponse)
+async def subscribe(
+    token: str = Depends(authenticate_get),  # pylint: disable=unused-argument
+) -> StreamingResponse:
+    """Stream cache updates as server-sent events.
+
+    The stream starts with a `snapshot` event holding all container metrics and
+    machine sections. It continues with a `container_metrics` or
+    `machine_sections` event whenever a node collector posts new data. If the
+    subscriber cannot keep up, another `snapshot` event is sent."""
+    return StreamingResponse(
+        stream_events(
+            app.state.subscription_hub,
+            partial(run_in_threadpool, _cache_snapshot),
+            keepalive_interval=SUBSCRIPTION_KEEPALIVE_INTERVAL,
+        ),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache"},
+    )
+
+
 @app.get("/metadata")
 def send_metadata(
     token: str = Depends(authenticate_get),  # pylint: disable=unused-argument
@@ -329,6 +583,7 @@ def send_metadata(
                 maxsize=app.state.machine_sections_queue.maxsize,
             ),
         ),
+        ingestion_health=app.state.ingestion_writer.health(),
         **dict(app.state.static_metadata),
     )
     return Metadata(
@@ -379,6 +634,61 @@ def parse_arguments(argv: Sequence[str]) -> argparse.Namespace:
         help="Specify the time-to-live (seconds) entries are persisted in the "
         "cache. Entries exceeding ttl are removed from the cache.",
     )
+    parser.add_argument(
+        "--auth-cache-ttl",
+        type=int,
+        help="Specify the time-to-live (seconds) of successful authentications "
+        "in the auth cache. Requests with a cached token are not reviewed by "
+        "the Kubernetes API again. 0 disables the auth cache.",
+    )
+    parser.add_argument(
+        "--ingestion-queue-size",
+        type=int,
+        help="Specify the maximum number of uploads that are queued to be "
+        "written to the cache. Once it is reached, further uploads are "
+        "rejected with 429 and a Retry-After header.",
+    )
+    parser.add_argument(
+        "--ingestion-group-window",
+        type=float,
+        help="Specify the time (seconds) uploads are collected for, once the "
+        "first one arrived. Uploads collected together are written to the "
+        "cache as one transaction.",
+    )
+    parser.add_argument(
+        "--max-in-flight-uploads",
+        type=int,
+        help="Specify the maximum number of uploads that are received and "
+        "decoded at a time. Further uploads are rejected with 429 Too Many "
+        "Requests.",
+    )
+    parser.add_argument(
+        "--max-queued-upload-bytes",
+        type=int,
+        help="Specify the maximum size (bytes) of the uploads waiting to be "
+        "written to the cache, after decompression. Further uploads are "
+        "rejected with 429 Too Many Requests.",
+    )
+    parser.add_argument(
+        "--subscription-buffer-size",
+        type=int,
+        help="Specify the maximum number of events buffered for each subscriber "
+        "of the /subscribe endpoint. A subscriber exceeding it is sent a new "
+        "snapshot of the cache instead of the buffered events.",
+    )
+    parser.add_argument(
+        "--machine-sections-encoding",
+        choices=[encoding.value for encoding in supported_encodings()],
+        help="Content coding machine sections are compressed with while they "
+        "are held in the cache. Clients accepting it are served the compressed "
+        "data as is.",
+    )
+    parser.add_argument(
+        "--max-request-body-size",
+        type=int,
+        help="Specify the maximum size (bytes) of a compressed request body "
+        "after decompression. Larger request bodies are rejected.",
+    )
     parser.add_argument(
         "--log-level",
         choices=["debug", "info", "warning", "error", "critical"],
@@ -397,17 +707,33 @@ def parse_arguments(argv: Sequence[str]) -> argparse.Namespace:
         writer_whitelist="checkmk-monitoring:node-collector",
         cache_maxsize=10000,
         cache_ttl=120,
+        auth_cache_ttl=60,
+        ingestion_queue_size=1000,
+        ingestion_group_window=0.005,
+        max_in_flight_uploads=64,
+        max_queued_upload_bytes=256 * 1024 * 1024,
+        subscription_buffer_size=1000,
+        machine_sections_encoding=ContentEncoding.GZIP.value,
+        max_request_body_size=64 * 1024 * 1024,
         log_level="error",
     )
 
     return parser.parse_args(argv)
 
 
-def _init_app_state(
+def _init_app_state(  # pylint: disable=too-many-arguments,too-many-locals
     app_,
     *,
     cache_maxsize: int,
     cache_ttl: int,
+    auth_cache_ttl: int,
+    ingestion_queue_size: int,
+    ingestion_group_window: float,
+    max_in_flight_uploads: int,
+    max_queued_upload_bytes: int,
+    subscription_buffer_size: int,
+    machine_sections_encoding: ContentEncoding,
+    max_request_body_size: int,
     reader_whitelist: Sequence[str],
     writer_whitelist: Sequence[str],
     tcp_timeout: TCPTimeout,
@@ -419,7 +745,37 @@ def _init_app_state(
         ttl=cache_ttl,
     )
     app_.state.container_metric_queue = container_metric_queue
-    app_.state.machine_sections_queue = DedupTTLCache[NodeName, MachineSections](
+    app_.state.container_metric_rate_queue = DedupTTLCache[
+        ContainerMetricKey, ContainerMetricRate
+    ](
+        key=container_metric_key,
+        maxsize=cache_maxsize,
+        ttl=cache_ttl,
+    )
+    app_.state.container_series_queue = DedupTTLCache[NodeName, NodeContainerSeries](
+        key=lambda x: x.node,
+        maxsize=10000,  # Kubernetes clusters can have a max of 5000 nodes.
+        ttl=cache_ttl,
+    )
+    app_.state.stored_upload_queue = DedupTTLCache[MetadataKey, StoredUpload](
+        key=lambda x: metadata_key(x.metadata),
+        maxsize=10000,
+        ttl=cache_ttl,
+    )
+    app_.state.upload_digest_queue = DedupTTLCache[str, UploadDigest](
+        key=lambda x: x.digest,
+        maxsize=10000,
+        ttl=cache_ttl,
+    )
+    app_.state.metadata_digest_queue = DedupTTLCache[str, MetadataDigest](
+        key=lambda x: x.digest,
+        maxsize=10000,
+        ttl=cache_ttl,
+    )
+    app_.state.machine_sections_encoding = machine_sections_encoding
+    app_.state.machine_sections_queue = DedupTTLCache[
+        NodeName, CompressedMachineSections
+    ](
         key=lambda x: x.node_name,
         maxsize=cache_maxsize,
         ttl=cache_ttl,
@@ -432,10 +788,36 @@ def _init_app_state(
         # Each node collector daemonset sends their own metadata to this queue
         ttl=cache_ttl,
     )
+    if getattr(app_.state, "ingestion_writer", None) is not None:
+        app_.state.ingestion_writer.stop()
+    app_.state.ingestion_writer = IngestionWriter(
+        maxsize=ingestion_queue_size,
+        group_window=ingestion_group_window,
+        transaction=partial(uploads.ingestion_transaction, app_.state),
+    )
+    app_.state.upload_phases = UploadPhases(
+        lambda: map(metadata_key, app_.state.node_collector_metadata_queue.get_all())
+    )
+    app_.state.admission_control = AdmissionControl(
+        app_.state.ingestion_writer,
+        max_in_flight=max_in_flight_uploads,
+        max_queued_bytes=max_queued_upload_bytes,
+    )
+    app_.state.subscription_hub = SubscriptionHub(maxsize=subscription_buffer_size)
+    app_.state.max_request_body_size = max_request_body_size
     app_.state.static_metadata = static_metadata
     app_.state.reader_whitelist = frozenset(reader_whitelist)
     app_.state.writer_whitelist = frozenset(writer_whitelist)
     app_.state.tcp_session = tcp_session(timeout=tcp_timeout)
+    app_.state.auth_cache = (
+        DedupTTLCache[str, str](
+            key=lambda x: x,
+            maxsize=cache_maxsize,
+            ttl=auth_cache_ttl,
+        )
+        if auth_cache_ttl > 0
+        else None
+    )
 
 
 def main(argv: Optional[Sequence[str]] = None) -> None:
@@ -446,6 +828,14 @@ def main(argv: Optional[Sequence[str]] = None) -> None:
         app,
         cache_maxsize=args.cache_maxsize,
         cache_ttl=args.cache_ttl,
+        auth_cache_ttl=args.auth_cache_ttl,
+        ingestion_queue_size=args.ingestion_queue_size,
+        ingestion_group_window=args.ingestion_group_window,
+        max_in_flight_uploads=args.max_in_flight_uploads,
+        max_queued_upload_bytes=args.max_queued_upload_bytes,
+        subscription_buffer_size=args.subscription_buffer_size,
+        machine_sections_encoding=ContentEncoding(args.machine_sections_encoding),
+        max_request_body_size=args.max_request_body_size,
         reader_whitelist=args.reader_whitelist.split(","),
         writer_whitelist=args.writer_whitelist.split(","),
         tcp_timeout=(args.connect_timeout, args.read_timeout),
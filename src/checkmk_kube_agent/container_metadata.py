@@ -7,6 +7,8 @@
 
 """Cluster and node collector container metadata collection."""
 
+import hashlib
+
 from checkmk_kube_agent.type_defs import (
     CheckmkKubeAgentMetadata,
     CollectorMetadata,
@@ -21,6 +23,9 @@ from checkmk_kube_agent.type_defs import (
     Version,
 )
 
+# Header of uploads of node collectors with the digest of their metadata
+METADATA_DIGEST_HEADER = "Checkmk-Node-Collector-Metadata-Digest"
+
 
 def parse_metadata(
     *,
@@ -69,3 +74,11 @@ def parse_node_collector_metadata(
         collector_type=collector_type,
         components=components,
     )
+
+
+def metadata_digest(metadata: NodeCollectorMetadata) -> str:
+    """Digest of node collector metadata, by which the cluster collector
+    recognizes metadata it already knows"""
+    return hashlib.blake2b(
+        metadata.model_dump_json().encode("utf-8"), digest_size=16
+    ).hexdigest()
@@ -0,0 +1,363 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright (C) 2021 Checkmk GmbH - License: GNU General Public License v2
+# This file is part of Checkmk (https://checkmk.com). It is subject to the
+# terms and conditions defined in the file COPYING, which is part of this
+# source code package.
+
+"""HTTP content codings used by the collectors.
+
+Only codings whose compressed members may be concatenated are supported:
+both a sequence of gzip members and a sequence of zstd frames decompress to
+the concatenation of their contents. This allows to serve data that was
+compressed piece by piece without recompressing it."""
+
+import gzip
+import importlib
+import zlib
+from functools import cache
+from types import ModuleType
+from typing import Any, Callable, Iterable, Iterator, Optional, Sequence, Tuple
+
+from checkmk_kube_agent.type_defs import ContentEncoding
+
+try:
+    # Part of the standard library as of Python 3.14, but only if CPython was
+    # built against libzstd.
+    ZSTD: Optional[ModuleType] = importlib.import_module("compression.zstd")
+except ImportError:  # pragma: no cover
+    ZSTD = None
+
+GZIP_COMPRESSLEVEL = 6
+
+# Name of the zstd dictionary below, as sent in the header ZSTD_DICTIONARY_HEADER.
+# Change the name whenever the content of the dictionary changes: node and
+# cluster collectors of different versions must not use different content
+# under the same name.
+METRIC_NAMES_DICTIONARY = "cadvisor-metric-names-1"
+ZSTD_DICTIONARY_HEADER = "Checkmk-Zstd-Dictionary"
+
+# Names of the metrics cAdvisor exposes per container.
+CADVISOR_METRIC_NAMES = (
+    "container_cpu_cfs_periods_total",
+    "container_cpu_cfs_throttled_periods_total",
+    "container_cpu_cfs_throttled_seconds_total",
+    "container_cpu_load_average_10s",
+    "container_cpu_system_seconds_total",
+    "container_cpu_usage_seconds_total",
+    "container_cpu_user_seconds_total",
+    "container_file_descriptors",
+    "container_fs_inodes_free",
+    "container_fs_inodes_total",
+    "container_fs_io_current",
+    "container_fs_io_time_seconds_total",
+    "container_fs_io_time_weighted_seconds_total",
+    "container_fs_limit_bytes",
+    "container_fs_read_seconds_total",
+    "container_fs_reads_bytes_total",
+    "container_fs_reads_merged_total",
+    "container_fs_reads_total",
+    "container_fs_sector_reads_total",
+    "container_fs_sector_writes_total",
+    "container_fs_usage_bytes",
+    "container_fs_write_seconds_total",
+    "container_fs_writes_bytes_total",
+    "container_fs_writes_merged_total",
+    "container_fs_writes_total",
+    "container_last_seen",
+    "container_memory_cache",
+    "container_memory_failcnt",
+    "container_memory_failures_total",
+    "container_memory_mapped_file",
+    "container_memory_max_usage_bytes",
+    "container_memory_rss",
+    "container_memory_swap",
+    "container_memory_usage_bytes",
+    "container_memory_working_set_bytes",
+    "container_network_receive_bytes_total",
+    "container_network_receive_errors_total",
+    "container_network_receive_packets_dropped_total",
+    "container_network_receive_packets_total",
+    "container_network_transmit_bytes_total",
+    "container_network_transmit_errors_total",
+    "container_network_transmit_packets_dropped_total",
+    "container_network_transmit_packets_total",
+    "container_processes",
+    "container_scrape_error",
+    "container_sockets",
+    "container_spec_cpu_period",
+    "container_spec_cpu_quota",
+    "container_spec_cpu_shares",
+    "container_spec_memory_limit_bytes",
+    "container_spec_memory_reservation_limit_bytes",
+    "container_spec_memory_swap_limit_bytes",
+    "container_start_time_seconds",
+    "container_tasks_state",
+    "container_threads",
+    "container_threads_max",
+    "container_ulimits_soft",
+)
+
+# Raw content dictionary for uploads of container metrics: the metric names
+# and the recurring JSON fragments.
+_METRIC_NAMES_DICTIONARY_CONTENT = "".join(
+    f'{{"container_name":"k8s_","namespace":"kube-system","pod_uid":"",'
+    f'"pod_name":"","metric_name":"{metric_name}","metric_value_string":"0",'
+    f'"timestamp":'
+    for metric_name in CADVISOR_METRIC_NAMES
+).encode("utf-8")
+
+
+class SizeLimitExceeded(ValueError):
+    """Decompressed content exceeds the permitted size"""
+
+
+def supported_encodings() -> Sequence[ContentEncoding]:
+    """Content codings available in this Python build.
+
+    >>> ContentEncoding.GZIP in supported_encodings()
+    True
+    """
+    return [
+        encoding
+        for encoding in ContentEncoding
+        if encoding is not ContentEncoding.ZSTD or ZSTD is not None
+    ]
+
+
+def _zstd() -> ModuleType:
+    if ZSTD is None:  # pragma: no cover
+        raise ValueError("zstd is not supported by this Python build")
+    return ZSTD
+
+
+@cache
+def _zstd_dictionary(name: str) -> Any:
+    if name != METRIC_NAMES_DICTIONARY:
+        raise ValueError(f"Unknown zstd dictionary: {name}")
+    return _zstd().ZstdDict(_METRIC_NAMES_DICTIONARY_CONTENT, is_raw=True)
+
+
+def compress(
+    content: bytes,
+    encoding: ContentEncoding,
+    *,
+    zstd_dictionary: Optional[str] = None,
+) -> bytes:
+    """Compress data with the given content coding.
+
+    A named zstd dictionary may be used, which the counterpart has to be
+    told about in the header ZSTD_DICTIONARY_HEADER.
+
+    >>> compress(b"foo", ContentEncoding.IDENTITY)
+    b'foo'
+
+    >>> gzip.decompress(compress(b"foo", ContentEncoding.GZIP))
+    b'foo'
+    """
+    if encoding is ContentEncoding.GZIP:
+        return gzip.compress(content, compresslevel=GZIP_COMPRESSLEVEL, mtime=0)
+    if encoding is ContentEncoding.ZSTD:
+        return _zstd().compress(
+            content,
+            zstd_dict=zstd_dictionary and _zstd_dictionary(zstd_dictionary),
+        )
+    return content
+
+
+def compress_stream(
+    chunks: Iterable[bytes],
+    encoding: ContentEncoding,
+    *,
+    zstd_dictionary: Optional[str] = None,
+) -> Iterator[bytes]:
+    """Compress a stream of data chunk by chunk with the given content coding,
+    into a single gzip member or zstd frame.
+
+    >>> gzip.decompress(b"".join(compress_stream([b"foo", b"bar"], ContentEncoding.GZIP)))
+    b'foobar'
+    """
+    if encoding is ContentEncoding.IDENTITY:
+        yield from chunks
+        return
+    compressor = (
+        zlib.compressobj(GZIP_COMPRESSLEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        if encoding is ContentEncoding.GZIP
+        else _zstd().ZstdCompressor(
+            zstd_dict=zstd_dictionary and _zstd_dictionary(zstd_dictionary)
+        )
+    )
+    for chunk in chunks:
+        if compressed := compressor.compress(chunk):
+            yield compressed
+    yield compressor.flush()
+
+
+def decompress(content: bytes, encoding: ContentEncoding) -> bytes:
+    """Decompress data with the given content coding.
+
+    Concatenated gzip members or zstd frames are decompressed as a whole.
+
+    >>> decompress(b"foo", ContentEncoding.IDENTITY)
+    b'foo'
+
+    >>> decompress(
+    ...     compress(b"foo", ContentEncoding.GZIP) + compress(b"bar", ContentEncoding.GZIP),
+    ...     ContentEncoding.GZIP,
+    ... )
+    b'foobar'
+    """
+    if encoding is ContentEncoding.GZIP:
+        return gzip.decompress(content)
+    if encoding is ContentEncoding.ZSTD:
+        return _zstd().decompress(content)
+    return content
+
+
+def decompress_bounded(
+    content: bytes,
+    encoding: ContentEncoding,
+    *,
+    max_size: int,
+    zstd_dictionary: Optional[str] = None,
+) -> bytes:
+    """Decompress data with the given content coding like `decompress`, without
+    ever holding more than `max_size` bytes of decompressed content.
+
+    Raises `SizeLimitExceeded` if the decompressed content is larger than
+    `max_size`, and `ValueError` if the content is malformed. Data following
+    the last gzip member or zstd frame is malformed as well.
+
+    >>> decompress_bounded(compress(b"foo", ContentEncoding.GZIP),
+    ...     ContentEncoding.GZIP, max_size=3)
+    b'foo'
+
+    >>> decompress_bounded(compress(b"foo", ContentEncoding.GZIP),
+    ...     ContentEncoding.GZIP, max_size=2)
+    Traceback (most recent call last):
+    ...
+    checkmk_kube_agent.content_encoding.SizeLimitExceeded: Decompressed content exceeds 2 bytes
+
+    >>> decompress_bounded(compress(b"foo", ContentEncoding.GZIP)[:-1],
+    ...     ContentEncoding.GZIP, max_size=3)
+    Traceback (most recent call last):
+    ...
+    ValueError: Incomplete gzip content
+
+    >>> decompress_bounded(
+    ...     compress(b"foo", ContentEncoding.GZIP) + compress(b"bar", ContentEncoding.GZIP),
+    ...     ContentEncoding.GZIP, max_size=5)
+    Traceback (most recent call last):
+    ...
+    checkmk_kube_agent.content_encoding.SizeLimitExceeded: Decompressed content exceeds 5 bytes
+
+    >>> decompress_bounded(b"foo", ContentEncoding.GZIP, max_size=3)
+    Traceback (most recent call last):
+    ...
+    ValueError: Malformed gzip content
+
+    >>> decompress_bounded(b"foo", ContentEncoding.IDENTITY, max_size=2)
+    Traceback (most recent call last):
+    ...
+    checkmk_kube_agent.content_encoding.SizeLimitExceeded: Decompressed content exceeds 2 bytes
+    """
+    if encoding is ContentEncoding.IDENTITY:
+        decompressed, complete = content, True
+    elif encoding is ContentEncoding.GZIP:
+        try:
+            decompressed, complete = _decompress_members(
+                content,
+                max_size,
+                lambda: zlib.decompressobj(wbits=16 + zlib.MAX_WBITS),
+            )
+        except zlib.error as exception:
+            raise ValueError("Malformed gzip content") from exception
+    else:
+        decompressed, complete = _zstd_decompress_bounded(
+            content, max_size, zstd_dictionary
+        )
+
+    if len(decompressed) > max_size:
+        raise SizeLimitExceeded(f"Decompressed content exceeds {max_size} bytes")
+    if not complete:
+        raise ValueError(f"Incomplete {encoding.value} content")
+    return decompressed
+
+
+def _zstd_decompress_bounded(
+    content: bytes, max_size: int, zstd_dictionary: Optional[str]
+) -> Tuple[bytes, bool]:
+    zstd_dict = zstd_dictionary and _zstd_dictionary(zstd_dictionary)
+    zstd = _zstd()
+    try:
+        return _decompress_members(
+            content, max_size, lambda: zstd.ZstdDecompressor(zstd_dict=zstd_dict)
+        )
+    except zstd.ZstdError as exception:
+        raise ValueError("Malformed zstd content") from exception
+
+
+def _decompress_members(
+    content: bytes, max_size: int, decompressor: Callable[[], Any]
+) -> Tuple[bytes, bool]:
+    """Decompress the gzip members or zstd frames of `content` one after
+    another, each with a new decompressor, until the content is consumed or
+    more than `max_size` bytes are decompressed. Returns the decompressed
+    content and whether its last member is complete."""
+    decompressed = b""
+    while True:
+        member = decompressor()
+        decompressed += member.decompress(content, max_size + 1 - len(decompressed))
+        if len(decompressed) > max_size or not member.eof:
+            return decompressed, False
+        if not (content := member.unused_data):
+            return decompressed, True
+
+
+def accepts_encoding(accept_encoding: Optional[str], encoding: ContentEncoding) -> bool:
+    """Whether a client accepts a content coding, according to its
+    Accept-Encoding header.
+
+    >>> accepts_encoding("gzip, deflate, br", ContentEncoding.GZIP)
+    True
+
+    >>> accepts_encoding("gzip;q=0, *", ContentEncoding.GZIP)
+    False
+
+    >>> accepts_encoding("zstd;q=0.5, *;q=0", ContentEncoding.ZSTD)
+    True
+
+    >>> accepts_encoding("*", ContentEncoding.ZSTD)
+    True
+
+    >>> accepts_encoding("gzip;level=1", ContentEncoding.GZIP)
+    True
+
+    >>> accepts_encoding("gzip;q=high", ContentEncoding.GZIP)
+    False
+
+    >>> accepts_encoding("deflate", ContentEncoding.GZIP)
+    False
+
+    >>> accepts_encoding(None, ContentEncoding.GZIP)
+    False
+
+    >>> accepts_encoding(None, ContentEncoding.IDENTITY)
+    True
+    """
+    if encoding is ContentEncoding.IDENTITY:
+        return True
+
+    qualities = {}
+    for coding in (accept_encoding or "").split(","):
+        name, *parameters = (part.strip() for part in coding.split(";"))
+        quality = 1.0
+        for parameter in parameters:
+            if parameter.startswith("q="):
+                try:
+                    quality = float(parameter[2:])
+                except ValueError:
+                    quality = 0.0
+        qualities[name.lower()] = quality
+
+    return qualities.get(encoding.value, qualities.get("*", 0.0)) > 0
@@ -8,8 +8,9 @@
 """DedupTTLCache to store data in RAM. Deduplicates entries based on a key
 function and adds thread safety to TTLCache."""
 
-from threading import Lock
-from typing import Callable, Sequence, TypeVar
+from contextlib import contextmanager
+from threading import RLock
+from typing import Callable, Iterable, Iterator, Optional, Sequence, TypeVar
 
 from cachetools import TTLCache
 
@@ -70,7 +71,7 @@ class DedupTTLCache(TTLCache[K, V]):
 
         super().__init__(maxsize=maxsize, ttl=ttl)
         self.key = key
-        self.__lock = Lock()
+        self.__lock = RLock()
 
     def put(self, entry: V):
         """Add entries to the TTL cache.
@@ -82,6 +83,61 @@ class DedupTTLCache(TTLCache[K, V]):
         with self.__lock:
             self[key] = entry
 
+    def replace(self, entry: V) -> Optional[V]:
+        """Add entries to the TTL cache like `put`, and return the entry that
+        was overwritten.
+
+        Returns `None` if there was no entry with the same key, or if it had
+        already expired."""
+        key = self.key(entry)
+        with self.__lock:
+            previous = self.get(key)
+            self[key] = entry
+        return previous
+
+    def find(self, key: K) -> Optional[V]:
+        """Get the entry with the given key.
+
+        Returns `None` if there is no such entry, or if it has expired."""
+        with self.__lock:
+            return self.get(key)
+
+    def refresh(self, entries: Iterable[V]) -> bool:
+        """Reset the time to live of the entries with the same keys as the
+        given entries.
+
+        Returns `False` if any of these entries has expired or was discarded,
+        in which case the remaining entries are refreshed nonetheless."""
+        refreshed = True
+        with self.__lock:
+            for entry in entries:
+                key = self.key(entry)
+                if (cached := self.get(key)) is None:
+                    refreshed = False
+                else:
+                    self[key] = cached
+        return refreshed
+
+    @contextmanager
+    def transaction(self) -> Iterator[None]:
+        """Lock the cache for the duration of the context, so that the writes
+        within it are applied as one transaction.
+
+        The time is frozen when the context is entered, so that all writes
+        within it see the same entries as expired. These are removed when the
+        context is entered, which leaves none to remove for the writes.
+
+            >>> c = DedupTTLCache(key=lambda x: x[0])
+            >>> with c.transaction():
+            ...     c.put(("foo", "bar"))
+            ...     c.put(("bar", "foo"))
+            >>> c.get_all()
+            [('foo', 'bar'), ('bar', 'foo')]
+        """
+        with self.__lock, self.timer as time:
+            self.expire(time)
+            yield
+
     def get_all(self) -> Sequence[V]:
         """Get all entries from the TTL cache."""
         with self.__lock:
@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright (C) 2021 Checkmk GmbH - License: GNU General Public License v2
+# This file is part of Checkmk (https://checkmk.com). It is subject to the
+# terms and conditions defined in the file COPYING, which is part of this
+# source code package.
+
+"""Ingestion of uploads of node collectors: admission control, the single
+writer thread applying them to the cache, and their spreading over the
+polling interval."""
+
+import logging
+import math
+import queue
+import time
+from bisect import bisect_left
+from concurrent.futures import Future
+from contextlib import contextmanager, nullcontext
+from threading import Lock, Thread
+from typing import (
+    Any,
+    Callable,
+    ContextManager,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+    TypeVar,
+)
+
+from checkmk_kube_agent.type_defs import IngestionHealth
+
+LOGGER = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class _WriteJob(NamedTuple):
+    write: Callable[[], Any]
+    future: "Future[Any]"
+    enqueued: float
+    size: int
+
+
+class IngestionOverloaded(Exception):
+    """An upload was not admitted. It may be retried after `retry_after`
+    seconds."""
+
+    def __init__(self, message: str, retry_after: int) -> None:
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class IngestionWriter:
+    """Bounded queue of writes to the cache, which are applied in order by a
+    single writer thread.
+
+    Request handlers decode uploads concurrently and only submit the
+    resulting writes. If the queue is full, submitting raises
+    IngestionOverloaded instead of waiting for the writer to catch up.
+
+    Writes submitted within `group_window` seconds of each other are applied
+    as a group, within a single `transaction`. Their futures are resolved
+    once the transaction is done.
+
+    The writer thread is started with the first write, so that it runs in the
+    process serving the requests, i.e. after gunicorn forked its worker."""
+
+    def __init__(
+        self,
+        maxsize: int,
+        *,
+        group_window: float = 0.0,
+        transaction: Callable[[], ContextManager[None]] = nullcontext,
+    ) -> None:
+        if maxsize <= 0:
+            raise ValueError(f"maxsize must be at least 1, got {maxsize}")
+
+        self._group_window = group_window
+        self._transaction = transaction
+        self._queue: "queue.Queue[Optional[_WriteJob]]" = queue.Queue(maxsize)
+        self._thread: Optional[Thread] = None
+        self._lag = 0.0
+        self._queued_bytes = 0
+        self.__lock = Lock()
+
+    def submit(self, write: Callable[[], T], *, size: int = 0) -> "Future[T]":
+        """Queue a write of an upload of `size` bytes. The returned future is
+        resolved once it was applied.
+
+        Raises IngestionOverloaded if the queue is full."""
+        future: "Future[T]" = Future()
+        self._start()
+        with self.__lock:
+            self._queued_bytes += size
+        try:
+            self._queue.put_nowait(_WriteJob(write, future, time.monotonic(), size))
+        except queue.Full as exception:
+            with self.__lock:
+                self._queued_bytes -= size
+            raise IngestionOverloaded(
+                f"Too many writes queued ({self._queue.maxsize})", self.retry_after()
+            ) from exception
+        return future
+
+    def join(self) -> None:
+        """Wait until all queued writes are applied."""
+        self._queue.join()
+
+    def stop(self) -> None:
+        """Apply the queued writes and stop the writer thread."""
+        with self.__lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(None)
+            thread.join()
+
+    def queued_bytes(self) -> int:
+        """Size of the uploads that are queued or being applied."""
+        with self.__lock:
+            return self._queued_bytes
+
+    def retry_after(self) -> int:
+        """Whole seconds until the writer is expected to have caught up, at
+        least one."""
+        return max(1, math.ceil(self._lag))
+
+    def health(self) -> IngestionHealth:
+        """Number and size of queued writes and the time the most recently
+        applied write waited in the queue."""
+        return IngestionHealth(
+            queue_depth=self._queue.qsize(),
+            queued_bytes=self.queued_bytes(),
+            maxsize=self._queue.maxsize,
+            lag=self._lag,
+        )
+
+    def _start(self) -> None:
+        with self.__lock:
+            if self._thread is None:
+                self._thread = Thread(
+                    target=self._run, name="ingestion-writer", daemon=True
+                )
+                self._thread.start()
+
+    def _run(self) -> None:
+        stopped = False
+        while not stopped:
+            group, stopped = self._collect_group()
+            try:
+                self._apply(group)
+            except Exception as exception:  # pylint: disable=broad-exception-caught
+                LOGGER.exception("Failed to apply uploads")
+                for job in group:
+                    job.future.set_exception(exception)
+            finally:
+                with self.__lock:
+                    self._queued_bytes -= sum(job.size for job in group)
+                for _ in range(len(group) + stopped):
+                    self._queue.task_done()
+
+    def _collect_group(self) -> Tuple[List[_WriteJob], bool]:
+        """Wait for a write, and collect the writes submitted within the group
+        window after it. Returns whether the writer was stopped."""
+        group: List[_WriteJob] = []
+        job = self._queue.get()
+        deadline = time.monotonic() + self._group_window
+        while job is not None:
+            group.append(job)
+            try:
+                job = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                return group, False
+        return group, True
+
+    def _apply(self, group: List[_WriteJob]) -> None:
+        if not group:
+            return
+        self._lag = time.monotonic() - group[0].enqueued
+        outcomes: List[Tuple["Future[Any]", Any, Optional[Exception]]] = []
+        with self._transaction():
+            for job in group:
+                try:
+                    outcomes.append((job.future, job.write(), None))
+                except Exception as exception:  # pylint: disable=broad-exception-caught
+                    LOGGER.exception("Failed to apply upload")
+                    outcomes.append((job.future, None, exception))
+        for future, result, error in outcomes:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+
+class AdmissionControl:
+    """Reject uploads while the cluster collector is overloaded, rather than
+    letting them queue up until the node collectors time out.
+
+    An upload is rejected if `max_in_flight` uploads are already being
+    received, decoded or waiting to be queued. Once it was received, it is
+    rejected if queueing it would exceed `max_queued_bytes` in the queue of
+    the `writer`, in the same unit the writer counts them in. An upload is
+    accepted regardless of its size if the queue is empty."""
+
+    def __init__(
+        self,
+        writer: IngestionWriter,
+        *,
+        max_in_flight: int,
+        max_queued_bytes: int,
+    ) -> None:
+        if max_in_flight <= 0:
+            raise ValueError(f"max_in_flight must be at least 1, got {max_in_flight}")
+
+        self.max_in_flight = max_in_flight
+        self.max_queued_bytes = max_queued_bytes
+        self._writer = writer
+        self._in_flight = 0
+        self.__lock = Lock()
+
+    def admit(self) -> ContextManager[None]:
+        """Admit an upload for the duration of the returned context, or raise
+        IngestionOverloaded."""
+        with self.__lock:
+            if self._in_flight >= self.max_in_flight:
+                raise IngestionOverloaded(
+                    f"Too many uploads in flight ({self._in_flight})",
+                    self._writer.retry_after(),
+                )
+            self._in_flight += 1
+        return self._admitted()
+
+    def accept(self, size: int) -> None:
+        """Accept a received upload of `size` bytes for queueing, or raise
+        IngestionOverloaded."""
+        queued_bytes = self._writer.queued_bytes()
+        if queued_bytes and queued_bytes + size > self.max_queued_bytes:
+            raise IngestionOverloaded(
+                f"Too many bytes queued ({queued_bytes})",
+                self._writer.retry_after(),
+            )
+
+    @contextmanager
+    def _admitted(self) -> Iterator[None]:
+        try:
+            yield
+        finally:
+            with self.__lock:
+                self._in_flight -= 1
+
+
+class UploadPhases:  # pylint: disable=too-few-public-methods
+    """Spread the uploads of node collectors evenly over their polling
+    interval.
+
+    Each node collector is assigned a phase in [0, 1): the fraction of the
+    polling interval after which it should upload. The `known` node collectors
+    are ordered by their key and their phases are evenly spaced. They are
+    looked up again at most every `refresh_interval` seconds.
+
+        >>> phases = UploadPhases(lambda: ["a", "b", "c", "d"])
+        >>> [phases.phase(key) for key in ("a", "c", "d")]
+        [0.0, 0.5, 0.75]
+
+    A node collector that is not known yet is placed as if it was.
+
+        >>> phases.phase("bb")
+        0.4
+    """
+
+    def __init__(
+        self, known: Callable[[], Iterable[str]], *, refresh_interval: float = 1.0
+    ) -> None:
+        self._known = known
+        self._refresh_interval = refresh_interval
+        self._keys: List[str] = []
+        self._refreshed: Optional[float] = None
+        self.__lock = Lock()
+
+    def phase(self, key: str) -> float:
+        """Phase of the node collector with the given key."""
+        keys = self._sorted_keys()
+        index = bisect_left(keys, key)
+        known = index < len(keys) and keys[index] == key
+        return index / (len(keys) + (not known))
+
+    def _sorted_keys(self) -> List[str]:
+        now = time.monotonic()
+        with self.__lock:
+            if (
+                self._refreshed is None
+                or now - self._refreshed >= self._refresh_interval
+            ):
+                self._keys = sorted(set(self._known()))
+                self._refreshed = now
+            return self._keys
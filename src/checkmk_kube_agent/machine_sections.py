@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright (C) 2021 Checkmk GmbH - License: GNU General Public License v2
+# This file is part of Checkmk (https://checkmk.com). It is subject to the
+# terms and conditions defined in the file COPYING, which is part of this
+# source code package.
+
+"""Storage format of machine sections in the cluster collector.
+
+Machine sections are large and repetitive, so they are kept compressed. Each
+node's sections are stored already wrapped in a piggyback block, which is
+compressed as a single gzip member or zstd frame. The agent output of all
+nodes can then be served by concatenating the stored entries as they are."""
+
+from typing import Iterable, Iterator
+
+from checkmk_kube_agent.content_encoding import compress, decompress
+from checkmk_kube_agent.type_defs import (
+    CompressedMachineSections,
+    ContentEncoding,
+    MachineSections,
+    NodeName,
+    RawMachineSections,
+)
+
+PIGGYBACK_FOOTER = b"<<<<>>>>\n"
+
+
+def _piggyback_header(node_name: NodeName) -> bytes:
+    return f"<<<<{node_name}>>>>\n".encode("utf-8")
+
+
+def compress_machine_sections(
+    machine_sections: RawMachineSections, content_encoding: ContentEncoding
+) -> CompressedMachineSections:
+    """Wrap the sections of a node in a piggyback block and compress it.
+
+    >>> compress_machine_sections(
+    ...     RawMachineSections(NodeName("a"), b"<<<uptime>>>\\n1"),
+    ...     ContentEncoding.IDENTITY,
+    ... )  # doctest: +NORMALIZE_WHITESPACE
+    CompressedMachineSections(node_name='a', content_encoding=<ContentEncoding.IDENTITY:
+    'identity'>, piggyback_block=b'<<<<a>>>>\\n<<<uptime>>>\\n1\\n<<<<>>>>\\n',
+    sections_size=14)
+    """
+    sections = machine_sections.sections
+    block = b"".join(
+        (
+            _piggyback_header(machine_sections.node_name),
+            sections,
+            b"" if sections.endswith(b"\n") else b"\n",
+            PIGGYBACK_FOOTER,
+        )
+    )
+    return CompressedMachineSections(
+        node_name=machine_sections.node_name,
+        content_encoding=content_encoding,
+        piggyback_block=compress(block, content_encoding),
+        sections_size=len(sections),
+    )
+
+
+def decompress_machine_sections(
+    machine_sections: CompressedMachineSections,
+) -> RawMachineSections:
+    """Restore the sections of a node as they were received.
+
+    >>> decompress_machine_sections(compress_machine_sections(
+    ...     RawMachineSections(NodeName("a"), b"<<<uptime>>>\\n1"),
+    ...     ContentEncoding.GZIP,
+    ... ))
+    RawMachineSections(node_name='a', sections=b'<<<uptime>>>\\n1')
+    """
+    block = decompress(
+        machine_sections.piggyback_block, machine_sections.content_encoding
+    )
+    start = len(_piggyback_header(machine_sections.node_name))
+    return RawMachineSections(
+        node_name=machine_sections.node_name,
+        sections=block[start : start + machine_sections.sections_size],
+    )
+
+
+def decode_machine_sections(machine_sections: RawMachineSections) -> MachineSections:
+    """Sections of a node as text, as served to clients requesting JSON.
+
+    >>> decode_machine_sections(RawMachineSections(NodeName("a"), b"<<<df>>>\\xff"))
+    MachineSections(node_name='a', sections='<<<df>>>\\ufffd')
+    """
+    return MachineSections(
+        node_name=machine_sections.node_name,
+        sections=machine_sections.sections.decode("utf-8", errors="replace"),
+    )
+
+
+def piggyback_agent_output(
+    machine_sections: Iterable[CompressedMachineSections],
+    content_encoding: ContentEncoding,
+) -> Iterator[bytes]:
+    """Render the machine sections of all nodes as Checkmk agent output with a
+    piggyback block for each node, encoded with the given content coding.
+
+    Entries that are stored with that content coding are passed on without
+    recompressing them.
+
+    >>> entries = [
+    ...     compress_machine_sections(
+    ...         RawMachineSections(NodeName("a"), b"<<<df>>>\\n/ 1\\n"),
+    ...         ContentEncoding.GZIP,
+    ...     ),
+    ...     compress_machine_sections(
+    ...         RawMachineSections(NodeName("b"), b"<<<uptime>>>\\n1"),
+    ...         ContentEncoding.GZIP,
+    ...     ),
+    ... ]
+
+    >>> b"".join(piggyback_agent_output(entries, ContentEncoding.IDENTITY)
+    ... ).decode("utf-8").splitlines()
+    ... # doctest: +NORMALIZE_WHITESPACE
+    ['<<<<a>>>>', '<<<df>>>', '/ 1', '<<<<>>>>',
+     '<<<<b>>>>', '<<<uptime>>>', '1', '<<<<>>>>']
+
+    >>> list(piggyback_agent_output(entries, ContentEncoding.GZIP)) == [
+    ...     entry.piggyback_block for entry in entries
+    ... ]
+    True
+    """
+    for entry in machine_sections:
+        if entry.content_encoding is content_encoding:
+            yield entry.piggyback_block
+        else:
+            yield compress(
+                decompress(entry.piggyback_block, entry.content_encoding),
+                content_encoding,
+            )
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright (C) 2021 Checkmk GmbH - License: GNU General Public License v2
+# This file is part of Checkmk (https://checkmk.com). It is subject to the
+# terms and conditions defined in the file COPYING, which is part of this
+# source code package.
+
+"""Delta uploads of container metrics.
+
+Most container series do not change between two polls. A node collector
+therefore only uploads the series that changed since its last upload the
+cluster collector acknowledged, and lists the keys of the others, so that
+they are kept alive. Every few uploads, and whenever the cluster collector
+lost track of the node's series, a keyframe with all series is sent
+instead.
+
+A series is unchanged if both its value and its own timestamp are. Series
+without a timestamp of their own take the timestamp of the latest upload.
+
+cAdvisor reports some metrics several times per container, e.g. per network
+interface. Such series share their key, and are uploaded, listed as
+unchanged and merged together. The cluster collector thus ingests all of
+them, as with uploads of the other formats, and computes no rates for
+them."""
+
+from typing import Dict, List, Optional, Sequence, Set, Tuple
+
+from checkmk_kube_agent.metric_table import encode_metric_table
+from checkmk_kube_agent.type_defs import (
+    ContainerMetric,
+    ContainerMetricDelta,
+    ContainerMetricRow,
+    ContainerMetricTable,
+    ContainerSeries,
+    MetricValueString,
+    NodeCollectorMetadata,
+    NodeContainerSeries,
+    SeriesKey,
+    Timestamp,
+)
+
+SeriesState = Tuple[MetricValueString, Optional[Timestamp]]
+
+
+class DeltaEncoder:
+    """Encode the container metrics of a node collector as deltas to its last
+    acknowledged upload.
+
+    Only the most recent upload may be acknowledged: an upload that was never
+    acknowledged, e.g. because it failed, is superseded by the next one."""
+
+    def __init__(self) -> None:
+        self._sequence = 0
+        self._acknowledged: Optional[int] = None
+        self._baseline: Dict[SeriesKey, List[SeriesState]] = {}
+        self._deltas_since_keyframe = 0
+        self._pending: Optional[
+            Tuple[int, bool, Dict[SeriesKey, List[SeriesState]]]
+        ] = None
+
+    def encode(
+        self,
+        container_metrics: Sequence[ContainerMetric],
+        timestamp: Timestamp,
+        metadata: NodeCollectorMetadata,
+        *,
+        keyframe_interval: int,
+    ) -> ContainerMetricDelta:
+        """Encode the current container metrics. This is a keyframe if there
+        is no acknowledged upload, or if `keyframe_interval` uploads have
+        passed since the last keyframe."""
+        keyframe = (
+            self._acknowledged is None
+            or self._deltas_since_keyframe + 1 >= keyframe_interval
+        )
+        table = encode_metric_table(container_metrics, timestamp)
+
+        series: Dict[SeriesKey, List[SeriesState]] = {}
+        for metric, row in zip(container_metrics, table.rows):
+            series.setdefault((metric.container_name, metric.metric_name), []).append(
+                (row[2], row[3])
+            )
+
+        rows: List[ContainerMetricRow] = []
+        unchanged: List[Tuple[int, int]] = []
+        listed: Set[SeriesKey] = set()
+        for metric, row in zip(container_metrics, table.rows):
+            key = (metric.container_name, metric.metric_name)
+            if keyframe or self._baseline.get(key) != series[key]:
+                rows.append(row)
+            elif key not in listed:
+                listed.add(key)
+                unchanged.append((row[0], row[1]))
+
+        self._sequence += 1
+        self._pending = (self._sequence, keyframe, series)
+        return ContainerMetricDelta(
+            sequence=self._sequence,
+            base_sequence=None if keyframe else self._acknowledged,
+            container_metrics=ContainerMetricTable(
+                containers=table.containers,
+                metric_names=table.metric_names,
+                rows=rows,
+                timestamp=timestamp,
+            ),
+            unchanged=unchanged,
+            metadata=metadata,
+        )
+
+    def acknowledge(self, sequence: int) -> None:
+        """The cluster collector merged the upload `sequence`, following
+        uploads are deltas to it."""
+        if self._pending is None or self._pending[0] != sequence:
+            return
+        _sequence, keyframe, series = self._pending
+        self._pending = None
+        self._acknowledged = sequence
+        self._baseline = series
+        self._deltas_since_keyframe = 0 if keyframe else self._deltas_since_keyframe + 1
+
+    def reset(self) -> None:
+        """Forget the acknowledged upload, so that the next upload is a
+        keyframe."""
+        self._acknowledged = None
+        self._baseline = {}
+        self._pending = None
+
+
+def merge_delta(
+    previous: Optional[NodeContainerSeries],
+    delta: ContainerMetricDelta,
+) -> Optional[NodeContainerSeries]:
+    """Merge an upload into the series of a node.
+
+    Series that are neither changed nor listed as unchanged are dropped.
+    Returns None if the upload is a delta to a different upload than the one
+    merged last, in which case a keyframe is required."""
+    if delta.base_sequence is not None and (
+        previous is None or previous.sequence != delta.base_sequence
+    ):
+        return None
+
+    table = delta.container_metrics
+    series: Dict[SeriesKey, List[ContainerSeries]] = {}
+    for container_index, metric_name_index in delta.unchanged:
+        key = (
+            table.containers[container_index].container_name,
+            table.metric_names[metric_name_index],
+        )
+        if previous is None or (unchanged := previous.series.get(key)) is None:
+            return None
+        series[key] = list(unchanged)
+    for container_index, metric_name_index, value, timestamp in table.rows:
+        container = table.containers[container_index]
+        metric_name = table.metric_names[metric_name_index]
+        series.setdefault((container.container_name, metric_name), []).append(
+            ContainerSeries(
+                container=container,
+                metric_name=metric_name,
+                value=value,
+                timestamp=timestamp,
+            )
+        )
+
+    return NodeContainerSeries(
+        node=delta.metadata.node,
+        sequence=delta.sequence,
+        timestamp=table.timestamp,
+        series=series,
+    )
+
+
+def node_container_metrics(
+    node_series: NodeContainerSeries,
+) -> Sequence[ContainerMetric]:
+    """Current container metrics of a node."""
+    return [
+        ContainerMetric(
+            container_name=series.container.container_name,
+            namespace=series.container.namespace,
+            pod_uid=series.container.pod_uid,
+            pod_name=series.container.pod_name,
+            metric_name=series.metric_name,
+            metric_value_string=series.value,
+            timestamp=(
+                node_series.timestamp if series.timestamp is None else series.timestamp
+            ),
+        )
+        for siblings in node_series.series.values()
+        for series in siblings
+    ]
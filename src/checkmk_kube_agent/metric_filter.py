@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright (C) 2021 Checkmk GmbH - License: GNU General Public License v2
+# This file is part of Checkmk (https://checkmk.com). It is subject to the
+# terms and conditions defined in the file COPYING, which is part of this
+# source code package.
+
+"""Filter of the cAdvisor metrics the node collector propagates, by metric
+name.
+
+The filter is configured by command line flags, or by a file, e.g. mounted
+from a ConfigMap, which takes precedence while it exists. The file is read
+again whenever it changes, so that the filter can be changed without
+restarting the node collector."""
+
+import fnmatch
+import functools
+import logging
+import os
+from collections import Counter
+from typing import Dict, Optional, Sequence, Tuple
+
+import pydantic
+
+from checkmk_kube_agent.type_defs import MetricFilterConfig
+
+LOGGER = logging.getLogger(__name__)
+
+
+class MetricFilter:  # pylint: disable=too-few-public-methods
+    """Keep the metrics whose names match one of the `allow` patterns, or all
+    metrics if there are none, unless they match one of the `deny` patterns.
+    Patterns are shell-style globs.
+
+        >>> metric_filter = MetricFilter(deny=["container_spec_*"])
+        >>> metric_filter.keep("container_spec_cpu_shares")
+        False
+        >>> metric_filter.keep("container_memory_cache")
+        True
+
+    The lines dropped so far are counted per metric name.
+
+        >>> metric_filter.dropped
+        Counter({'container_spec_cpu_shares': 1})
+    """
+
+    def __init__(self, allow: Sequence[str] = (), deny: Sequence[str] = ()) -> None:
+        self.allow = tuple(allow)
+        self.deny = tuple(deny)
+        self.dropped: Counter[str] = Counter()
+        self._kept: Dict[str, bool] = {}
+
+    def keep(self, metric_name: str) -> bool:
+        """Whether to keep a line of the metric `metric_name`."""
+        try:
+            kept = self._kept[metric_name]
+        except KeyError:
+            # There are only a few dozen metric names, so each is only
+            # matched once
+            kept = self._kept[metric_name] = self._matches(metric_name)
+        if not kept:
+            self.dropped[metric_name] += 1
+        return kept
+
+    def _matches(self, metric_name: str) -> bool:
+        return (
+            not self.allow
+            or any(fnmatch.fnmatchcase(metric_name, pattern) for pattern in self.allow)
+        ) and not any(
+            fnmatch.fnmatchcase(metric_name, pattern) for pattern in self.deny
+        )
+
+
+@functools.lru_cache(maxsize=1)
+def _configured_metric_filter(
+    allow: Tuple[str, ...], deny: Tuple[str, ...]
+) -> MetricFilter:
+    return MetricFilter(allow, deny)
+
+
+@functools.lru_cache(maxsize=1)
+def _read_metric_filter(
+    path: str, modified: int  # pylint: disable=unused-argument
+) -> MetricFilter:
+    """Read the metric filter file, as of its modification time `modified`,
+    which is part of the key of the cache."""
+    LOGGER.info("Reading metric filter from %s", path)
+    with open(path, "rb") as metric_filter_file:
+        config = MetricFilterConfig.model_validate_json(metric_filter_file.read())
+    return MetricFilter(config.allow, config.deny)
+
+
+def load_metric_filter(
+    allow: Sequence[str], deny: Sequence[str], path: Optional[str] = None
+) -> MetricFilter:
+    """The metric filter configured in the file at `path`, if it exists, or
+    else by the `allow` and `deny` patterns.
+
+    The filter is only created again once its configuration changed, so that
+    its counters of dropped lines carry over. An invalid file is logged and
+    ignored."""
+    if path is not None:
+        try:
+            modified = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            pass
+        else:
+            try:
+                return _read_metric_filter(path, modified)
+            except (OSError, pydantic.ValidationError):
+                LOGGER.exception("Ignoring invalid metric filter file %s", path)
+    return _configured_metric_filter(tuple(allow), tuple(deny))
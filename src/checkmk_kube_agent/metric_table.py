@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright (C) 2021 Checkmk GmbH - License: GNU General Public License v2
+# This file is part of Checkmk (https://checkmk.com). It is subject to the
+# terms and conditions defined in the file COPYING, which is part of this
+# source code package.
+
+"""Dictionary encoding of container metrics for the v2 upload format.
+
+In a MetricCollection, every metric repeats the labels of its container and
+its metric name. A ContainerMetricTable lists the labels of each container
+and each metric name once, and the metrics reference them by index."""
+
+from typing import Dict, Iterable, List, Sequence, Tuple
+
+from checkmk_kube_agent.type_defs import (
+    ContainerLabels,
+    ContainerMetric,
+    ContainerMetricRow,
+    ContainerMetricTable,
+    MetricName,
+    Timestamp,
+)
+
+
+def encode_metric_table(
+    container_metrics: Iterable[ContainerMetric], timestamp: Timestamp
+) -> ContainerMetricTable:
+    """Dictionary encode container metrics. The timestamp of a metric is only
+    kept if it differs from `timestamp`.
+
+    >>> encode_metric_table([
+    ...     ContainerMetric(container_name="c", namespace="n", pod_uid="u",
+    ...         pod_name="p", metric_name="m", metric_value_string="1",
+    ...         timestamp=1.0),
+    ...     ContainerMetric(container_name="c", namespace="n", pod_uid="u",
+    ...         pod_name="p", metric_name="k", metric_value_string="2",
+    ...         timestamp=0.5),
+    ... ], Timestamp(1.0))  # doctest: +NORMALIZE_WHITESPACE
+    ContainerMetricTable(containers=[ContainerLabels(container_name='c',
+    namespace='n', pod_uid='u', pod_name='p')], metric_names=['m', 'k'],
+    rows=[(0, 0, '1', None), (0, 1, '2', 0.5)], timestamp=1.0)
+    """
+    container_indices: Dict[Tuple[str, str, str, str], int] = {}
+    containers: List[ContainerLabels] = []
+    metric_names: Dict[MetricName, int] = {}
+    rows: List[ContainerMetricRow] = []
+    for metric in container_metrics:
+        labels = (
+            metric.container_name,
+            metric.namespace,
+            metric.pod_uid,
+            metric.pod_name,
+        )
+        if (container := container_indices.get(labels)) is None:
+            container = container_indices[labels] = len(containers)
+            containers.append(
+                ContainerLabels(
+                    container_name=metric.container_name,
+                    namespace=metric.namespace,
+                    pod_uid=metric.pod_uid,
+                    pod_name=metric.pod_name,
+                )
+            )
+        rows.append(
+            (
+                container,
+                metric_names.setdefault(metric.metric_name, len(metric_names)),
+                metric.metric_value_string,
+                None if metric.timestamp == timestamp else metric.timestamp,
+            )
+        )
+    return ContainerMetricTable(
+        containers=containers,
+        metric_names=list(metric_names),
+        rows=rows,
+        timestamp=timestamp,
+    )
+
+
+def decode_metric_table(table: ContainerMetricTable) -> Sequence[ContainerMetric]:
+    """Decode a dictionary encoded table of container metrics.
+
+    The label values and metric names of the table are shared by all metrics
+    that reference them, rather than copied.
+
+    >>> table = ContainerMetricTable(
+    ...     containers=[ContainerLabels(container_name="c", namespace="n",
+    ...         pod_uid="u", pod_name="p")],
+    ...     metric_names=["m", "k"],
+    ...     rows=[(0, 0, "1", None), (0, 1, "2", 0.5)],
+    ...     timestamp=1.0,
+    ... )
+    >>> first, second = decode_metric_table(table)
+    >>> first  # doctest: +NORMALIZE_WHITESPACE
+    ContainerMetric(container_name='c', namespace='n', pod_uid='u',
+    pod_name='p', metric_name='m', metric_value_string='1', timestamp=1.0)
+    >>> second.timestamp
+    0.5
+    >>> first.pod_uid is second.pod_uid
+    True
+    """
+    metrics = []
+    for container_index, metric_name_index, value, timestamp in table.rows:
+        container = table.containers[container_index]
+        metrics.append(
+            ContainerMetric(
+                container_name=container.container_name,
+                namespace=container.namespace,
+                pod_uid=container.pod_uid,
+                pod_name=container.pod_name,
+                metric_name=table.metric_names[metric_name_index],
+                metric_value_string=value,
+                timestamp=table.timestamp if timestamp is None else timestamp,
+            )
+        )
+    return metrics
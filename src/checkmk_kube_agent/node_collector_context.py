@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright (C) 2021 Checkmk GmbH - License: GNU General Public License v2
+# This file is part of Checkmk (https://checkmk.com). It is subject to the
+# terms and conditions defined in the file COPYING, which is part of this
+# source code package.
+
+"""What a node collector needs in each cycle, but which rarely changes
+between cycles: its token, its metadata and the version of cAdvisor. These
+are cached across cycles, and only looked up again once they may have
+changed."""
+
+import functools
+import logging
+import os
+import time
+from typing import Callable, Dict, Optional, Tuple
+
+from checkmk_kube_agent.common import collector_metadata
+from checkmk_kube_agent.container_metadata import (
+    METADATA_DIGEST_HEADER,
+    metadata_digest,
+    parse_node_collector_metadata,
+)
+from checkmk_kube_agent.type_defs import (
+    CollectorMetadata,
+    CollectorType,
+    Components,
+    NodeCollectorMetadata,
+    UploadResponse,
+    Version,
+)
+
+LOGGER = logging.getLogger(__name__)
+
+TOKEN_PATH = "/var/run/secrets/kubernetes.io/serviceaccount/token"
+
+
+class NodeCollectorContext:
+    """Cache of the invariants of the cycles of a node collector.
+
+    The token of the service account is read again whenever its file was
+    modified, as Kubernetes rotates it. The collector metadata, i.e. the
+    platform of the container, is read once, and the node collector metadata
+    is only rebuilt if its components change. The version of cAdvisor is
+    queried again at most every `cadvisor_version_interval` seconds.
+
+    Uploads reference the node collector metadata by its digest. Once the
+    cluster collector acknowledged the digest, the metadata itself is omitted
+    from uploads, until it changes or the cluster collector requests it."""
+
+    def __init__(
+        self,
+        *,
+        token_path: str = TOKEN_PATH,
+        read_collector_metadata: Callable[[], CollectorMetadata] = collector_metadata,
+        cadvisor_version_interval: float = 600.0,
+    ) -> None:
+        self._token_path = token_path
+        self._read_collector_metadata = functools.lru_cache(maxsize=1)(
+            read_collector_metadata
+        )
+        self._cadvisor_version_interval = cadvisor_version_interval
+        self._token: Optional[Tuple[int, str]] = None
+        self._metadata: Optional[Tuple[NodeCollectorMetadata, str]] = None
+        self._acknowledged_digest: Optional[str] = None
+        self._cadvisor_version: Optional[Tuple[float, Version]] = None
+
+    def token(self) -> str:
+        """The token of the service account, as of the last modification of
+        its file."""
+        modified = os.stat(self._token_path).st_mtime_ns
+        if self._token is None or self._token[0] != modified:
+            LOGGER.info("Reading token from %s", self._token_path)
+            with open(self._token_path, "r", encoding="utf-8") as token_file:
+                self._token = (modified, token_file.read())
+        return self._token[1]
+
+    def headers(self) -> Dict[str, str]:
+        """Headers authenticating requests to the cluster collector, with the
+        digest of the node collector metadata, once it was built."""
+        headers = {"Authorization": f"Bearer {self.token()}"}
+        if self._metadata is not None:
+            headers[METADATA_DIGEST_HEADER] = self._metadata[1]
+        return headers
+
+    def metadata(
+        self, collector_type: CollectorType, components: Components
+    ) -> NodeCollectorMetadata:
+        """Node collector metadata of the given type and components."""
+        if (
+            self._metadata is None
+            or self._metadata[0].collector_type != collector_type
+            or self._metadata[0].components != components
+        ):
+            metadata = parse_node_collector_metadata(
+                collector_metadata=self._read_collector_metadata(),
+                collector_type=collector_type,
+                components=components,
+            )
+            self._metadata = (metadata, metadata_digest(metadata))
+        return self._metadata[0]
+
+    def metadata_known(self) -> bool:
+        """Whether the cluster collector acknowledged the digest of the
+        current node collector metadata, so that it can be omitted."""
+        return (
+            self._metadata is not None
+            and self._acknowledged_digest == self._metadata[1]
+        )
+
+    def acknowledge_metadata(self, response: UploadResponse) -> None:
+        """Track the digest of the metadata the cluster collector knows, as of
+        its response to an upload."""
+        if response.metadata_required:
+            self._acknowledged_digest = None
+        elif response.metadata_digest is not None:
+            self._acknowledged_digest = response.metadata_digest
+
+    def cadvisor_version(self, query: Callable[[], Version]) -> Version:
+        """The version of cAdvisor, as returned by `query` when it was last
+        called."""
+        now = time.monotonic()
+        if (
+            self._cadvisor_version is None
+            or now - self._cadvisor_version[0] >= self._cadvisor_version_interval
+        ):
+            self._cadvisor_version = (now, query())
+        return self._cadvisor_version[1]
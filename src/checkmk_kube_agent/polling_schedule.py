@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright (C) 2021 Checkmk GmbH - License: GNU General Public License v2
+# This file is part of Checkmk (https://checkmk.com). It is subject to the
+# terms and conditions defined in the file COPYING, which is part of this
+# source code package.
+
+"""Schedule the polling cycles of a node collector.
+
+Cycles start on a grid of the monotonic clock, so that they neither drift
+nor are affected by changes of the wall clock. The grid is aligned to the
+epoch when the node collector starts, so that the phases of all node
+collectors refer to the same intervals. Each node collector starts its
+cycles at its own phase of the interval, so that they do not upload in
+lockstep."""
+
+import hashlib
+import math
+from typing import NamedTuple
+
+
+class Cycle(NamedTuple):
+    """Start of the next cycle on the monotonic clock, and the number of
+    cycles skipped because the previous one overran."""
+
+    start: float
+    skipped: int
+
+
+def node_phase(node_name: str) -> float:
+    """Deterministic phase of a node within the polling interval, in [0, 1).
+
+    >>> node_phase("worker-1") == node_phase("worker-1")
+    True
+    >>> 0 <= node_phase("worker-2") < 1
+    True
+    """
+    digest = hashlib.blake2b(node_name.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big") / 2**64
+
+
+class PollingSchedule:  # pylint: disable=too-few-public-methods
+    """Grid of cycle starts every `interval` seconds at the given `phase` of
+    the interval.
+
+    `now` and `wall_time` are the current times of the monotonic and the
+    wall clock, which align the grid to the epoch.
+
+        >>> schedule = PollingSchedule(60, 0.5, now=1000.0, wall_time=6010.0)
+        >>> schedule.next_cycle(after=1000.0, now=1000.0)
+        Cycle(start=1020.0, skipped=0)
+
+    Cycles that are due while a cycle overruns are skipped, instead of being
+    run back to back.
+
+        >>> schedule.next_cycle(after=1020.0, now=1210.0)
+        Cycle(start=1260.0, skipped=3)
+    """
+
+    def __init__(
+        self, interval: float, phase: float, *, now: float, wall_time: float
+    ) -> None:
+        if interval <= 0:
+            raise ValueError(f"interval must be positive, got {interval}")
+
+        self.interval = interval
+        self.phase = phase
+        self._origin = now - wall_time % interval
+
+    def next_cycle(self, *, after: float, now: float) -> Cycle:
+        """The first cycle on the grid which starts after the cycle that
+        started at `after`, and is not due already at `now`."""
+        offset = self._origin + self.phase * self.interval
+        start = offset + (math.floor((after - offset) / self.interval) + 1) * (
+            self.interval
+        )
+        if start >= now:
+            return Cycle(start, 0)
+        skipped = math.ceil((now - start) / self.interval)
+        return Cycle(start + skipped * self.interval, skipped)
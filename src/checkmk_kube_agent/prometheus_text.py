@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright (C) 2021 Checkmk GmbH - License: GNU General Public License v2
+# This file is part of Checkmk (https://checkmk.com). It is subject to the
+# terms and conditions defined in the file COPYING, which is part of this
+# source code package.
+
+"""Tokenizer of the text exposition format of Prometheus, as served by
+cAdvisor, and the scanning of large responses in a pool of workers.
+
+This module only depends on the standard library, so that it can be
+imported by subinterpreters, which cannot import extension modules that do
+not support them, such as the one of pydantic."""
+
+import functools
+import json
+from collections import deque
+from concurrent.futures import Executor, Future, InterpreterPoolExecutor
+from typing import (
+    AbstractSet,
+    Callable,
+    Deque,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+    TypeVar,
+)
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+# The labels of cAdvisor metrics which identify a container. All other labels
+# are skipped when parsing.
+CONTAINER_LABELS = frozenset(
+    {
+        "name",
+        "container_label_io_kubernetes_pod_name",
+        "container_label_io_kubernetes_pod_namespace",
+        "container_label_io_kubernetes_pod_uid",
+    }
+)
+
+
+def _escaped(line: str, position: int) -> bool:
+    """Whether the character at `position` is escaped, i.e. preceded by an
+    odd number of backslashes.
+
+    >>> _escaped('"a\\\\"', 3), _escaped('"a\\\\\\\\"', 4)
+    (True, False)
+    """
+    escape = position
+    while line[escape - 1] == "\\":
+        escape -= 1
+    return (position - escape) % 2 == 1
+
+
+def scan_labels(
+    line: str, start: int, names: Optional[AbstractSet[str]] = None
+) -> Tuple[Dict[str, str], int]:
+    """Scan the comma separated labels starting at `start`, right after the
+    opening brace, and return them together with the position after the
+    closing brace.
+
+    Label values may contain any character, including commas, braces, equal
+    signs and escaped double quotes.
+
+    >>> scan_labels('{a="[1,2]",b="}",c="x\\\\"y"} 42', 1)
+    ({'a': '[1,2]', 'b': '}', 'c': 'x"y'}, 26)
+
+    If `names` are given, all other labels are skipped without extracting
+    their values.
+
+    >>> scan_labels('{a="[1,2]",b="}",c="x\\\\"y"} 42', 1, {"b"})
+    ({'b': '}'}, 26)
+
+    Further examples:
+
+    >>> scan_labels("{}", 1)
+    ({}, 2)
+
+    >>> scan_labels('{mylabel="myval"}', 1)[0]
+    {'mylabel': 'myval'}
+
+    >>> scan_labels('{mylabel1="myval1",mylabel2="myval2"}', 1)[0]
+    {'mylabel1': 'myval1', 'mylabel2': 'myval2'}
+
+    >>> scan_labels('{mylabel="myval",}', 1)[0]
+    {'mylabel': 'myval'}
+
+    >>> scan_labels('{,mylabel="myval"}', 1)[0]
+    {'mylabel': 'myval'}
+
+    >>> scan_labels('{mylabel="[val1,val2,val3]"}', 1)[0]
+    {'mylabel': '[val1,val2,val3]'}
+
+    >>> scan_labels('{mylabel1="[val1,val2,val3]",mylabel2="[val1,val2,val3]"}', 1)[0]
+    {'mylabel1': '[val1,val2,val3]', 'mylabel2': '[val1,val2,val3]'}
+
+    >>> scan_labels('{mylabel="[\\\\"val1\\\\",\\\\"val2\\\\",\\\\"val3\\\\"]"}', 1)[0]
+    {'mylabel': '["val1","val2","val3"]'}
+
+    >>> scan_labels('{mylabel1="[\\\\"val1\\\\",\\\\"val2\\\\",\\\\"val3\\\\"]",'
+    ... 'mylabel2="[\\\\"val1\\\\",\\\\"val2\\\\",\\\\"val3\\\\"]"}', 1)[0]
+    ... # doctest: +NORMALIZE_WHITESPACE
+    {'mylabel1': '["val1","val2","val3"]',
+     'mylabel2': '["val1","val2","val3"]'}
+    """
+    labels: Dict[str, str] = {}
+    position = start
+    while True:
+        char = line[position]
+        if char == "}":
+            return labels, position + 1
+        if char == ",":
+            position += 1
+            continue
+        equals = line.index('="', position)
+        end = line.index('"', equals + 2)
+        while line[end - 1] == "\\" and _escaped(line, end):
+            end = line.index('"', end + 1)
+        name = line[position:equals]
+        if names is None or name in names:
+            value = line[equals + 2 : end]
+            if "\\" in value:
+                # Escape sequences are rare, and a subset of those of JSON
+                value = json.loads(line[equals + 1 : end + 1])
+            labels[name] = value
+        position = end + 1
+
+
+class ScannedBatch(NamedTuple):
+    """The lines of a batch which carry labels: the distinct sets of their
+    container labels, and per line its metric name, the index of its label
+    set, its value and its timestamp, if any."""
+
+    label_sets: List[Dict[str, str]]
+    lines: List[Tuple[str, int, str, Optional[str]]]
+
+
+def scan_batch(batch: bytes) -> ScannedBatch:
+    """Scan the lines of a batch, without converting them any further. Each
+    label set is only scanned the first time it occurs in the batch.
+
+    >>> scan_batch(b'# HELP m\\nm{id="/",name="c"} 1 2\\n'
+    ... b'n{id="/",name="c"} 3\\nmachine_memory_bytes 4\\n')
+    ScannedBatch(label_sets=[{'name': 'c'}], lines=[('m', 0, '1', '2'), ('n', 0, '3', None)])
+    """
+    label_sets: List[Dict[str, str]] = []
+    indices: Dict[str, int] = {}
+    lines: List[Tuple[str, int, str, Optional[str]]] = []
+    for line in batch.decode("utf-8").split("\n"):
+        if line.startswith("#") or "{" not in line:
+            continue
+        brace = line.index("{")
+        # The value and timestamp following the labels contain no braces
+        end = line.rindex("}")
+        raw_labels = line[brace + 1 : end]
+        if (index := indices.get(raw_labels)) is None:
+            index = indices[raw_labels] = len(label_sets)
+            label_sets.append(scan_labels(line, brace + 1, CONTAINER_LABELS)[0])
+        value_string, *optional_timestamp = line[end + 1 :].split()
+        lines.append(
+            (
+                line[:brace],
+                index,
+                value_string,
+                optional_timestamp[0] if optional_timestamp else None,
+            )
+        )
+    return ScannedBatch(label_sets, lines)
+
+
+def iter_batches(chunks: Iterable[bytes], size: int) -> Iterator[bytes]:
+    """Batches of whole lines of a stream of chunks, each as soon as at
+    least `size` bytes are received.
+
+    >>> list(iter_batches([b"a\\nb", b"c\\nd\\ne"], 2))
+    [b'a', b'bc\\nd', b'e']
+
+    >>> list(iter_batches([b"a\\n"], 1))
+    [b'a']
+    """
+    pending = bytearray()
+    for chunk in chunks:
+        pending += chunk
+        if len(pending) >= size and (end := pending.rfind(b"\n")) >= 0:
+            yield bytes(pending[:end])
+            del pending[: end + 1]
+    if pending:
+        yield bytes(pending)
+
+
+def map_in_order(
+    executor: Executor,
+    function: Callable[[T], R],
+    arguments: Iterable[T],
+    *,
+    max_pending: int,
+) -> Iterator[R]:
+    """Results of the calls of `function` with each of the `arguments` by
+    the `executor`, in order. Unlike `Executor.map`, at most `max_pending`
+    calls are submitted ahead of the results consumed, so that the
+    arguments are consumed as they are needed.
+
+    >>> from concurrent.futures import ThreadPoolExecutor
+    >>> with ThreadPoolExecutor(2) as executor:
+    ...     list(map_in_order(executor, abs, [-1, 2, -3], max_pending=2))
+    [1, 2, 3]
+    """
+    pending: "Deque[Future[R]]" = deque()
+    try:
+        for argument in arguments:
+            pending.append(executor.submit(function, argument))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+class ParsingPool(NamedTuple):
+    """Pool of `workers`, which scan the responses of cAdvisor of at least
+    `threshold` bytes in batches of about `batch_size` bytes."""
+
+    executor: Executor
+    workers: int
+    threshold: int
+    batch_size: int = 1024 * 1024
+
+    def scan(self, batches: Iterable[bytes]) -> Iterator[ScannedBatch]:
+        """Scan the batches in the pool, in order."""
+        return map_in_order(
+            self.executor, scan_batch, batches, max_pending=2 * self.workers
+        )
+
+
+@functools.lru_cache(maxsize=1)
+def parsing_pool(workers: int, threshold: int) -> ParsingPool:
+    """The pool of the node collector, which is started once and then kept
+    for all cycles. Its workers are interpreters, which run in parallel
+    within the process of the node collector."""
+    return ParsingPool(InterpreterPoolExecutor(max_workers=workers), workers, threshold)
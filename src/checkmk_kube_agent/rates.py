@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright (C) 2021 Checkmk GmbH - License: GNU General Public License v2
+# This file is part of Checkmk (https://checkmk.com). It is subject to the
+# terms and conditions defined in the file COPYING, which is part of this
+# source code package.
+
+"""Per-second rates of cumulative container counters."""
+
+import math
+from collections import Counter
+from collections.abc import Hashable
+from typing import Callable, FrozenSet, Iterable, Optional, TypeVar
+
+from checkmk_kube_agent.type_defs import ContainerMetric, ContainerMetricRate
+
+SeriesKey = TypeVar("SeriesKey", bound=Hashable)
+
+
+def is_counter(metric: ContainerMetric) -> bool:
+    """Whether the metric is a cumulative counter.
+
+    cAdvisor follows the Prometheus naming convention, where counters are
+    suffixed with `_total`.
+
+    >>> is_counter(ContainerMetric(container_name="c", namespace="n",
+    ... pod_uid="u", pod_name="p", metric_name="container_cpu_usage_seconds_total",
+    ... metric_value_string="1", timestamp=0.0))
+    True
+
+    >>> is_counter(ContainerMetric(container_name="c", namespace="n",
+    ... pod_uid="u", pod_name="p", metric_name="container_memory_usage_bytes",
+    ... metric_value_string="1", timestamp=0.0))
+    False
+    """
+    return metric.metric_name.endswith("_total")
+
+
+def repeated_series(
+    container_metrics: Iterable[ContainerMetric],
+    key: Callable[[ContainerMetric], SeriesKey],
+) -> FrozenSet[SeriesKey]:
+    """Keys of the metrics which occur more than once per container.
+
+    cAdvisor exports some metrics as several series per container, which only
+    differ in labels the node collector does not keep, e.g.
+    `container_memory_failures_total` by `failure_type` and `scope`. Their
+    samples cannot be told apart, so no rates are computed for them.
+
+    >>> def sample(metric_name):
+    ...     return ContainerMetric(container_name="c", namespace="n", pod_uid="u",
+    ...     pod_name="p", metric_name=metric_name, metric_value_string="1",
+    ...     timestamp=0.0)
+
+    >>> repeated_series(
+    ...     [sample("container_memory_failures_total"),
+    ...      sample("container_memory_failures_total"),
+    ...      sample("container_cpu_usage_seconds_total")],
+    ...     lambda metric: metric.metric_name,
+    ... )
+    frozenset({'container_memory_failures_total'})
+    """
+    occurrences = Counter(map(key, container_metrics))
+    return frozenset(
+        series_key for series_key, count in occurrences.items() if count > 1
+    )
+
+
+def _parse_value(metric_value_string: str) -> Optional[float]:
+    """
+    >>> _parse_value("1.6595398656e+10")
+    16595398656.0
+
+    >>> _parse_value("NaN") is None
+    True
+
+    >>> _parse_value("garbage") is None
+    True
+    """
+    try:
+        value = float(metric_value_string)
+    except ValueError:
+        return None
+    return value if math.isfinite(value) else None
+
+
+def counter_rate(
+    previous: ContainerMetric, current: ContainerMetric
+) -> Optional[ContainerMetricRate]:
+    """Per-second rate between two consecutive samples of the same counter.
+
+    If the counter decreased, it is assumed to have been reset (e.g. because
+    the process inside the container restarted) and to have started counting
+    from zero, which is the same assumption Prometheus makes.
+
+    No rate is computed for non-counter metrics, unparsable values or samples
+    that are not strictly newer than the previous one.
+
+    >>> def sample(value, timestamp):
+    ...     return ContainerMetric(container_name="c", namespace="n", pod_uid="u",
+    ...     pod_name="p", metric_name="container_cpu_usage_seconds_total",
+    ...     metric_value_string=value, timestamp=timestamp)
+
+    >>> counter_rate(sample("10", 0.0), sample("40", 60.0))
+    ... # doctest: +NORMALIZE_WHITESPACE
+    ContainerMetricRate(container_name='c', namespace='n', pod_uid='u',
+                        pod_name='p', metric_name='container_cpu_usage_seconds_total',
+                        rate=0.5, timestamp=60.0, counter_reset=False)
+
+    >>> counter_rate(sample("40", 0.0), sample("6", 60.0)).rate
+    0.1
+
+    >>> counter_rate(sample("10", 60.0), sample("40", 60.0)) is None
+    True
+
+    >>> counter_rate(sample("NaN", 0.0), sample("40", 60.0)) is None
+    True
+
+    >>> gauge = sample("40", 60.0).model_copy(
+    ...     update={"metric_name": "container_memory_cache"})
+    >>> counter_rate(sample("10", 0.0), gauge) is None
+    True
+    """
+    if not is_counter(current):
+        return None
+
+    elapsed = current.timestamp - previous.timestamp
+    if elapsed <= 0:
+        return None
+
+    previous_value = _parse_value(previous.metric_value_string)
+    current_value = _parse_value(current.metric_value_string)
+    if previous_value is None or current_value is None:
+        return None
+
+    counter_reset = current_value < previous_value
+    increase = current_value if counter_reset else current_value - previous_value
+
+    return ContainerMetricRate(
+        container_name=current.container_name,
+        namespace=current.namespace,
+        pod_uid=current.pod_uid,
+        pod_name=current.pod_name,
+        metric_name=current.metric_name,
+        rate=increase / elapsed,
+        timestamp=current.timestamp,
+        counter_reset=counter_reset,
+    )
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright (C) 2021 Checkmk GmbH - License: GNU General Public License v2
+# This file is part of Checkmk (https://checkmk.com). It is subject to the
+# terms and conditions defined in the file COPYING, which is part of this
+# source code package.
+
+"""ASGI middleware decoding compressed request bodies."""
+
+from typing import Optional
+
+from fastapi import HTTPException, status
+from starlette.datastructures import Headers
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from checkmk_kube_agent.content_encoding import (
+    ZSTD_DICTIONARY_HEADER,
+    SizeLimitExceeded,
+    decompress_bounded,
+)
+from checkmk_kube_agent.type_defs import ContentEncoding
+
+
+class RequestDecompressionMiddleware:  # pylint: disable=too-few-public-methods
+    """Decode request bodies according to their Content-Encoding header.
+
+    The body is decompressed lazily, i.e. only once the endpoint reads it.
+    Requests that are rejected before, e.g. because they are not
+    authenticated, do not cost any decompression.
+
+    The decompressed size is limited by `max_request_body_size` in the state
+    of the application, to protect against decompression bombs. Exceeding it
+    is answered with `413 Content Too Large`."""
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        headers = Headers(scope=scope)
+        content_encoding = headers.get("content-encoding", "identity").lower()
+        if content_encoding == ContentEncoding.IDENTITY.value:
+            await self.app(scope, receive, send)
+            return
+
+        decoded_scope = dict(scope)
+        decoded_scope["headers"] = [
+            (name, value)
+            for name, value in scope["headers"]
+            if name not in (b"content-encoding", b"content-length")
+        ]
+        await self.app(
+            decoded_scope,
+            _DecompressingReceive(
+                receive,
+                content_encoding=content_encoding,
+                zstd_dictionary=headers.get(ZSTD_DICTIONARY_HEADER),
+                max_size=scope["app"].state.max_request_body_size,
+            ),
+            send,
+        )
+
+
+class _DecompressingReceive:  # pylint: disable=too-few-public-methods
+    def __init__(
+        self,
+        receive: Receive,
+        *,
+        content_encoding: str,
+        zstd_dictionary: Optional[str],
+        max_size: int,
+    ) -> None:
+        self._receive = receive
+        self._content_encoding = content_encoding
+        self._zstd_dictionary = zstd_dictionary
+        self._max_size = max_size
+        self._body_received = False
+
+    async def __call__(self) -> Message:
+        if self._body_received:
+            return await self._receive()
+
+        try:
+            encoding = ContentEncoding(self._content_encoding)
+        except ValueError as exception:
+            raise HTTPException(
+                status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+                detail=f"Unsupported Content-Encoding: {self._content_encoding}",
+            ) from exception
+
+        chunks = []
+        size = 0
+        more_body = True
+        while more_body:
+            message = await self._receive()
+            if message["type"] != "http.request":
+                return message
+            chunks.append(message.get("body", b""))
+            size += len(chunks[-1])
+            if size > self._max_size:
+                raise _content_too_large(self._max_size)
+            more_body = message.get("more_body", False)
+        self._body_received = True
+
+        try:
+            body = decompress_bounded(
+                b"".join(chunks),
+                encoding,
+                max_size=self._max_size,
+                zstd_dictionary=self._zstd_dictionary,
+            )
+        except SizeLimitExceeded as exception:
+            raise _content_too_large(self._max_size) from exception
+        except ValueError as exception:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Malformed request body: {exception}",
+            ) from exception
+
+        return {"type": "http.request", "body": body, "more_body": False}
+
+
+def _content_too_large(max_size: int) -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_413_CONTENT_TOO_LARGE,
+        detail=f"Decompressed request body exceeds {max_size} bytes",
+    )
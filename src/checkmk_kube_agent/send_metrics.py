@@ -7,48 +7,65 @@
 """Node collector metric collection."""
 
 import argparse
+import itertools
 import json
 import logging
 import os
-import re
 import signal
 import subprocess  # nosec
 import sys
 import time
+from collections import OrderedDict
 from functools import partial
 from threading import Event
 from typing import (
     Callable,
     Dict,
     Iterable,
+    Iterator,
+    List,
     Literal,
     Mapping,
+    NamedTuple,
     NewType,
     Optional,
     Sequence,
+    Set,
     Union,
+    cast,
 )
 
 import requests
 import urllib3
+from pydantic import BaseModel
 from requests import Session
 
-from checkmk_kube_agent.common import (
-    collector_argument_parser,
-    collector_metadata,
-    tcp_session,
+from checkmk_kube_agent.common import collector_argument_parser, tcp_session
+from checkmk_kube_agent.content_encoding import (
+    METRIC_NAMES_DICTIONARY,
+    supported_encodings,
+)
+from checkmk_kube_agent.metric_delta import DeltaEncoder
+from checkmk_kube_agent.metric_filter import MetricFilter, load_metric_filter
+from checkmk_kube_agent.node_collector_context import NodeCollectorContext
+from checkmk_kube_agent.polling_schedule import PollingSchedule, node_phase
+from checkmk_kube_agent.prometheus_text import (
+    CONTAINER_LABELS,
+    ParsingPool,
+    iter_batches,
+    parsing_pool,
+    scan_labels,
 )
-from checkmk_kube_agent.container_metadata import parse_node_collector_metadata
 from checkmk_kube_agent.type_defs import (
     CollectorType,
     Components,
     ContainerMetric,
     ContainerName,
+    ContentEncoding,
     LabelName,
     LabelValue,
     MachineSections,
     MachineSectionsCollection,
-    MetricCollection,
     MetricName,
     MetricValueString,
     Namespace,
@@ -58,66 +75,28 @@ from checkmk_kube_agent.type_defs import (
     Timestamp,
     Version,
 )
+from checkmk_kube_agent.upload_requests import (
+    container_metrics_upload,
+    encode_request_body,
+    encode_request_body_stream,
+    iter_metric_collection_json,
+    overload_delay,
+    parse_upload_response,
+    upload_container_metric_delta,
+    upload_with_metadata,
+)
 
 # urllib warnings clutter logs
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 Url = NewType("Url", str)
-RequestHeaders = Mapping[str, str]
 CaCertPath = NewType("CaCertPath", str)
 SslVerify = Union[bool, CaCertPath]
 
 
 logger = logging.getLogger(__name__)
 
-
-def _split_labels(raw_labels: str) -> Iterable[str]:
-    """Split comma separated Kubernetes labels text into individual labels
-
-    >>> list(_split_labels(""))
-    []
-
-    >>> list(_split_labels('mylabel="myval"'))
-    ['mylabel="myval"']
-
-    >>> list(_split_labels('mylabel1="myval1",mylabel2="myval2"'))
-    ['mylabel1="myval1"', 'mylabel2="myval2"']
-
-    >>> list(_split_labels('mylabel="myval",'))
-    ['mylabel="myval"']
-
-    >>> list(_split_labels(',mylabel="myval"'))
-    ['mylabel="myval"']
-
-    >>> list(_split_labels('mylabel="[val1,val2,val3]"'))
-    ['mylabel="[val1,val2,val3]"']
-
-    >>> list(_split_labels('mylabel1="[val1,val2,val3]",mylabel2="[val1,val2,val3]"'))
-    ['mylabel1="[val1,val2,val3]"', 'mylabel2="[val1,val2,val3]"']
-
-    >>> list(_split_labels('mylabel="[\\\\"val1\\\\",\\\\"val2\\\\",\\\\"val3\\\\"]"'))
-    ['mylabel="[\\\\"val1\\\\",\\\\"val2\\\\",\\\\"val3\\\\"]"']
-
-    >>> list(_split_labels('mylabel1="[\\\\"val1\\\\",\\\\"val2\\\\",\\\\"val3\\\\"]",'
-    ... 'mylabel2="[\\\\"val1\\\\",\\\\"val2\\\\",\\\\"val3\\\\"]"'))
-    ... # doctest: +NORMALIZE_WHITESPACE
-    ['mylabel1="[\\\\"val1\\\\",\\\\"val2\\\\",\\\\"val3\\\\"]"',
-     'mylabel2="[\\\\"val1\\\\",\\\\"val2\\\\",\\\\"val3\\\\"]"']
-
-    """
-
-    if not raw_labels:
-        yield from ()
-        return
-
-    # csv.reader would have been a really neat solution; however, unfortunately
-    # only double quotes, and not the separator characters themselves, inside
-    # value strings like this:
-    #     my_val="hello",another_val="you,my\"friend\""
-    # are escaped, rendering it esentially unusable...
-    for label in re.split(r",(?=(?:[^\"]*\"[^\"]*\")*[^\"]*$)", raw_labels):
-        if label:
-            yield label
+CADVISOR_URL = Url("http://localhost:8080")
 
 
 def _parse_labels(raw_labels: str) -> Mapping[LabelName, LabelValue]:
@@ -136,18 +115,128 @@ def _parse_labels(raw_labels: str) -> Mapping[LabelName, LabelValue]:
     >>> _parse_labels("")
     {}
 
+    >>> _parse_labels('mylabel1="[val1,val2,val3]",mylabel2="x=y",')
+    {'mylabel1': '[val1,val2,val3]', 'mylabel2': 'x=y'}
+
+    >>> _parse_labels(',mylabel="[\\\\"val1\\\\",\\\\"val2\\\\"]"')
+    {'mylabel': '["val1","val2"]'}
+
+    """
+    labels, _end = scan_labels(f"{raw_labels}}}", 0)
+    return cast(Dict[LabelName, LabelValue], labels)
+
+
+class _Container(NamedTuple):
+    name: ContainerName
+    namespace: Namespace
+    pod_uid: PodUid
+    pod_name: PodName
+
+
+def _parse_container(line: str, start: int) -> Optional[_Container]:
+    """Container identified by the labels starting at `start`, if any.
+
+    >>> _parse_container('{container_label_io_kubernetes_pod_namespace="ns",'
+    ... 'container_label_io_kubernetes_pod_name="pod",'
+    ... 'container_label_io_kubernetes_pod_uid="123",name="c"}', 1)
+    _Container(name='c', namespace='ns', pod_uid='123', pod_name='pod')
+
+    >>> _parse_container('{id="/",name="c"}', 1) is None
+    True
     """
-    labels: Dict[LabelName, LabelValue] = {}
+    labels, _end = scan_labels(line, start, CONTAINER_LABELS)
+    return _container(labels)
+
+
+def _container(scanned: Mapping[str, str]) -> Optional[_Container]:
+    """Container identified by labels, if any. The label values are interned,
+    as they are shared by many metrics."""
+    labels = {
+        LabelName(name): LabelValue(sys.intern(value))
+        for name, value in scanned.items()
+    }
+    if not (
+        (container_name := labels.get(LabelName("name")))
+        and (pod_uid := labels.get(LabelName("container_label_io_kubernetes_pod_uid")))
+    ):
+        return None
+    return _Container(
+        name=ContainerName(container_name),
+        namespace=Namespace(
+            labels[LabelName("container_label_io_kubernetes_pod_namespace")]
+        ),
+        pod_uid=PodUid(pod_uid),
+        pod_name=PodName(labels[LabelName("container_label_io_kubernetes_pod_name")]),
+    )
 
-    for label in _split_labels(raw_labels):
-        label_name, label_value = label.split("=")
-        labels[LabelName(label_name)] = LabelValue(json.loads(label_value))
 
-    return labels
+class LabelSetCache:
+    """Containers identified by the label sets of cAdvisor metrics.
+
+    The same label set repeats for every metric of a container, and in every
+    response of cAdvisor, so it is only parsed the first time it occurs. The
+    least recently used label set is evicted once there are `maxsize`, and
+    `sweep` evicts the label sets which did not occur since the previous
+    sweep, i.e. those of containers that disappeared.
+
+    Responses list the label sets in the same order every time, which evicts
+    each of them before it occurs again once they do not all fit. Sweeping
+    thus raises the limit to a quarter more than the number of label sets
+    which occurred since the previous sweep, if `maxsize` is too small for
+    them.
+
+        >>> cache = LabelSetCache()
+        >>> line = ('m{container_label_io_kubernetes_pod_name="p",'
+        ... 'container_label_io_kubernetes_pod_namespace="n",'
+        ... 'container_label_io_kubernetes_pod_uid="1",name="c"} 1')
+        >>> cache.container(line, 2, line.rindex("}")).name
+        'c'
+        >>> len(cache), cache.sweep(), len(cache), cache.sweep(), len(cache)
+        (1, None, 1, None, 0)
+    """
+
+    def __init__(self, maxsize: int = 4096) -> None:
+        if maxsize <= 0:
+            raise ValueError(f"maxsize must be at least 1, got {maxsize}")
+
+        self.maxsize = maxsize
+        self._capacity = maxsize
+        self._containers: "OrderedDict[str, Optional[_Container]]" = OrderedDict()
+        self._seen: Set[str] = set()
+
+    def __len__(self) -> int:
+        return len(self._containers)
+
+    def container(self, line: str, start: int, end: int) -> Optional[_Container]:
+        """Container identified by the labels of `line` between `start`,
+        right after the opening brace, and `end`, the closing brace."""
+        raw_labels = line[start:end]
+        self._seen.add(raw_labels)
+        try:
+            container = self._containers[raw_labels]
+        except KeyError:
+            container = _parse_container(line, start)
+            if len(self._containers) >= self._capacity:
+                self._containers.popitem(last=False)
+            self._containers[raw_labels] = container
+            return container
+        self._containers.move_to_end(raw_labels)
+        return container
+
+    def sweep(self) -> None:
+        """Evict the label sets which did not occur since the previous
+        sweep."""
+        for raw_labels in self._containers.keys() - self._seen:
+            del self._containers[raw_labels]
+        self._capacity = max(self.maxsize, len(self._seen) + len(self._seen) // 4)
+        self._seen.clear()
 
 
 def _parse_metrics_with_labels(
-    open_metric: str, now: Timestamp
+    open_metric: str,
+    now: Timestamp,
+    label_sets: Optional[LabelSetCache] = None,
+    metric_filter: Optional[MetricFilter] = None,
 ) -> Optional[ContainerMetric]:
     """Parse an individual container metric and select relevant Kubernetes
     labels.
@@ -158,6 +247,9 @@ def _parse_metrics_with_labels(
     If the metric has a timestamp, it is added; otherwise, the current
     timestamp is used.
 
+    The container is looked up in `label_sets`, if given. Metrics dropped by
+    the `metric_filter` are discarded before their labels are parsed.
+
     >>> _parse_metrics_with_labels(('container_cpu_cfs_periods_total'
     ... '{container_label_io_kubernetes_pod_namespace="mynamespace",'
     ... 'container_label_io_kubernetes_pod_name="mypod",'
@@ -187,41 +279,65 @@ def _parse_metrics_with_labels(
     True
     """
 
-    metric_name, rest = open_metric.split("{", 1)
-    labels_string, timestamped_value = rest.rsplit("}", 1)
-    value_string, *optional_timestamp = timestamped_value.strip().split()
-    labels = _parse_labels(labels_string)
+    brace = open_metric.index("{")
+    metric_name = MetricName(open_metric[:brace])
+    if metric_filter is not None and not metric_filter.keep(metric_name):
+        return None
+    # The value and timestamp following the labels contain no braces
+    end = open_metric.rindex("}")
+    container = (
+        _parse_container(open_metric, brace + 1)
+        if label_sets is None
+        else label_sets.container(open_metric, brace + 1, end)
+    )
+    if container is None:
+        return None
+
+    value_string, *optional_timestamp = open_metric[end + 1 :].split()
+    return _container_metric(
+        container,
+        metric_name,
+        value_string,
+        optional_timestamp[0] if optional_timestamp else None,
+        now,
+    )
 
-    if (container_name := labels.get(LabelName("name"))) and (
-        pod_uid := labels.get(LabelName("container_label_io_kubernetes_pod_uid"))
-    ):
-        return ContainerMetric(
-            container_name=ContainerName(container_name),
-            namespace=Namespace(
-                labels[LabelName("container_label_io_kubernetes_pod_namespace")]
-            ),
-            pod_uid=PodUid(pod_uid),
-            pod_name=PodName(
-                labels[LabelName("container_label_io_kubernetes_pod_name")]
-            ),
-            metric_name=MetricName(metric_name),
-            metric_value_string=MetricValueString(value_string),
-            timestamp=(
-                Timestamp(float(optional_timestamp[0]) / 1000.0)
-                if optional_timestamp
-                else now
-            ),
-        )
 
-    return None
+def _container_metric(
+    container: _Container,
+    metric_name: MetricName,
+    value_string: str,
+    timestamp_ms: Optional[str],
+    now: Timestamp,
+) -> ContainerMetric:
+    return ContainerMetric(
+        container_name=container.name,
+        namespace=container.namespace,
+        pod_uid=container.pod_uid,
+        pod_name=container.pod_name,
+        metric_name=metric_name,
+        metric_value_string=MetricValueString(value_string),
+        timestamp=(
+            now if timestamp_ms is None else Timestamp(float(timestamp_ms) / 1000.0)
+        ),
+    )
 
 
-def parse_raw_response(raw_response: str, now: Timestamp) -> Sequence[ContainerMetric]:
+def parse_raw_response(
+    raw_response: str,
+    now: Timestamp,
+    label_sets: Optional[LabelSetCache] = None,
+    metric_filter: Optional[MetricFilter] = None,
+) -> Sequence[ContainerMetric]:
     """Parse open metric response from cAdvisor into the schema the cluster
     collector API expects.
 
     Only container metrics are propagated, node metrics are discarded.
 
+    The label sets of containers are memoized in `label_sets`, if given, which
+    is swept afterwards. Metrics are filtered by name with `metric_filter`, if
+    given.
+
     >>> parse_raw_response(("# HELP cadvisor_version_info\\n"
     ... "# TYPE container_cpu_cfs_periods_total counter\\n"), 0.0)
     []
@@ -248,9 +364,24 @@ def parse_raw_response(raw_response: str, now: Timestamp) -> Sequence[ContainerM
 
     """
 
-    container_metrics = []
-    for open_metric in raw_response.split("\n"):
-        if "{" not in open_metric:
+    return list(
+        iter_container_metrics(raw_response.split("\n"), now, label_sets, metric_filter)
+    )
+
+
+def iter_container_metrics(
+    lines: Iterable[str],
+    now: Timestamp,
+    label_sets: Optional[LabelSetCache] = None,
+    metric_filter: Optional[MetricFilter] = None,
+) -> Iterator[ContainerMetric]:
+    """Parse the lines of an open metric response from cAdvisor one at a
+    time, as they are received, see `parse_raw_response`.
+
+    `label_sets` is swept once all lines are parsed."""
+    parsed = 0
+    for open_metric in lines:
+        if open_metric.startswith("#") or "{" not in open_metric:
             # This means that the respective line does not contain any
             # Kubernetes labels, which is due to the following reasons:
             # 1. Some lines are comments that can safely be ignored. They
@@ -259,21 +390,133 @@ def parse_raw_response(raw_response: str, now: Timestamp) -> Sequence[ContainerM
             #    include go statistics and machine metrics, which we are not
             #    interested in.
             continue
-        if metric := _parse_metrics_with_labels(open_metric, now):
-            container_metrics.append(metric)
+        if metric := _parse_metrics_with_labels(
+            open_metric, now, label_sets, metric_filter
+        ):
+            parsed += 1
+            yield metric
+
+    if label_sets is not None:
+        label_sets.sweep()
+
+    logger.debug("Parsed %d container metrics", parsed)
+    if metric_filter is not None and metric_filter.dropped:
+        logger.debug(
+            "Lines dropped by metric name so far: %s", dict(metric_filter.dropped)
+        )
 
-    logger.debug("Parsed %d container metrics", len(container_metrics))
-    return container_metrics
 
+def iter_cadvisor_metrics(
+    chunks: Iterable[bytes],
+    now: Timestamp,
+    label_sets: Optional[LabelSetCache] = None,
+    metric_filter: Optional[MetricFilter] = None,
+    *,
+    pool: Optional[ParsingPool] = None,
+) -> Iterator[ContainerMetric]:
+    """Container metrics of a response from cAdvisor, received in chunks.
+    Large responses are parsed in the `pool`, if given.
+
+    >>> list(iter_cadvisor_metrics([
+    ...     b'container_cpu_cfs_periods_total{container_label_io_kubernetes_pod_',
+    ...     b'namespace="ns",container_label_io_kubernetes_pod_name="pod",',
+    ...     b'container_label_io_kubernetes_pod_uid="123",name="c"} 42\\n',
+    ... ], 0.0))
+    ... # doctest: +NORMALIZE_WHITESPACE
+    [ContainerMetric(container_name='c', namespace='ns', pod_uid='123',
+                     pod_name='pod', metric_name='container_cpu_cfs_periods_total',
+                     metric_value_string='42', timestamp=0.0)]
+    """
+    if pool is not None:
+        return iter_container_metrics_parallel(
+            chunks, now, pool, label_sets, metric_filter
+        )
+    return iter_container_metrics(_iter_lines(chunks), now, label_sets, metric_filter)
+
+
+def iter_container_metrics_parallel(
+    chunks: Iterable[bytes],
+    now: Timestamp,
+    pool: ParsingPool,
+    label_sets: Optional[LabelSetCache] = None,
+    metric_filter: Optional[MetricFilter] = None,
+) -> Iterator[ContainerMetric]:
+    """Parse a response from cAdvisor in the text exposition format like
+    `iter_container_metrics` does, but have its lines scanned in batches by
+    the `pool` if it is at least as large as the threshold of the pool.
+    Smaller responses are parsed in this thread, with the `label_sets`.
+
+    The scanned label sets are converted into containers in this thread, as
+    the workers of the pool may not be able to import pydantic. Lines
+    dropped by the `metric_filter` are scanned nonetheless."""
+    batches = iter_batches(chunks, pool.batch_size)
+    received = _receive(batches, pool.threshold)
+    if sum(map(len, received)) < pool.threshold:
+        yield from iter_container_metrics(
+            itertools.chain.from_iterable(
+                batch.decode("utf-8").split("\n") for batch in received
+            ),
+            now,
+            label_sets,
+            metric_filter,
+        )
+        return
 
-def read_node_collector_token() -> str:  # pragma: no cover
-    """Read token from token file managed by Kubernetes."""
-    with open(
-        "/var/run/secrets/kubernetes.io/serviceaccount/token",
-        "r",
-        encoding="utf-8",
-    ) as token:
-        return token.read()
+    parsed = 0
+    for scanned in pool.scan(itertools.chain(received, batches)):
+        containers = [_container(labels) for labels in scanned.label_sets]
+        for metric_name, index, value_string, timestamp_ms in scanned.lines:
+            if (container := containers[index]) is None or (
+                metric_filter is not None and not metric_filter.keep(metric_name)
+            ):
+                continue
+            parsed += 1
+            yield _container_metric(
+                container, MetricName(metric_name), value_string, timestamp_ms, now
+            )
+    logger.debug(
+        "Parsed %d container metrics in a pool of %d workers", parsed, pool.workers
+    )
+
+
+def _receive(batches: Iterator[bytes], size: int) -> List[bytes]:
+    """The first batches, until at least `size` bytes are received or the
+    stream ended.
+
+    >>> _receive(iter([b"ab", b"c", b"d"]), 3)
+    [b'ab', b'c']
+    """
+    received: List[bytes] = []
+    for batch in batches:
+        received.append(batch)
+        if sum(map(len, received)) >= size:
+            break
+    return received
+
+
+def _iter_lines(chunks: Iterable[bytes]) -> Iterator[str]:
+    """Decoded lines of a stream of chunks, each as soon as it is received
+    completely.
+
+    >>> list(_iter_lines([b"a\\nb", b"c\\n\\nd"]))
+    ['a', 'bc', '', 'd']
+    """
+    pending = b""
+    for chunk in chunks:
+        *lines, pending = (pending + chunk).split(b"\n")
+        for line in lines:
+            yield line.decode("utf-8")
+    if pending:
+        yield pending.decode("utf-8")
+
+
+def query_cadvisor_version(session: Session) -> Version:  # pragma: no cover
+    """Query the version of cAdvisor."""
+    logger.info("Querying cadvisor version")
+    cadvisor_version = session.get(f"{CADVISOR_URL}/api/v2.0/version")
+    cadvisor_version.raise_for_status()
+    logger.debug("cadvisor version %s", cadvisor_version.content)
+    return Version(json.loads(cadvisor_version.content))
 
 
 def parse_arguments(argv: Sequence[str]) -> argparse.Namespace:
@@ -314,6 +557,70 @@ def parse_arguments(argv: Sequence[str]) -> argparse.Namespace:
         type=int,
         help="Checkmk Agent execution timeout in seconds",
     )
+    parser.add_argument(
+        "--compression",
+        choices=[encoding.value for encoding in supported_encodings()],
+        help="Content coding to compress data sent to the cluster collector with.",
+    )
+    parser.add_argument(
+        "--zstd-dictionary",
+        action="store_true",
+        help="Compress container metrics with a zstd dictionary of cAdvisor "
+        "metric names. Only takes effect with --compression=zstd.",
+    )
+    parser.add_argument(
+        "--upload-format",
+        choices=["v1", "v2", "delta"],
+        help="Format to send container metrics in. v2 lists the labels of "
+        "each container and each metric name only once, delta additionally "
+        "only sends the metrics that changed since the last upload. Both "
+        "require a cluster collector that supports them.",
+    )
+    parser.add_argument(
+        "--keyframe-interval",
+        type=int,
+        help="With --upload-format=delta, send all container metrics every "
+        "this many uploads.",
+    )
+    parser.add_argument(
+        "--raw-machine-sections",
+        action="store_true",
+        help="Send the Checkmk Agent output to the cluster collector as plain "
+        "text, instead of embedding it in JSON.",
+    )
+    parser.add_argument(
+        "--parsing-workers",
+        type=int,
+        help="Parse large responses of cAdvisor in a pool of this many "
+        "interpreters, which run in parallel within the node collector. By "
+        "default, they are parsed by the node collector itself.",
+    )
+    parser.add_argument(
+        "--parallel-parsing-threshold",
+        type=int,
+        help="With --parsing-workers, only parse responses of cAdvisor of at "
+        "least this many bytes in the pool.",
+    )
+    parser.add_argument(
+        "--metric-allowlist",
+        action="append",
+        metavar="PATTERN",
+        help="Only send the cAdvisor metrics whose names match one of these "
+        "glob patterns. May be given multiple times.",
+    )
+    parser.add_argument(
+        "--metric-denylist",
+        action="append",
+        metavar="PATTERN",
+        help="Do not send the cAdvisor metrics whose names match one of these "
+        "glob patterns. May be given multiple times.",
+    )
+    parser.add_argument(
+        "--metric-filter-file",
+        help="JSON file with the lists of glob patterns 'allow' and 'deny', "
+        "which replace --metric-allowlist and --metric-denylist while it "
+        "exists. The file is read again whenever it changes.",
+    )
     parser.set_defaults(
         host=os.environ.get("CLUSTER_COLLECTOR_SERVICE_HOST", "127.0.0.1"),
         port=os.environ.get("CLUSTER_COLLECTOR_SERVICE_PORT_API", "10050"),
@@ -321,6 +628,13 @@ def parse_arguments(argv: Sequence[str]) -> argparse.Namespace:
         polling_interval=60,
         ca_cert="/etc/ca-certificates/checkmk-ca-cert.pem",
         checkmk_agent_timeout=5,
+        compression=ContentEncoding.GZIP.value,
+        upload_format="v1",
+        keyframe_interval=10,
+        metric_allowlist=[],
+        metric_denylist=[],
+        parsing_workers=0,
+        parallel_parsing_threshold=8 * 1024 * 1024,
     )
 
     return parser.parse_args(argv)
@@ -329,60 +643,148 @@ def parse_arguments(argv: Sequence[str]) -> argparse.Namespace:
 def container_metrics_worker(
     session: Session,
     cluster_collector_base_url: Url,
-    headers: RequestHeaders,
+    context: NodeCollectorContext,
     verify: SslVerify,
-    _args: argparse.Namespace,
-) -> None:  # pragma: no cover
+    args: argparse.Namespace,
+    *,
+    delta_encoder: DeltaEncoder,
+    label_sets: LabelSetCache,
+) -> Optional[float]:  # pragma: no cover
     """
-    Query cadvisor api, send metrics to cluster collector
+    Query cadvisor api, send metrics to cluster collector. Returns the phase
+    the cluster collector assigned to upload at.
     """
 
-    cadvisor_url = "http://localhost:8080"
-
-    logger.info("Querying cadvisor version")
-    cadvisor_version = session.get(f"{cadvisor_url}/api/v2.0/version")
-    cadvisor_version.raise_for_status()
-    logger.debug("cadvisor version %s", cadvisor_version.content)
-
-    logger.info("Querying container metrics")
-    cadvisor_metrics = session.get(f"{cadvisor_url}/metrics")
-    cadvisor_metrics.raise_for_status()
-
-    logger.info("Parsing and sending container metrics")
-    cluster_collector_response = session.post(
-        f"{cluster_collector_base_url}/update_container_metrics",
-        headers={**headers, "Content-Type": "application/json"},
-        data=MetricCollection(
-            container_metrics=parse_raw_response(
-                cadvisor_metrics.content.decode("utf-8"), Timestamp(time.time())
+    metadata = context.metadata(
+        CollectorType.CONTAINER_METRICS,
+        Components(
+            cadvisor_version=context.cadvisor_version(
+                partial(query_cadvisor_version, session)
             ),
-            metadata=parse_node_collector_metadata(
-                collector_metadata=collector_metadata(),
-                collector_type=CollectorType.CONTAINER_METRICS,
-                components=Components(
-                    cadvisor_version=Version(
-                        json.loads(cadvisor_version.content),
-                    ),
-                    checkmk_agent_version=None,
-                ),
-            ),
-        ).model_dump_json(),
-        verify=verify,
+            checkmk_agent_version=None,
+        ),
     )
-    _verify_and_log_cluster_collector_response(
-        cluster_collector_response, "container metrics"
+    post = partial(
+        _post_container_metrics,
+        session=session,
+        cluster_collector_base_url=cluster_collector_base_url,
+        context=context,
+        verify=verify,
+        args=args,
     )
 
+    logger.info("Querying and parsing container metrics")
+    # The response is parsed line by line as it is received, rather than
+    # buffering it, as it grows to several MB on nodes with many pods
+    with session.get(f"{CADVISOR_URL}/metrics", stream=True) as cadvisor_metrics:
+        cadvisor_metrics.raise_for_status()
+        now = Timestamp(time.time())
+        parsed_metrics = iter_cadvisor_metrics(
+            cadvisor_metrics.iter_content(chunk_size=64 * 1024),
+            now,
+            label_sets,
+            load_metric_filter(
+                args.metric_allowlist, args.metric_denylist, args.metric_filter_file
+            ),
+            pool=(
+                parsing_pool(args.parsing_workers, args.parallel_parsing_threshold)
+                if args.parsing_workers
+                else None
+            ),
+        )
+        if args.upload_format == "v1":
+            logger.info("Streaming container metrics")
+            # The upload is encoded and sent while the response is parsed
+            return parse_upload_response(
+                post(
+                    "update_container_metrics",
+                    iter_metric_collection_json(
+                        parsed_metrics,
+                        None if context.metadata_known() else metadata,
+                    ),
+                )
+            ).upload_phase
+        container_metrics = list(parsed_metrics)
+
+    logger.info("Sending container metrics")
+    if args.upload_format == "delta":
+        response = upload_container_metric_delta(
+            post,
+            delta_encoder,
+            container_metrics,
+            metadata,
+            now,
+            keyframe_interval=args.keyframe_interval,
+        )
+    else:
+        response = parse_upload_response(
+            post(
+                *container_metrics_upload(
+                    container_metrics, metadata, now, args.upload_format
+                )
+            )
+        )
+    return response.upload_phase
+
+
+def _post_container_metrics(
+    endpoint: str,
+    collection: Union[BaseModel, Iterable[bytes]],
+    *,
+    session: Session,
+    cluster_collector_base_url: Url,
+    context: NodeCollectorContext,
+    verify: SslVerify,
+    args: argparse.Namespace,
+) -> bytes:  # pragma: no cover
+    def post(include_metadata: bool) -> bytes:
+        body: Union[bytes, Iterator[bytes]]
+        if isinstance(collection, BaseModel):
+            body, encoding_headers = encode_request_body(
+                collection.model_dump_json(
+                    exclude=None if include_metadata else {"metadata"}
+                ).encode("utf-8"),
+                ContentEncoding(args.compression),
+                METRIC_NAMES_DICTIONARY if args.zstd_dictionary else None,
+            )
+        else:
+            # Sent with chunked transfer encoding. Whether the stream includes
+            # the metadata, was decided when it was started.
+            body, encoding_headers = encode_request_body_stream(
+                collection,
+                ContentEncoding(args.compression),
+                METRIC_NAMES_DICTIONARY if args.zstd_dictionary else None,
+            )
+        cluster_collector_response = session.post(
+            f"{cluster_collector_base_url}/{endpoint}",
+            headers={
+                **context.headers(),
+                **encoding_headers,
+                "Content-Type": "application/json",
+            },
+            data=body,
+            verify=verify,
+        )
+        _verify_and_log_cluster_collector_response(
+            cluster_collector_response, "container metrics"
+        )
+        return cluster_collector_response.content
+
+    # A stream can only be sent once. If the cluster collector requests the
+    # metadata, it is included in the next upload.
+    return upload_with_metadata(post, context, retry=isinstance(collection, BaseModel))
+
 
 def machine_sections_worker(
     session: Session,
     cluster_collector_base_url: Url,
-    headers: RequestHeaders,
+    context: NodeCollectorContext,
     verify: SslVerify,
     args: argparse.Namespace,
-) -> None:  # pragma: no cover
+) -> Optional[float]:  # pragma: no cover
     """
-    Call check_mk_agent, send sections to cluster collector
+    Call check_mk_agent, send sections to cluster collector. Returns the phase
+    the cluster collector assigned to upload at.
     """
     logger.info("Querying Checkmk Agent for node data")
     with subprocess.Popen(  # nosec
@@ -395,32 +797,66 @@ def machine_sections_worker(
             raise RuntimeError("Agent execution failed.")
         if process.stdout is None:
             raise RuntimeError("Could not read agent output")
-        sections = out.decode("utf-8")
 
-    logger.info("Parsing and sending machine sections")
-    cluster_collector_response = session.post(
-        f"{cluster_collector_base_url}/update_machine_sections",
-        headers={**headers, "Content-Type": "application/json"},
-        data=MachineSectionsCollection(
-            sections=MachineSections(
-                sections=sections,
-                node_name=NodeName(os.environ["NODE_NAME"]),
-            ),
-            metadata=parse_node_collector_metadata(
-                collector_metadata=collector_metadata(),
-                collector_type=CollectorType.MACHINE_SECTIONS,
-                components=Components(
-                    cadvisor_version=None,
-                    checkmk_agent_version=Version(os.environ["CHECKMK_AGENT_VERSION"]),
-                ),
-            ),
-        ).model_dump_json(),
-        verify=verify,
-    )
-    _verify_and_log_cluster_collector_response(
-        cluster_collector_response, "machine sections"
+    metadata = context.metadata(
+        CollectorType.MACHINE_SECTIONS,
+        Components(
+            cadvisor_version=None,
+            checkmk_agent_version=Version(os.environ["CHECKMK_AGENT_VERSION"]),
+        ),
     )
 
+    def post(include_metadata: bool) -> bytes:
+        if args.raw_machine_sections:
+            body, encoding_headers = encode_request_body(
+                out, ContentEncoding(args.compression)
+            )
+            cluster_collector_response = session.post(
+                f"{cluster_collector_base_url}/update_machine_sections_raw",
+                headers={
+                    **context.headers(),
+                    **encoding_headers,
+                    "Content-Type": "text/plain",
+                    **(
+                        {"Checkmk-Node-Collector-Metadata": metadata.model_dump_json()}
+                        if include_metadata
+                        else {}
+                    ),
+                },
+                data=body,
+                verify=verify,
+            )
+        else:
+            body, encoding_headers = encode_request_body(
+                MachineSectionsCollection(
+                    sections=MachineSections(
+                        sections=out.decode("utf-8"),
+                        node_name=NodeName(os.environ["NODE_NAME"]),
+                    ),
+                    metadata=metadata,
+                )
+                .model_dump_json(exclude=None if include_metadata else {"metadata"})
+                .encode("utf-8"),
+                ContentEncoding(args.compression),
+            )
+            cluster_collector_response = session.post(
+                f"{cluster_collector_base_url}/update_machine_sections",
+                headers={
+                    **context.headers(),
+                    **encoding_headers,
+                    "Content-Type": "application/json",
+                },
+                data=body,
+                verify=verify,
+            )
+        _verify_and_log_cluster_collector_response(
+            cluster_collector_response, "machine sections"
+        )
+        return cluster_collector_response.content
+
+    logger.info("Parsing and sending machine sections")
+    return parse_upload_response(upload_with_metadata(post, context)).upload_phase
+
 
 def _verify_and_log_cluster_collector_response(
     cluster_collector_response: requests.Response, component_name: str
@@ -452,9 +888,50 @@ def _setup_logging(verbosity: Literal["info", "debug"]) -> None:  # pragma: no c
     )
 
 
+def _run_cycles(
+    worker: Callable[[], Optional[float]],
+    schedule: PollingSchedule,
+    terminated: Event,
+    *,
+    clock: Callable[[], float] = time.monotonic,
+) -> None:
+    """Run the worker once per cycle of the schedule until terminated.
+
+    The worker returns the phase the cluster collector assigned, if any,
+    which the schedule adopts. Uploads rejected because the cluster collector
+    is overloaded are retried after the delay it asked for. `clock` is the
+    monotonic clock of the schedule."""
+    cycle_start = clock()
+    while not terminated.is_set():
+        start_time = clock()
+        logger.info("Cycle started %.2f seconds late", start_time - cycle_start)
+
+        try:
+            upload_phase = worker()
+        except requests.HTTPError as error:
+            terminated.wait(overload_delay(error, schedule.interval))
+            cycle_start = clock()
+            continue
+        now = clock()
+        logger.info("Worker finished in %.2f seconds", now - start_time)
+
+        if upload_phase is not None:
+            # Adopt the phase the cluster collector assigned
+            schedule.phase = upload_phase
+        cycle = schedule.next_cycle(after=cycle_start, now=now)
+        if cycle.skipped:
+            logger.warning(
+                "Worker overran the polling interval, skipped %d cycles",
+                cycle.skipped,
+            )
+        cycle_start = cycle.start
+        terminated.wait(cycle_start - now)
+
+
 def _main(
     worker: Callable[
-        [Session, Url, RequestHeaders, SslVerify, argparse.Namespace], None
+        [Session, Url, NodeCollectorContext, SslVerify, argparse.Namespace],
+        Optional[float],
     ],
     argv: Optional[Sequence[str]] = None,
 ) -> None:  # pragma: no cover
@@ -476,24 +953,33 @@ def _main(
     )
     cluster_collector_base_url = Url(f"{protocol}://{args.host}:{args.port}")
     logger.debug("Cluster collector base url: %s", cluster_collector_base_url)
+    # The token, the metadata and the version of cAdvisor are looked up again
+    # only once they may have changed
+    context = NodeCollectorContext()
 
     terminated = Event()
     signal.signal(signal.SIGTERM, lambda _sig, _frame: terminated.set())
 
-    while not terminated.is_set():
-        start_time = time.time()
-
-        headers = {
-            "Authorization": f"Bearer {read_node_collector_token()}",
-        }
-        worker(session, cluster_collector_base_url, headers, verify, args)
-        process_duration = time.time() - start_time
-        logger.info("Worker finished in %.2f seconds", process_duration)
-
-        terminated.wait(max(args.polling_interval - int(process_duration), 0))
+    _run_cycles(
+        partial(worker, session, cluster_collector_base_url, context, verify, args),
+        PollingSchedule(
+            args.polling_interval,
+            node_phase(os.environ.get("NODE_NAME", "")),
+            now=time.monotonic(),
+            wall_time=time.time(),
+        ),
+        terminated,
+    )
 
     logger.info("Shut down gracefully")
 
 
-main_container_metrics = partial(_main, container_metrics_worker)
+main_container_metrics = partial(
+    _main,
+    partial(
+        container_metrics_worker,
+        delta_encoder=DeltaEncoder(),
+        label_sets=LabelSetCache(),
+    ),
+)
 main_machine_sections = partial(_main, machine_sections_worker)
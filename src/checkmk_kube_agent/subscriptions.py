@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright (C) 2021 Checkmk GmbH - License: GNU General Public License v2
+# This file is part of Checkmk (https://checkmk.com). It is subject to the
+# terms and conditions defined in the file COPYING, which is part of this
+# source code package.
+
+"""Push cache updates to subscribers as server-sent events."""
+
+import asyncio
+from collections import deque
+from contextlib import contextmanager
+from threading import Lock
+from typing import (
+    AsyncGenerator,
+    Awaitable,
+    Callable,
+    Deque,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+)
+
+
+class SubscriptionEvent(NamedTuple):
+    """Server-sent event. `data` is serialized once when published, not once
+    per subscriber."""
+
+    event: str
+    data: str  # pylint: disable=disallowed-name
+
+
+class Subscription:
+    """Bounded event buffer of a single subscriber.
+
+    Events may be published from any thread, whereas they are received on the
+    event loop the subscription was created on.
+
+    If the subscriber falls behind and the buffer is full, all buffered events
+    are discarded and the subscriber is flagged as overflowed: it has to start
+    over from a fresh snapshot instead of receiving an incomplete event
+    stream.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, maxsize: int):
+        if maxsize <= 0:
+            raise ValueError(f"maxsize must be at least 1, got {maxsize}")
+
+        self.maxsize = maxsize
+        self._loop = loop
+        self._events: Deque[SubscriptionEvent] = deque()
+        self._overflowed = False
+        self._wakeup = asyncio.Event()
+        self.__lock = Lock()
+
+    def publish(self, event: SubscriptionEvent) -> None:
+        """Buffer an event and wake up the subscriber."""
+        self.publish_many([event])
+
+    def publish_many(self, events: Sequence[SubscriptionEvent]) -> None:
+        """Buffer several events and wake up the subscriber once."""
+        with self.__lock:
+            if len(self._events) + len(events) > self.maxsize:
+                self._events.clear()
+                self._overflowed = True
+            else:
+                self._events.extend(events)
+        self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    async def receive(self, timeout: float) -> Tuple[bool, Sequence[SubscriptionEvent]]:
+        """Wait up to `timeout` seconds for events and return all buffered
+        events, together with whether the buffer overflowed since the last
+        call."""
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout)
+        except TimeoutError:
+            pass
+        self._wakeup.clear()
+
+        with self.__lock:
+            events: List[SubscriptionEvent] = list(self._events)
+            self._events.clear()
+            overflowed, self._overflowed = self._overflowed, False
+        return overflowed, events
+
+
+class SubscriptionHub:
+    """Fan out events to all current subscribers."""
+
+    def __init__(self, *, maxsize: int):
+        self.maxsize = maxsize
+        self._subscriptions: Set[Subscription] = set()
+        self._batch: Optional[List[SubscriptionEvent]] = None
+        self.__lock = Lock()
+
+    def __len__(self) -> int:
+        with self.__lock:
+            return len(self._subscriptions)
+
+    @contextmanager
+    def subscribe(self, loop: asyncio.AbstractEventLoop) -> Iterator[Subscription]:
+        """Register a subscription for the duration of the context."""
+        subscription = Subscription(loop, self.maxsize)
+        with self.__lock:
+            self._subscriptions.add(subscription)
+        try:
+            yield subscription
+        finally:
+            with self.__lock:
+                self._subscriptions.discard(subscription)
+
+    def publish(self, event: SubscriptionEvent) -> None:
+        """Publish an event to all current subscribers."""
+        with self.__lock:
+            if self._batch is not None:
+                self._batch.append(event)
+                return
+            subscriptions = list(self._subscriptions)
+        for subscription in subscriptions:
+            subscription.publish(event)
+
+    @contextmanager
+    def batch(self) -> Iterator[None]:
+        """Hold back the events published within the context, and publish
+        them together once it is left.
+
+        This applies to events published from any thread, hence batches are
+        meant to be used by a single writer."""
+        with self.__lock:
+            self._batch = []
+        try:
+            yield
+        finally:
+            with self.__lock:
+                events, self._batch = self._batch, None
+                subscriptions = list(self._subscriptions)
+            if events:
+                for subscription in subscriptions:
+                    subscription.publish_many(events)
+
+
+def format_server_sent_event(event: SubscriptionEvent) -> bytes:
+    """Encode an event in the `text/event-stream` format.
+
+    >>> format_server_sent_event(SubscriptionEvent("snapshot", '{"a": 1}'))
+    b'event: snapshot\\ndata: {"a": 1}\\n\\n'
+    """
+    return f"event: {event.event}\ndata: {event.data}\n\n".encode("utf-8")
+
+
+async def stream_events(
+    hub: SubscriptionHub,
+    snapshot: Callable[[], Awaitable[SubscriptionEvent]],
+    *,
+    keepalive_interval: float,
+) -> AsyncGenerator[bytes, None]:
+    """Stream a snapshot, followed by incremental events as they are
+    published.
+
+    The subscription is registered before the snapshot is taken, so that no
+    update is missed in between. A new snapshot is sent whenever the
+    subscriber's buffer overflowed. A comment line is sent if there were no
+    events for `keepalive_interval` seconds, so that broken connections are
+    detected.
+
+    Taking a snapshot waits on the locks of the caches, so it is awaited
+    rather than taken on the event loop."""
+    with hub.subscribe(asyncio.get_running_loop()) as subscription:
+        yield format_server_sent_event(await snapshot())
+        while True:
+            overflowed, events = await subscription.receive(keepalive_interval)
+            if overflowed:
+                yield format_server_sent_event(await snapshot())
+            elif not events:
+                yield b": keepalive\n\n"
+            else:
+                for event in events:
+                    yield format_server_sent_event(event)
@@ -8,9 +8,19 @@
 """Cluster collector API data type definitions."""
 
 from enum import Enum
-from typing import NamedTuple, NewType, NoReturn, Optional, Protocol, Sequence
-
-from pydantic import BaseModel, model_validator
+from typing import (
+    Any,
+    Mapping,
+    NamedTuple,
+    NewType,
+    NoReturn,
+    Optional,
+    Protocol,
+    Sequence,
+    Tuple,
+)
+
+from pydantic import BaseModel, ValidationInfo, model_validator
 
 LabelName = NewType("LabelName", str)
 LabelValue = NewType("LabelValue", str)
@@ -43,11 +53,67 @@ class ContainerMetric(BaseModel):
     timestamp: Timestamp
 
 
+class ContainerMetricRate(BaseModel):
+    container_name: ContainerName
+    namespace: Namespace
+    pod_uid: PodUid
+    pod_name: PodName
+    metric_name: MetricName
+    rate: float
+    timestamp: Timestamp
+    counter_reset: bool
+
+
+class ContainerLabels(BaseModel):
+    container_name: ContainerName
+    namespace: Namespace
+    pod_uid: PodUid
+    pod_name: PodName
+
+
 class MachineSections(BaseModel):
     node_name: NodeName
     sections: str
 
 
+class ContentEncoding(str, Enum):
+    IDENTITY = "identity"
+    GZIP = "gzip"
+    ZSTD = "zstd"
+
+
+class RawMachineSections(NamedTuple):
+    node_name: NodeName
+    sections: bytes  # Checkmk agent output, as is
+
+
+SeriesKey = Tuple[ContainerName, MetricName]
+
+
+class ContainerSeries(NamedTuple):
+    container: ContainerLabels
+    metric_name: MetricName
+    value: MetricValueString
+    # None if the series takes the timestamp of the upload
+    timestamp: Optional[Timestamp]
+
+
+class NodeContainerSeries(NamedTuple):
+    node: NodeName
+    sequence: int  # of the upload merged last
+    timestamp: Timestamp  # of the upload merged last
+    # several series per key if cAdvisor reports a metric several times per
+    # container, in the order they were uploaded
+    series: Mapping[SeriesKey, Sequence[ContainerSeries]]
+
+
+class CompressedMachineSections(NamedTuple):
+    node_name: NodeName
+    content_encoding: ContentEncoding
+    piggyback_block: bytes  # compressed sections, wrapped in piggyback header
+    sections_size: int  # size of the sections before compression
+
+
 class PlatformMetadata(BaseModel):
     os_name: OsName
     os_version: Version
@@ -78,8 +144,16 @@ class CacheHealth(BaseModel):
     machine_sections: CacheSizeInfo
 
 
+class IngestionHealth(BaseModel):
+    queue_depth: int
+    queued_bytes: int
+    maxsize: int
+    lag: float  # Seconds the most recently applied upload waited in the queue
+
+
 class ClusterCollectorMetadata(CollectorMetadata):
     cache_health: CacheHealth
+    ingestion_health: Optional[IngestionHealth] = None
 
 
 class CollectorType(str, Enum):
@@ -114,21 +188,158 @@ class NodeCollectorMetadata(CollectorMetadata):
         )
 
 
+class StoredUpload(NamedTuple):
+    digest: str  # of the request body the entries were stored from
+    metadata: NodeCollectorMetadata
+    container_metrics: Sequence[ContainerMetric]
+    machine_sections: Sequence[CompressedMachineSections]
+    container_metric_rates: Sequence[ContainerMetricRate] = ()
+    # of the node, if the upload was merged into its series
+    container_series: Optional[NodeContainerSeries] = None
+
+
+class UploadDigest(NamedTuple):
+    digest: str
+    metadata: NodeCollectorMetadata
+
+
+# Metadata of a node collector, by the digest the node collector sends along
+# with its uploads instead of the metadata, once the cluster collector knows it
+class MetadataDigest(NamedTuple):
+    digest: str
+    metadata: NodeCollectorMetadata
+
+
+class MetadataRequired(Exception):
+    """An upload without metadata references a digest the cluster collector
+    does not know."""
+
+
+class MetadataReference(NamedTuple):
+    digest: str
+    # Known metadata with this digest, if any
+    metadata: Optional[NodeCollectorMetadata]
+
+    def resolve(self) -> NodeCollectorMetadata:
+        if self.metadata is None:
+            raise MetadataRequired(self.digest)
+        return self.metadata
+
+
+# Upload of a node collector. Its metadata may be omitted, if it is validated
+# with the MetadataReference of the digest sent along with it as context.
+class NodeCollectorUpload(BaseModel):
+    @model_validator(mode="before")
+    @classmethod
+    def resolve_metadata(cls, values: Any, info: ValidationInfo) -> Any:
+        if (
+            isinstance(values, dict)
+            and "metadata" not in values
+            and isinstance(info.context, MetadataReference)
+        ):
+            return {**values, "metadata": info.context.resolve()}
+        return values
+
+
 class Metadata(BaseModel):
     cluster_collector_metadata: ClusterCollectorMetadata
     node_collector_metadata: Sequence[NodeCollectorMetadata]
 
 
-class MetricCollection(BaseModel):
+class MetricCollection(NodeCollectorUpload):
     container_metrics: Sequence[ContainerMetric]
     metadata: NodeCollectorMetadata
 
 
-class MachineSectionsCollection(BaseModel):
+# Indices into `containers` and `metric_names` of a ContainerMetricTable, the
+# metric value and the timestamp, if it differs from the one of the table.
+ContainerMetricRow = Tuple[int, int, MetricValueString, Optional[Timestamp]]
+
+
+class ContainerMetricTable(BaseModel):
+    containers: Sequence[ContainerLabels]
+    metric_names: Sequence[MetricName]
+    rows: Sequence[ContainerMetricRow]
+    timestamp: Timestamp
+
+    @model_validator(mode="after")
+    def validate_rows(self) -> "ContainerMetricTable":
+        containers, metric_names = len(self.containers), len(self.metric_names)
+        for container, metric_name, _value, _timestamp in self.rows:
+            if not 0 <= container < containers:
+                raise ValueError(f"Unknown container index: {container}")
+            if not 0 <= metric_name < metric_names:
+                raise ValueError(f"Unknown metric name index: {metric_name}")
+        return self
+
+
+class MetricTableCollection(NodeCollectorUpload):
+    container_metrics: ContainerMetricTable
+    metadata: NodeCollectorMetadata
+
+
+# Upload of the container metrics that changed since the upload `base_sequence`
+# of the same node collector. Series that did not change are only listed by
+# their indices into `containers` and `metric_names`. Without a
+# `base_sequence`, the upload is a keyframe and contains all series.
+class ContainerMetricDelta(NodeCollectorUpload):
+    sequence: int
+    base_sequence: Optional[int] = None
+    container_metrics: ContainerMetricTable
+    unchanged: Sequence[Tuple[int, int]] = ()
+    metadata: NodeCollectorMetadata
+
+    @model_validator(mode="after")
+    def validate_unchanged(self) -> "ContainerMetricDelta":
+        if self.base_sequence is None and self.unchanged:
+            raise ValueError("A keyframe cannot reference unchanged series")
+        containers = len(self.container_metrics.containers)
+        metric_names = len(self.container_metrics.metric_names)
+        for container, metric_name in self.unchanged:
+            if not 0 <= container < containers:
+                raise ValueError(f"Unknown container index: {container}")
+            if not 0 <= metric_name < metric_names:
+                raise ValueError(f"Unknown metric name index: {metric_name}")
+        return self
+
+
+class UploadResponse(BaseModel):
+    keyframe_required: bool = False
+    # The upload referenced metadata by a digest the cluster collector does
+    # not know, and was discarded. It has to be sent again with its metadata.
+    metadata_required: bool = False
+    # Digest of the metadata the cluster collector knows of the node collector.
+    # Older cluster collectors do not set it, and always need the metadata.
+    metadata_digest: Optional[str] = None
+    # Fraction of the polling interval, after which the node collector should
+    # upload, so that the uploads of all node collectors are spread evenly.
+    upload_phase: Optional[float] = None
+
+
+class MetricFilterConfig(BaseModel):
+    # Glob patterns of the names of the cAdvisor metrics the node collector
+    # propagates. All metrics are propagated if there are none.
+    allow: Sequence[str] = ()
+    # Glob patterns of the names of the cAdvisor metrics the node collector
+    # drops, even if they are allowed.
+    deny: Sequence[str] = ()
+
+
+class MachineSectionsCollection(NodeCollectorUpload):
     sections: MachineSections
     metadata: NodeCollectorMetadata
 
 
+class ContainerMetricsUpdate(BaseModel):
+    node: NodeName
+    container_metrics: Sequence[ContainerMetric]
+
+
+class CacheSnapshot(BaseModel):
+    container_metrics: Sequence[ContainerMetric]
+    machine_sections: Sequence[MachineSections]
+
+
 class UserInfo(BaseModel):
     username: str = ""  # username might be missing, so we avoid `None` value
 
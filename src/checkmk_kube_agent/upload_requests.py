@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright (C) 2021 Checkmk GmbH - License: GNU General Public License v2
+# This file is part of Checkmk (https://checkmk.com). It is subject to the
+# terms and conditions defined in the file COPYING, which is part of this
+# source code package.
+"""Uploads of the node collectors to the cluster collector: the encoding of
+their request bodies and the handling of the responses."""
+
+import email.utils
+import itertools
+import logging
+import time
+from typing import (
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+import requests
+from pydantic import BaseModel, TypeAdapter
+
+from checkmk_kube_agent.content_encoding import (
+    ZSTD_DICTIONARY_HEADER,
+    compress,
+    compress_stream,
+)
+from checkmk_kube_agent.metric_delta import DeltaEncoder
+from checkmk_kube_agent.metric_table import encode_metric_table
+from checkmk_kube_agent.node_collector_context import NodeCollectorContext
+from checkmk_kube_agent.type_defs import (
+    ContainerMetric,
+    ContentEncoding,
+    MetricCollection,
+    MetricTableCollection,
+    NodeCollectorMetadata,
+    Timestamp,
+    UploadResponse,
+)
+
+RequestHeaders = Mapping[str, str]
+
+logger = logging.getLogger(__name__)
+
+_CONTAINER_METRICS = TypeAdapter(List[ContainerMetric])
+
+
+def encode_request_body(
+    body: bytes,
+    encoding: ContentEncoding,
+    zstd_dictionary: Optional[str] = None,
+) -> Tuple[bytes, RequestHeaders]:
+    """Compress a request body to the cluster collector, and return it together
+    with the headers announcing its content coding.
+
+    The zstd dictionary is only used with zstd.
+
+    >>> from checkmk_kube_agent.content_encoding import METRIC_NAMES_DICTIONARY
+    >>> encode_request_body(b"foo", ContentEncoding.IDENTITY, METRIC_NAMES_DICTIONARY)
+    (b'foo', {})
+
+    >>> body, headers = encode_request_body(
+    ...     b"foo", ContentEncoding.GZIP, METRIC_NAMES_DICTIONARY)
+    >>> headers
+    {'Content-Encoding': 'gzip'}
+    """
+    headers, zstd_dictionary = _content_encoding_headers(encoding, zstd_dictionary)
+    return compress(body, encoding, zstd_dictionary=zstd_dictionary), headers
+
+
+def encode_request_body_stream(
+    chunks: Iterable[bytes],
+    encoding: ContentEncoding,
+    zstd_dictionary: Optional[str] = None,
+) -> Tuple[Iterator[bytes], RequestHeaders]:
+    """Compress a request body to the cluster collector chunk by chunk, see
+    `encode_request_body`.
+
+    >>> import gzip
+    >>> from checkmk_kube_agent.content_encoding import METRIC_NAMES_DICTIONARY
+    >>> body, headers = encode_request_body_stream(
+    ...     [b"foo", b"bar"], ContentEncoding.GZIP, METRIC_NAMES_DICTIONARY)
+    >>> headers, gzip.decompress(b"".join(body))
+    ({'Content-Encoding': 'gzip'}, b'foobar')
+    """
+    headers, zstd_dictionary = _content_encoding_headers(encoding, zstd_dictionary)
+    return compress_stream(chunks, encoding, zstd_dictionary=zstd_dictionary), headers
+
+
+def _content_encoding_headers(
+    encoding: ContentEncoding, zstd_dictionary: Optional[str]
+) -> Tuple[Dict[str, str], Optional[str]]:
+    """Headers announcing a content coding, and the zstd dictionary to use
+    with it, if any."""
+    if encoding is ContentEncoding.IDENTITY:
+        return {}, None
+
+    headers = {"Content-Encoding": encoding.value}
+    if encoding is ContentEncoding.ZSTD and zstd_dictionary is not None:
+        headers[ZSTD_DICTIONARY_HEADER] = zstd_dictionary
+    else:
+        zstd_dictionary = None
+    return headers, zstd_dictionary
+
+
+def iter_metric_collection_json(
+    container_metrics: Iterable[ContainerMetric],
+    metadata: Optional[NodeCollectorMetadata],
+    *,
+    batch_size: int = 1000,
+) -> Iterator[bytes]:
+    """Encode container metrics as the JSON of a MetricCollection, a batch of
+    `batch_size` metrics at a time, as they are parsed. Without `metadata`,
+    the metadata is omitted."""
+    yield b'{"container_metrics":['
+    separator = b""
+    metrics = iter(container_metrics)
+    while batch := list(itertools.islice(metrics, batch_size)):
+        # Strip the brackets of the encoded list
+        yield separator + _CONTAINER_METRICS.dump_json(batch)[1:-1]
+        separator = b","
+    if metadata is None:
+        yield b"]}"
+    else:
+        yield b'],"metadata":' + metadata.model_dump_json().encode("utf-8") + b"}"
+
+
+def container_metrics_upload(
+    container_metrics: Sequence[ContainerMetric],
+    metadata: NodeCollectorMetadata,
+    now: Timestamp,
+    upload_format: str,
+) -> Tuple[str, BaseModel]:
+    """Cluster collector endpoint and request body to upload container metrics
+    with in the given format.
+
+    In the v2 format, metrics without a timestamp of their own are sent
+    without one, and take the timestamp of the upload, `now`."""
+    if upload_format == "v2":
+        return "v2/update_container_metrics", MetricTableCollection(
+            container_metrics=encode_metric_table(container_metrics, now),
+            metadata=metadata,
+        )
+    return "update_container_metrics", MetricCollection(
+        container_metrics=container_metrics,
+        metadata=metadata,
+    )
+
+
+def upload_container_metric_delta(
+    post: Callable[[str, BaseModel], bytes],
+    delta_encoder: DeltaEncoder,
+    container_metrics: Sequence[ContainerMetric],
+    metadata: NodeCollectorMetadata,
+    now: Timestamp,
+    *,
+    keyframe_interval: int,
+) -> UploadResponse:
+    """Upload the container metrics that changed since the last acknowledged
+    upload. If the cluster collector cannot merge them, a keyframe is sent
+    right away."""
+    endpoint = "v2/update_container_metric_deltas"
+    delta = delta_encoder.encode(
+        container_metrics, now, metadata, keyframe_interval=keyframe_interval
+    )
+    response = UploadResponse.model_validate_json(post(endpoint, delta))
+    if response.keyframe_required:
+        logger.info("Cluster collector requested a keyframe")
+        delta_encoder.reset()
+        delta = delta_encoder.encode(
+            container_metrics, now, metadata, keyframe_interval=keyframe_interval
+        )
+        response = UploadResponse.model_validate_json(post(endpoint, delta))
+    delta_encoder.acknowledge(delta.sequence)
+    return response
+
+
+def parse_upload_response(content: bytes) -> UploadResponse:
+    """Parse the response of the cluster collector to an upload. Older
+    cluster collectors respond with an empty JSON document.
+
+    >>> parse_upload_response(b"null").metadata_digest is None
+    True
+    >>> parse_upload_response(b'{"upload_phase": 0.5}').upload_phase
+    0.5
+    """
+    if content.strip() in (b"", b"null"):
+        return UploadResponse()
+    return UploadResponse.model_validate_json(content)
+
+
+def upload_with_metadata(
+    post: Callable[[bool], bytes],
+    context: NodeCollectorContext,
+    *,
+    retry: bool = True,
+) -> bytes:
+    """Post an upload with `post`, which includes the node collector metadata
+    in the upload if it is called with True. The metadata is omitted once the
+    cluster collector knows it. If the cluster collector requests it instead,
+    the upload is posted again with the metadata, unless `retry` is False."""
+    include_metadata = not context.metadata_known()
+    content = post(include_metadata)
+    context.acknowledge_metadata(parse_upload_response(content))
+    if retry and not include_metadata and not context.metadata_known():
+        logger.info("Cluster collector requested the node collector metadata")
+        content = post(True)
+        context.acknowledge_metadata(parse_upload_response(content))
+    return content
+
+
+def retry_after_seconds(
+    response: Optional[requests.Response], now: float
+) -> Optional[float]:
+    """Seconds the cluster collector asked to wait before retrying a rejected
+    request, if it did so with a Retry-After header. The header either holds
+    the seconds or an HTTP date, which is compared to `now`."""
+    if response is None or (value := response.headers.get("Retry-After")) is None:
+        return None
+    if value.strip().isdigit():
+        return float(value)
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(date.timestamp() - now, 0.0)
+
+
+def overload_delay(error: requests.HTTPError, polling_interval: float) -> float:
+    """Seconds to wait before retrying after the cluster collector rejected a
+    request because it is overloaded, at most one polling interval. Errors
+    without a Retry-After header are raised again."""
+    if (delay := retry_after_seconds(error.response, time.time())) is None:
+        raise error
+    delay = min(delay, polling_interval)
+    logger.warning("Cluster collector overloaded, retrying in %.0fs", delay)
+    return delay
@@ -0,0 +1,568 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright (C) 2021 Checkmk GmbH - License: GNU General Public License v2
+# This file is part of Checkmk (https://checkmk.com). It is subject to the
+# terms and conditions defined in the file COPYING, which is part of this
+# source code package.
+
+"""Ingestion of the uploads of node collectors into the caches of the cluster
+collector.
+
+The update functions handle the request bodies received by the API endpoints
+of the same name, and are run in a worker thread. They decode the uploads and
+queue storing them to the ingestion writer of the application `state`."""
+
+import functools
+import hashlib
+import logging
+from concurrent.futures import Future
+from contextlib import ExitStack, contextmanager
+from functools import partial
+from operator import attrgetter
+from typing import (
+    Callable,
+    Iterator,
+    List,
+    NewType,
+    Optional,
+    ParamSpec,
+    Sequence,
+    Tuple,
+    Type,
+    TypeVar,
+    Union,
+)
+
+import pydantic
+from fastapi.exceptions import RequestValidationError
+from starlette.datastructures import State
+
+from checkmk_kube_agent import container_metadata
+from checkmk_kube_agent.machine_sections import (
+    compress_machine_sections,
+    decode_machine_sections,
+)
+from checkmk_kube_agent.metric_delta import merge_delta, node_container_metrics
+from checkmk_kube_agent.metric_table import decode_metric_table
+from checkmk_kube_agent.rates import counter_rate, repeated_series
+from checkmk_kube_agent.subscriptions import SubscriptionEvent
+from checkmk_kube_agent.type_defs import (
+    CompressedMachineSections,
+    ContainerMetric,
+    ContainerMetricDelta,
+    ContainerMetricRate,
+    ContainerMetricsUpdate,
+    MachineSectionsCollection,
+    MetadataDigest,
+    MetadataReference,
+    MetadataRequired,
+    MetricCollection,
+    MetricTableCollection,
+    NodeCollectorMetadata,
+    NodeContainerSeries,
+    RawMachineSections,
+    StoredUpload,
+    UploadDigest,
+    UploadResponse,
+)
+
+LOGGER = logging.getLogger(__name__)
+
+ContainerMetricKey = NewType("ContainerMetricKey", str)
+MetadataKey = NewType("MetadataKey", str)
+
+UploadModel = TypeVar("UploadModel", bound=pydantic.BaseModel)
+Upload = TypeVar("Upload")
+WriteResult = TypeVar("WriteResult")
+UpdateParameters = ParamSpec("UpdateParameters")
+
+
+def container_metric_key(
+    metric: Union[ContainerMetric, ContainerMetricRate],
+) -> ContainerMetricKey:
+    """Key function to determine unique key for container metrics and their
+    rates"""
+    return ContainerMetricKey(f"{metric.container_name}:{metric.metric_name}")
+
+
+def metadata_key(metadata: NodeCollectorMetadata) -> MetadataKey:
+    """Key function to determine unique key for metadata"""
+    return MetadataKey(f"{metadata.node}:{metadata.collector_type}")
+
+
+def _decode_upload(
+    model: Type[UploadModel],
+    body: bytes,
+    reference: Optional[MetadataReference] = None,
+) -> UploadModel:
+    """Parse and validate an upload of a node collector in a single pass.
+
+    The JSON document is validated straight from its bytes by the compiled
+    schema of the model, which avoids building and then validating an
+    intermediate tree of Python objects. Uploads without metadata take the
+    metadata of the `reference`."""
+    try:
+        return model.model_validate_json(body, context=reference)
+    except pydantic.ValidationError as exception:
+        raise RequestValidationError(
+            [
+                {**error, "loc": ("body", *error["loc"])}
+                for error in exception.errors(include_url=False)
+            ],
+            body=body,
+        ) from exception
+
+
+def _requesting_metadata(
+    update: Callable[UpdateParameters, UploadResponse],
+) -> Callable[UpdateParameters, UploadResponse]:
+    """Respond to uploads referencing metadata by a digest the cluster
+    collector does not know, e.g. after its restart, by requesting the
+    metadata."""
+
+    @functools.wraps(update)
+    def wrapper(
+        *args: UpdateParameters.args, **kwargs: UpdateParameters.kwargs
+    ) -> UploadResponse:
+        try:
+            return update(*args, **kwargs)
+        except MetadataRequired as exception:
+            LOGGER.info("Requesting metadata of unknown digest %s", exception)
+            return UploadResponse(metadata_required=True)
+
+    return wrapper
+
+
+def _metadata_reference(
+    state: State, metadata_digest: Optional[str]
+) -> Optional[MetadataReference]:
+    """Reference to the metadata with the digest sent along with an upload.
+
+    The metadata is kept as it was validated, when it was first uploaded."""
+    if metadata_digest is None:
+        return None
+    known = state.metadata_digest_queue.find(metadata_digest)
+    return MetadataReference(metadata_digest, None if known is None else known.metadata)
+
+
+def _metadata_digest(
+    metadata: NodeCollectorMetadata, reference: Optional[MetadataReference]
+) -> str:
+    """Digest to keep the metadata of an upload by, for later uploads.
+
+    Metadata resolved by the `reference` is known by its digest already.
+    Metadata included in the upload is kept by the digest computed here, as
+    node collectors of other versions may compute a different one. They
+    learn the digest from the response, and keep including their metadata
+    while it differs from their own."""
+    if reference is not None and metadata is reference.metadata:
+        return reference.digest
+    return container_metadata.metadata_digest(metadata)
+
+
+def _upload_digest(*parts: bytes) -> str:
+    """Digest of an upload, to recognize identical uploads"""
+    digest = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        digest.update(len(part).to_bytes(8, "big"))
+        digest.update(part)
+    return digest.hexdigest()
+
+
+def _remember_upload(
+    state: State,
+    digest: str,
+    metadata: NodeCollectorMetadata,
+    *,
+    container_metrics: Sequence[ContainerMetric] = (),
+    container_metric_rates: Sequence[ContainerMetricRate] = (),
+    container_series: Optional[NodeContainerSeries] = None,
+    machine_sections: Sequence[CompressedMachineSections] = (),
+) -> None:
+    state.stored_upload_queue.put(
+        StoredUpload(
+            digest=digest,
+            metadata=metadata,
+            container_metrics=container_metrics,
+            machine_sections=machine_sections,
+            container_metric_rates=container_metric_rates,
+            container_series=container_series,
+        )
+    )
+    state.upload_digest_queue.put(UploadDigest(digest=digest, metadata=metadata))
+
+
+def _latest_upload(
+    state: State, digest: str
+) -> Optional[Tuple[UploadDigest, StoredUpload]]:
+    """The identical earlier upload, if it is the latest upload of its node
+    collector"""
+    known = state.upload_digest_queue.find(digest)
+    if known is None:
+        return None
+    stored = state.stored_upload_queue.find(metadata_key(known.metadata))
+    if stored is None or stored.digest != digest:
+        return None
+    return known, stored
+
+
+def _refresh_upload(state: State, digest: str) -> bool:
+    """Refresh the cache entries stored from an identical earlier upload,
+    instead of parsing and storing the upload again.
+
+    This only applies if the earlier upload is the latest upload of its node
+    collector, and all entries stored from it are still cached. Otherwise,
+    False is returned and the upload has to be stored."""
+    if (latest := _latest_upload(state, digest)) is None:
+        return False
+    known, stored = latest
+    refreshed = [
+        state.node_collector_metadata_queue.refresh([stored.metadata]),
+        state.container_metric_queue.refresh(stored.container_metrics),
+        state.container_metric_rate_queue.refresh(stored.container_metric_rates),
+        state.container_series_queue.refresh(
+            [] if stored.container_series is None else [stored.container_series]
+        ),
+        state.machine_sections_queue.refresh(stored.machine_sections),
+        state.stored_upload_queue.refresh([stored]),
+        state.upload_digest_queue.refresh([known]),
+    ]
+    return all(refreshed)
+
+
+@contextmanager
+def ingestion_transaction(state: State) -> Iterator[None]:
+    """Apply a group of writes to all caches as one transaction, and publish
+    their events together once it is done."""
+    with ExitStack() as stack:
+        stack.enter_context(state.subscription_hub.batch())
+        for cache in (
+            state.node_collector_metadata_queue,
+            state.container_metric_queue,
+            state.container_metric_rate_queue,
+            state.container_series_queue,
+            state.machine_sections_queue,
+            state.stored_upload_queue,
+            state.upload_digest_queue,
+            state.metadata_digest_queue,
+        ):
+            stack.enter_context(cache.transaction())
+        yield
+
+
+def _ingest(  # pylint: disable=too-many-arguments
+    state: State,
+    digest: str,
+    decode: Callable[[Optional[MetadataReference]], Upload],
+    store: Callable[[Upload], WriteResult],
+    *,
+    metadata_digest: Optional[str],
+    refreshed: WriteResult,
+    size: int,
+    metadata_of: Callable[[Upload], NodeCollectorMetadata] = attrgetter("metadata"),
+) -> Tuple["Future[WriteResult]", NodeCollectorMetadata, Optional[str]]:
+    """Decode an upload and queue storing it to the ingestion writer.
+
+    Uploads are decoded by the request handler, so that invalid uploads are
+    rejected right away. Uploads identical to the latest upload of their node
+    collector are not decoded, and only refresh the entries stored from it.
+    Whether they are still identical to the latest upload, is decided by the
+    writer: another upload of the node collector may be queued before. In
+    that case, or if the entries expired in the meantime, the writer decodes
+    the upload itself. Refreshing returns `refreshed`, storing the result of
+    `store`. The upload is accounted for with `size` bytes while it is
+    queued.
+
+    Uploads may omit the metadata of their node collector, and reference it by
+    its `metadata_digest` instead. The metadata is kept by its digest, and
+    refreshed with each upload referencing it. If the digest is unknown,
+    MetadataRequired is raised. Uploads sent along with a digest keep their
+    metadata by the digest `_metadata_digest` computes.
+
+    Returns the future of the write, the metadata of the node collector the
+    upload is from, and the digest its metadata is kept by, if any."""
+    upload: Optional[Upload] = None
+    if (latest := _latest_upload(state, digest)) is None:
+        reference = _metadata_reference(state, metadata_digest)
+        upload = decode(reference)
+        metadata = metadata_of(upload)
+    else:
+        reference = None
+        metadata = latest[0].metadata
+    if metadata_digest is not None:
+        metadata_digest = _metadata_digest(metadata, reference)
+
+    def write() -> WriteResult:
+        if upload is None and _refresh_upload(state, digest):
+            result = refreshed
+        else:
+            result = store(
+                decode(
+                    None
+                    if metadata_digest is None
+                    else MetadataReference(metadata_digest, metadata)
+                )
+                if upload is None
+                else upload
+            )
+        if metadata_digest is not None:
+            state.metadata_digest_queue.put(
+                MetadataDigest(digest=metadata_digest, metadata=metadata)
+            )
+        return result
+
+    return state.ingestion_writer.submit(write, size=size), metadata, metadata_digest
+
+
+def _upload_response(
+    state: State,
+    metadata: NodeCollectorMetadata,
+    metadata_digest: Optional[str],
+    response: Optional[UploadResponse] = None,
+) -> UploadResponse:
+    """Response to an upload, with the phase the node collector should upload
+    at, and the digest of its metadata, which the cluster collector now
+    knows"""
+    return (response or UploadResponse()).model_copy(
+        update={
+            "upload_phase": state.upload_phases.phase(metadata_key(metadata)),
+            "metadata_digest": metadata_digest,
+        }
+    )
+
+
+def _store_machine_sections(
+    state: State,
+    metadata: NodeCollectorMetadata,
+    machine_sections: RawMachineSections,
+    digest: str,
+) -> None:
+    compressed = compress_machine_sections(
+        machine_sections, state.machine_sections_encoding
+    )
+    state.node_collector_metadata_queue.put(metadata)
+    state.machine_sections_queue.put(compressed)
+    _remember_upload(state, digest, metadata, machine_sections=[compressed])
+    if state.subscription_hub:
+        state.subscription_hub.publish(
+            SubscriptionEvent(
+                "machine_sections",
+                decode_machine_sections(machine_sections).model_dump_json(),
+            )
+        )
+
+
+@_requesting_metadata
+def update_machine_sections(
+    state: State, body: bytes, metadata_digest: Optional[str]
+) -> UploadResponse:
+    """Ingest a JSON encoded MachineSectionsCollection"""
+    digest = _upload_digest(
+        b"update_machine_sections", (metadata_digest or "").encode("utf-8"), body
+    )
+    _future, metadata, metadata_digest = _ingest(
+        state,
+        digest,
+        partial(_decode_upload, MachineSectionsCollection, body),
+        lambda machine_sections: _store_machine_sections(
+            state,
+            machine_sections.metadata,
+            RawMachineSections(
+                node_name=machine_sections.sections.node_name,
+                sections=machine_sections.sections.sections.encode("utf-8"),
+            ),
+            digest,
+        ),
+        metadata_digest=metadata_digest,
+        refreshed=None,
+        size=len(body),
+    )
+    return _upload_response(state, metadata, metadata_digest)
+
+
+def _decode_node_collector_metadata(
+    node_collector_metadata: Optional[str],
+    reference: Optional[MetadataReference],
+) -> NodeCollectorMetadata:
+    if node_collector_metadata is None:
+        if reference is None:
+            raise RequestValidationError(
+                [
+                    {
+                        "type": "missing",
+                        "loc": ("header", "Checkmk-Node-Collector-Metadata"),
+                        "msg": "Field required",
+                        "input": None,
+                    }
+                ]
+            )
+        return reference.resolve()
+    try:
+        return NodeCollectorMetadata.model_validate_json(node_collector_metadata)
+    except pydantic.ValidationError as exception:
+        raise RequestValidationError(
+            exception.errors(include_url=False), body=node_collector_metadata
+        ) from exception
+
+
+@_requesting_metadata
+def update_machine_sections_raw(
+    state: State,
+    node_collector_metadata: Optional[str],
+    body: bytes,
+    metadata_digest: Optional[str],
+) -> UploadResponse:
+    """Ingest plain Checkmk agent output, with the metadata of the node
+    collector from the Checkmk-Node-Collector-Metadata header"""
+    digest = _upload_digest(
+        b"update_machine_sections_raw",
+        (node_collector_metadata or "").encode("utf-8"),
+        (metadata_digest or "").encode("utf-8"),
+        body,
+    )
+    _future, metadata, metadata_digest = _ingest(
+        state,
+        digest,
+        partial(_decode_node_collector_metadata, node_collector_metadata),
+        lambda metadata: _store_machine_sections(
+            state,
+            metadata,
+            RawMachineSections(node_name=metadata.node, sections=body),
+            digest,
+        ),
+        metadata_digest=metadata_digest,
+        refreshed=None,
+        size=len(body),
+        metadata_of=lambda metadata: metadata,
+    )
+    return _upload_response(state, metadata, metadata_digest)
+
+
+def _store_container_metrics(
+    state: State,
+    metadata: NodeCollectorMetadata,
+    container_metrics: Sequence[ContainerMetric],
+    digest: str,
+    container_series: Optional[NodeContainerSeries] = None,
+) -> None:
+    state.node_collector_metadata_queue.put(metadata)
+    repeated = repeated_series(container_metrics, container_metric_key)
+    # The rates of the upload, including those kept from earlier uploads if
+    # the counter has no newer sample
+    rates: List[ContainerMetricRate] = []
+    for metric in container_metrics:
+        previous = state.container_metric_queue.replace(metric)
+        key = container_metric_key(metric)
+        if key in repeated:
+            continue
+        if previous is not None and (rate := counter_rate(previous, metric)):
+            state.container_metric_rate_queue.put(rate)
+        else:
+            rate = state.container_metric_rate_queue.find(key)
+        if rate is not None:
+            rates.append(rate)
+    _remember_upload(
+        state,
+        digest,
+        metadata,
+        container_metrics=container_metrics,
+        container_metric_rates=rates,
+        container_series=container_series,
+    )
+    if state.subscription_hub:
+        state.subscription_hub.publish(
+            SubscriptionEvent(
+                "container_metrics",
+                ContainerMetricsUpdate(
+                    node=metadata.node,
+                    container_metrics=container_metrics,
+                ).model_dump_json(),
+            )
+        )
+
+
+@_requesting_metadata
+def update_container_metrics(
+    state: State, body: bytes, metadata_digest: Optional[str]
+) -> UploadResponse:
+    """Ingest a JSON encoded MetricCollection"""
+    digest = _upload_digest(
+        b"update_container_metrics", (metadata_digest or "").encode("utf-8"), body
+    )
+    _future, metadata, metadata_digest = _ingest(
+        state,
+        digest,
+        partial(_decode_upload, MetricCollection, body),
+        lambda metrics: _store_container_metrics(
+            state, metrics.metadata, metrics.container_metrics, digest
+        ),
+        metadata_digest=metadata_digest,
+        refreshed=None,
+        size=len(body),
+    )
+    return _upload_response(state, metadata, metadata_digest)
+
+
+@_requesting_metadata
+def update_container_metrics_v2(
+    state: State, body: bytes, metadata_digest: Optional[str]
+) -> UploadResponse:
+    """Ingest a JSON encoded MetricTableCollection"""
+    digest = _upload_digest(
+        b"v2/update_container_metrics", (metadata_digest or "").encode("utf-8"), body
+    )
+    _future, metadata, metadata_digest = _ingest(
+        state,
+        digest,
+        partial(_decode_upload, MetricTableCollection, body),
+        lambda metrics: _store_container_metrics(
+            state,
+            metrics.metadata,
+            decode_metric_table(metrics.container_metrics),
+            digest,
+        ),
+        metadata_digest=metadata_digest,
+        refreshed=None,
+        size=len(body),
+    )
+    return _upload_response(state, metadata, metadata_digest)
+
+
+def _merge_container_metric_delta(
+    state: State, delta: ContainerMetricDelta, digest: str
+) -> UploadResponse:
+    node_series = merge_delta(
+        state.container_series_queue.find(delta.metadata.node), delta
+    )
+    if node_series is None:
+        return UploadResponse(keyframe_required=True)
+    state.container_series_queue.put(node_series)
+    _store_container_metrics(
+        state, delta.metadata, node_container_metrics(node_series), digest, node_series
+    )
+    return UploadResponse()
+
+
+@_requesting_metadata
+def update_container_metric_deltas(
+    state: State, body: bytes, metadata_digest: Optional[str]
+) -> UploadResponse:
+    """Ingest a JSON encoded ContainerMetricDelta, once it is merged"""
+    # Unlike other uploads, deltas are only acknowledged once they are merged:
+    # the response tells whether the merge succeeded.
+    digest = _upload_digest(
+        b"v2/update_container_metric_deltas",
+        (metadata_digest or "").encode("utf-8"),
+        body,
+    )
+    future, metadata, metadata_digest = _ingest(
+        state,
+        digest,
+        partial(_decode_upload, ContainerMetricDelta, body),
+        partial(_merge_container_metric_delta, state, digest=digest),
+        metadata_digest=metadata_digest,
+        # A retry of the upload merged last
+        refreshed=UploadResponse(),
+        size=len(body),
+    )
+    return _upload_response(state, metadata, metadata_digest, future.result())
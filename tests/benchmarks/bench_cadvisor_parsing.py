@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright (C) 2021 Checkmk GmbH - License: GNU General Public License v2
+# This file is part of Checkmk (https://checkmk.com). It is subject to the
+# terms and conditions defined in the file COPYING, which is part of this
+# source code package.
+
+"""CPU time of parsing the cAdvisor response of a node with the single pass
+tokenizer of the node collector versus the regex based parser it replaced,
+and with the label sets memoized from the previous response, also in a
+cache of fewer label sets than the response has. The same lines are also
+scanned by a pool of WORKERS workers.
+
+Usage: python tests/benchmarks/bench_cadvisor_parsing.py [PODS] [WORKERS]"""
+
+import json
+import random
+import re
+import sys
+import time
+import uuid
+from functools import partial
+from typing import Callable, Dict, List, Tuple
+
+from checkmk_kube_agent.content_encoding import CADVISOR_METRIC_NAMES
+from checkmk_kube_agent.prometheus_text import parsing_pool
+from checkmk_kube_agent.send_metrics import (
+    LabelSetCache,
+    iter_cadvisor_metrics,
+    parse_raw_response,
+)
+from checkmk_kube_agent.type_defs import ContainerMetric, Timestamp
+
+REPETITIONS = 10
+
+# Metric name, labels, value and timestamp in milliseconds
+Series = Tuple[str, Dict[str, str], int, int]
+
+
+def cadvisor_series(pods: int) -> List[Series]:
+    """Series of a node running `pods` pods with two containers each. Like
+    the real thing, every series carries all labels of its container,
+    including the JSON encoded annotations, and the series are grouped by
+    metric."""
+    rng = random.Random(0)
+    containers = []
+    for pod in range(pods):
+        pod_uid = str(uuid.UUID(int=rng.getrandbits(128)))
+        pod_name = f"workload-{pod}-{rng.getrandbits(32):08x}"
+        ports = json.dumps(
+            [{"name": "http", "containerPort": 8080, "protocol": "TCP"}],
+            separators=(",", ":"),
+        )
+        for container in ("POD", "app"):
+            labels = {
+                "container_label_annotation_io_kubernetes_container_hash": "5c3e8a2f",
+                "container_label_annotation_io_kubernetes_container_ports": ports,
+                "container_label_annotation_io_kubernetes_container_"
+                "terminationMessagePath": "/dev/termination-log",
+                "container_label_io_kubernetes_container_name": container,
+                "container_label_io_kubernetes_docker_type": "container",
+                "container_label_io_kubernetes_pod_name": pod_name,
+                "container_label_io_kubernetes_pod_namespace": "default",
+                "container_label_io_kubernetes_pod_uid": pod_uid,
+                "id": f"/kubepods/burstable/pod{pod_uid}/{rng.getrandbits(64):016x}",
+                "image": "registry.example.com/workload:1.0",
+                "name": f"k8s_{container}_{pod_name}_default_{pod_uid}_0",
+            }
+            containers.append(labels)
+    return [
+        (
+            metric_name,
+            labels,
+            rng.randint(0, 10**9),
+            int(time.time() * 1000),
+        )
+        for metric_name in CADVISOR_METRIC_NAMES
+        for labels in containers
+    ]
+
+
+def cadvisor_response(series: List[Series]) -> str:
+    """The series in the text exposition format"""
+    lines = ["# HELP cadvisor_version_info A metric with a constant '1' value"]
+    for metric_name, labels, value, timestamp_ms in series:
+        raw_labels = ",".join(
+            f"{name}={json.dumps(label)}" for name, label in labels.items()
+        )
+        lines.append(f"{metric_name}{{{raw_labels}}} {value} {timestamp_ms}")
+    return "\n".join(lines) + "\n"
+
+
+def legacy_parse_raw_response(raw_response: str) -> List[Dict[str, str]]:
+    """The parser before the tokenizer: split off the labels at the braces,
+    split them at commas outside of quotes and decode every value as JSON"""
+    metrics = []
+    for open_metric in raw_response.split("\n"):
+        if "{" not in open_metric:
+            continue
+        _metric_name, rest = open_metric.split("{", 1)
+        labels_string, _timestamped_value = rest.rsplit("}", 1)
+        labels = {}
+        for label in re.split(r",(?=(?:[^\"]*\"[^\"]*\")*[^\"]*$)", labels_string):
+            if label:
+                label_name, label_value = label.split("=")
+                labels[label_name] = json.loads(label_value)
+        metrics.append(labels)
+    return metrics
+
+
+def timed(function: Callable[[], object]) -> float:
+    """Average duration of a function call in milliseconds"""
+    start = time.perf_counter()
+    for _ in range(REPETITIONS):
+        function()
+    return (time.perf_counter() - start) / REPETITIONS * 1000
+
+
+def timed_memoized(
+    parse: Callable[[LabelSetCache], object], maxsize: int = 4096
+) -> float:
+    """Average duration of a parse in milliseconds, with the label sets
+    memoized from a previous response in a cache of `maxsize` label sets"""
+    label_sets = LabelSetCache(maxsize)
+    parse(label_sets)
+    return timed(partial(parse, label_sets))
+
+
+def print_timing(name: str, milliseconds: float, baseline: float = 0.0) -> None:
+    """Print one row of the results, with the speedup over `baseline`"""
+    speedup = f" {baseline / milliseconds:>6.1f}x" if baseline else ""
+    print(f"{name:>10} {milliseconds:>9.2f}ms{speedup}")
+
+
+def main() -> None:
+    """Print CPU time per parser"""
+    pods = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    pool = parsing_pool(int(sys.argv[2]) if len(sys.argv) > 2 else 4, 0)
+    series = cadvisor_series(pods)
+    raw_response = cadvisor_response(series)
+    now = Timestamp(time.time())
+
+    def parse_in_pool() -> List[ContainerMetric]:
+        encoded = raw_response.encode("utf-8")
+        return list(
+            iter_cadvisor_metrics(
+                (
+                    encoded[index : index + 65536]
+                    for index in range(0, len(encoded), 65536)
+                ),
+                now,
+                pool=pool,
+            )
+        )
+
+    print(
+        f"cAdvisor response of {pods} pods: {raw_response.count(chr(10))} lines, "
+        f"{len(raw_response)} characters"
+    )
+    assert len(parse_raw_response(raw_response, now)) == len(
+        legacy_parse_raw_response(raw_response)
+    )
+    assert parse_in_pool() == parse_raw_response(raw_response, now)
+    legacy_ms = timed(lambda: legacy_parse_raw_response(raw_response))
+    print_timing("regex", legacy_ms)
+    print_timing(
+        "tokenizer", timed(lambda: parse_raw_response(raw_response, now)), legacy_ms
+    )
+    print_timing(
+        "memoized",
+        timed_memoized(partial(parse_raw_response, raw_response, now)),
+        legacy_ms,
+    )
+    print_timing(
+        "> maxsize",
+        # Half as many as there are label sets
+        timed_memoized(partial(parse_raw_response, raw_response, now), maxsize=pods),
+        legacy_ms,
+    )
+    print_timing("pool", timed(parse_in_pool), legacy_ms)
+
+
+if __name__ == "__main__":
+    main()
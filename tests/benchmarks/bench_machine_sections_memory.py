@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright (C) 2021 Checkmk GmbH - License: GNU General Public License v2
+# This file is part of Checkmk (https://checkmk.com). It is subject to the
+# terms and conditions defined in the file COPYING, which is part of this
+# source code package.
+
+"""Memory held by the machine sections cache of the cluster collector, per
+content coding the sections are stored with.
+
+Usage: python tests/benchmarks/bench_machine_sections_memory.py [NODES]"""
+
+import random
+import sys
+import time
+import tracemalloc
+
+from checkmk_kube_agent.content_encoding import supported_encodings
+from checkmk_kube_agent.dedup_ttl_cache import DedupTTLCache
+from checkmk_kube_agent.machine_sections import compress_machine_sections
+from checkmk_kube_agent.type_defs import (
+    CompressedMachineSections,
+    ContentEncoding,
+    NodeName,
+    RawMachineSections,
+)
+
+
+def agent_output(rng: random.Random) -> bytes:
+    """Synthetic output of the Checkmk Linux agent of a Kubernetes node"""
+    lines = ["<<<check_mk>>>", "Version: 2.4.0p1", "AgentOS: linux"]
+    lines.append("<<<df>>>")
+    for i in range(40):
+        lines.append(
+            f"/dev/sda{i} ext4 {rng.randint(10**6, 10**8)} "
+            f"{rng.randint(10**5, 10**7)} {rng.randint(10**5, 10**7)} "
+            f"{rng.randint(1, 99)}% /var/lib/kubelet/pods/{rng.getrandbits(128):032x}"
+        )
+    lines.append("<<<lnx_cpuinfo:sep(58)>>>")
+    for cpu in range(32):
+        lines.extend(
+            [
+                f"processor\t: {cpu}",
+                "vendor_id\t: GenuineIntel",
+                "model name\t: Intel(R) Xeon(R) Platinum 8375C CPU @ 2.90GHz",
+                f"cpu MHz\t\t: {rng.uniform(2800, 3500):.3f}",
+                "cache size\t: 55296 KB",
+                "flags\t\t: fpu vme de pse tsc msr pae mce cx8 apic sep mtrr pge "
+                "mca cmov pat pse36 clflush mmx fxsr sse sse2 ss ht syscall nx",
+            ]
+        )
+    lines.append("<<<kernel>>>")
+    lines.append(str(int(time.time())))
+    for counter in ("nr_free_pages", "pgpgin", "pgpgout", "pswpin", "pswpout"):
+        lines.append(f"{counter} {rng.randint(0, 10**9)}")
+    for cpu in range(32):
+        lines.append(
+            f"cpu{cpu} " + " ".join(str(rng.randint(0, 10**7)) for _ in range(10))
+        )
+    lines.append("<<<ps_lnx>>>")
+    for pid in range(300):
+        lines.append(
+            f"(root,{rng.randint(10**4, 10**6)},{rng.randint(10**3, 10**5)},"
+            f"00:00:{rng.randint(0, 59):02d}/{rng.randint(10, 10**5)},{pid}) "
+            "/usr/bin/containerd-shim-runc-v2 -namespace k8s.io -id "
+            f"{rng.getrandbits(256):064x}"
+        )
+    return ("\n".join(lines) + "\n").encode("utf-8")
+
+
+def held_memory(nodes: int, encoding: ContentEncoding) -> int:
+    """Memory allocated by a cache holding the sections of all nodes"""
+    rng = random.Random(0)
+    outputs = [
+        RawMachineSections(NodeName(f"node-{i}"), agent_output(rng))
+        for i in range(nodes)
+    ]
+
+    tracemalloc.start()
+    cache = DedupTTLCache[NodeName, CompressedMachineSections](
+        key=lambda x: x.node_name, maxsize=10000, ttl=120
+    )
+    for output in outputs:
+        cache.put(compress_machine_sections(output, encoding))
+    held, _peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return held
+
+
+def main() -> None:
+    """Print memory held per content coding"""
+    nodes = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    print(f"Machine sections cache holding {nodes} nodes")
+    for encoding in supported_encodings():
+        start = time.perf_counter()
+        held = held_memory(nodes, encoding)
+        print(
+            f"{encoding.value:>10}: {held / 2**20:8.1f} MiB "
+            f"({time.perf_counter() - start:.1f}s incl. setup)"
+        )
+
+
+if __name__ == "__main__":
+    main()
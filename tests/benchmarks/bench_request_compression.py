@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright (C) 2021 Checkmk GmbH - License: GNU General Public License v2
+# This file is part of Checkmk (https://checkmk.com). It is subject to the
+# terms and conditions defined in the file COPYING, which is part of this
+# source code package.
+
+"""Bytes on the wire versus CPU time of compressing container metrics uploads
+on the node collector and decompressing them on the cluster collector.
+
+Usage: python tests/benchmarks/bench_request_compression.py [PODS]"""
+
+import random
+import sys
+import time
+import uuid
+from functools import partial
+from typing import Callable, Optional
+
+from checkmk_kube_agent.content_encoding import (
+    CADVISOR_METRIC_NAMES,
+    METRIC_NAMES_DICTIONARY,
+    ZSTD,
+    decompress_bounded,
+)
+from checkmk_kube_agent.type_defs import (
+    CheckmkKubeAgentMetadata,
+    CollectorType,
+    Components,
+    ContainerMetric,
+    ContainerName,
+    ContentEncoding,
+    HostName,
+    LabelValue,
+    MetricCollection,
+    MetricName,
+    MetricValueString,
+    Namespace,
+    NodeCollectorMetadata,
+    NodeName,
+    OsName,
+    PlatformMetadata,
+    PodName,
+    PodUid,
+    PythonCompiler,
+    Timestamp,
+    Version,
+)
+from checkmk_kube_agent.upload_requests import encode_request_body
+
+REPETITIONS = 20
+
+
+def metric_collection(pods: int) -> bytes:
+    """Upload of a node running `pods` pods with two containers each"""
+    rng = random.Random(0)
+    now = Timestamp(time.time())
+    container_metrics = []
+    for pod in range(pods):
+        pod_uid = str(uuid.UUID(int=rng.getrandbits(128)))
+        pod_name = f"workload-{pod}-{rng.getrandbits(32):08x}"
+        for container in ("POD", "app"):
+            for metric_name in CADVISOR_METRIC_NAMES:
+                container_metrics.append(
+                    ContainerMetric(
+                        container_name=ContainerName(
+                            LabelValue(
+                                f"k8s_{container}_{pod_name}_default_{pod_uid}_0"
+                            )
+                        ),
+                        namespace=Namespace(LabelValue("default")),
+                        pod_uid=PodUid(LabelValue(pod_uid)),
+                        pod_name=PodName(LabelValue(pod_name)),
+                        metric_name=MetricName(metric_name),
+                        metric_value_string=MetricValueString(
+                            str(rng.randint(0, 10**9))
+                        ),
+                        timestamp=now,
+                    )
+                )
+    return (
+        MetricCollection(
+            container_metrics=container_metrics,
+            metadata=NodeCollectorMetadata(
+                node=NodeName("node"),
+                host_name=HostName("host"),
+                container_platform=PlatformMetadata(
+                    os_name=OsName("alpine"),
+                    os_version=Version("3.19"),
+                    python_version=Version("3.14.0"),
+                    python_compiler=PythonCompiler("GCC"),
+                ),
+                checkmk_kube_agent=CheckmkKubeAgentMetadata(
+                    project_version=Version("1.0.0")
+                ),
+                collector_type=CollectorType.CONTAINER_METRICS,
+                components=Components(cadvisor_version=Version("v0.49.1")),
+            ),
+        )
+        .model_dump_json()
+        .encode("utf-8")
+    )
+
+
+def timed(function: Callable[[], object]) -> float:
+    """Average duration of a function call in milliseconds"""
+    start = time.perf_counter()
+    for _ in range(REPETITIONS):
+        function()
+    return (time.perf_counter() - start) / REPETITIONS * 1000
+
+
+def main() -> None:
+    """Print size and CPU time per content coding"""
+    pods = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    body = metric_collection(pods)
+    print(f"Container metrics upload of {pods} pods: {len(body)} bytes")
+    print(f"{'':>16} {'bytes':>10} {'ratio':>7} {'compress':>10} {'decompress':>11}")
+
+    variants: list[tuple[str, ContentEncoding, Optional[str]]] = [
+        ("identity", ContentEncoding.IDENTITY, None),
+        ("gzip", ContentEncoding.GZIP, None),
+    ]
+    if ZSTD is not None:
+        variants += [
+            ("zstd", ContentEncoding.ZSTD, None),
+            ("zstd+dictionary", ContentEncoding.ZSTD, METRIC_NAMES_DICTIONARY),
+        ]
+
+    for name, encoding, dictionary in variants:
+        compressed, _headers = encode_request_body(body, encoding, dictionary)
+        compress_ms = timed(partial(encode_request_body, body, encoding, dictionary))
+        decompress_ms = timed(
+            partial(
+                decompress_bounded,
+                compressed,
+                encoding,
+                max_size=len(body),
+                zstd_dictionary=dictionary,
+            )
+        )
+        print(
+            f"{name:>16} {len(compressed):>10} {len(body) / len(compressed):>6.1f}x "
+            f"{compress_ms:>8.2f}ms {decompress_ms:>9.2f}ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
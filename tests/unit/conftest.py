@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright (C) 2021 Checkmk GmbH - License: GNU General Public License v2
+# This file is part of Checkmk (https://checkmk.com). It is subject to the
+# terms and conditions defined in the file COPYING, which is part of this
+# source code package.
+
+"""Fixtures shared by the unit tests."""
+
+import pytest
+from fastapi.testclient import TestClient
+
+from checkmk_kube_agent.api import (
+    _init_app_state,
+    app,
+    authenticate_get,
+    authenticate_post,
+)
+from checkmk_kube_agent.type_defs import (
+    CheckmkKubeAgentMetadata,
+    CollectorMetadata,
+    CollectorType,
+    Components,
+    ContainerMetric,
+    ContainerName,
+    ContentEncoding,
+    HostName,
+    LabelValue,
+    MachineSections,
+    MachineSectionsCollection,
+    MetricCollection,
+    MetricName,
+    MetricValueString,
+    Namespace,
+    NodeCollectorMetadata,
+    NodeName,
+    OsName,
+    PlatformMetadata,
+    PodName,
+    PodUid,
+    PythonCompiler,
+    Timestamp,
+    Version,
+)
+
+
+@pytest.fixture(name="collector_metadata")
+def fixture_collector_metadata() -> CollectorMetadata:
+    """Example cluster metadata"""
+    return CollectorMetadata(
+        node=NodeName("nebukadnezar"),
+        host_name=HostName("morpheus"),
+        container_platform=PlatformMetadata(
+            os_name=OsName("alpine"),
+            os_version=Version("3.15"),
+            python_version=Version("3.9.9"),
+            python_compiler=PythonCompiler("GCC"),
+        ),
+        checkmk_kube_agent=CheckmkKubeAgentMetadata(
+            project_version=Version("1.0.0"),
+        ),
+    )
+
+
+@pytest.fixture(name="metadata")
+def fixture_node_collector_metadata() -> NodeCollectorMetadata:
+    """Metadata of a container metrics node collector"""
+    return NodeCollectorMetadata(
+        node=NodeName("node"),
+        host_name=HostName("host"),
+        container_platform=PlatformMetadata(
+            os_name=OsName("alpine"),
+            os_version=Version("3"),
+            python_version=Version("3.14"),
+            python_compiler=PythonCompiler("GCC"),
+        ),
+        checkmk_kube_agent=CheckmkKubeAgentMetadata(project_version=Version("1")),
+        collector_type=CollectorType.CONTAINER_METRICS,
+        components=Components(cadvisor_version=Version("v0.43.0")),
+    )
+
+
+@pytest.fixture(name="cache_ttl")
+def fixture_cache_ttl() -> int:
+    """Time to live of the cache entries of the cluster collector"""
+    return 120
+
+
+@pytest.fixture(name="cluster_collector_client")
+def fixture_cluster_collector_client(
+    collector_metadata: CollectorMetadata,
+    cache_ttl: int,
+) -> TestClient:
+    """Cluster collector API test client"""
+    _init_app_state(
+        app,
+        cache_maxsize=100,
+        cache_ttl=cache_ttl,
+        auth_cache_ttl=60,
+        ingestion_queue_size=100,
+        ingestion_group_window=0.005,
+        max_in_flight_uploads=100,
+        max_queued_upload_bytes=1024 * 1024,
+        subscription_buffer_size=10,
+        machine_sections_encoding=ContentEncoding.GZIP,
+        max_request_body_size=1024 * 1024,
+        reader_whitelist=["checkmk-monitoring:checkmk-server"],
+        writer_whitelist=["checkmk-monitoring:node-collector"],
+        tcp_timeout=(10, 12),
+        static_metadata=collector_metadata,
+    )
+
+    def authenticate_with_empty_token() -> str:
+        return ""
+
+    app.dependency_overrides[authenticate_post] = authenticate_with_empty_token
+    app.dependency_overrides[authenticate_get] = authenticate_with_empty_token
+
+    return TestClient(app)
+
+
+@pytest.fixture(name="metric_collection")
+def fixture_metric_collection(
+    collector_metadata: CollectorMetadata,
+) -> MetricCollection:
+    """Metrics data sample"""
+    return MetricCollection(
+        container_metrics=[
+            ContainerMetric(
+                container_name=ContainerName(
+                    LabelValue(
+                        "k8s_checkmk-cluster-agent_checkmk-cluster-agent-"
+                        "5c645c445f-tp44q_checkmk-monitoring_cf703718-71a1-"
+                        "41de-8026-b52d3195229b_0"
+                    )
+                ),
+                namespace=Namespace(LabelValue("checkmk-monitoring")),
+                pod_uid=PodUid(LabelValue("cf703718-71a1-41de-8026-b52d3195229b")),
+                pod_name=PodName(LabelValue("checkmk-cluster-agent-5c645c445f-tp44q")),
+                metric_name=MetricName("container_cpu_cfs_periods_total"),
+                metric_value_string=MetricValueString("4783"),
+                timestamp=Timestamp(0.0),
+            ),
+            ContainerMetric(
+                container_name=ContainerName(
+                    LabelValue(
+                        "k8s_POD_checkmk-worker-agent-8x8bt_checkmk-monitoring"
+                        "_f560ac4c-2dd6-4d2e-8044-caaf6873ce93_0"
+                    )
+                ),
+                namespace=Namespace(LabelValue("checkmk-monitoring")),
+                pod_uid=PodUid(LabelValue("f560ac4c-2dd6-4d2e-8044-caaf6873ce93")),
+                pod_name=PodName(LabelValue("checkmk-worker-agent-8x8bt")),
+                metric_name=MetricName("container_memory_cache"),
+                metric_value_string=MetricValueString("0"),
+                timestamp=Timestamp(0.0),
+            ),
+            ContainerMetric(
+                container_name=ContainerName(
+                    LabelValue(
+                        "k8s_kube-scheduler_kube-scheduler-k8_kube-system_"
+                        "b58645c4b948b3629f3b7cc9f5fdde56_0"
+                    )
+                ),
+                namespace=Namespace(LabelValue("kube-system")),
+                pod_uid=PodUid(LabelValue("b58645c4b948b3629f3b7cc9f5fdde56")),
+                pod_name=PodName(LabelValue("kube-scheduler-k8")),
+                metric_name=MetricName("container_cpu_load_average_10s"),
+                metric_value_string=MetricValueString("0"),
+                timestamp=Timestamp(1638960637.145),
+            ),
+        ],
+        metadata=NodeCollectorMetadata(
+            **dict(collector_metadata),
+            collector_type=CollectorType.CONTAINER_METRICS,
+            components=Components(
+                cadvisor_version=Version("v0.43.0"), checkmk_agent_version=None
+            ),
+        ),
+    )
+
+
+@pytest.fixture(name="machine_sections_collection")
+def fixture_machine_sections_collection(
+    collector_metadata: CollectorMetadata,
+) -> MachineSectionsCollection:
+    """Machine sections example"""
+    return MachineSectionsCollection(
+        sections=MachineSections(
+            node_name=NodeName("unittest_node_name"),
+            sections="<<<section_name>>>\nsection_data 1",
+        ),
+        metadata=NodeCollectorMetadata(
+            **dict(collector_metadata),
+            collector_type=CollectorType.MACHINE_SECTIONS,
+            components=Components(
+                cadvisor_version=None, checkmk_agent_version=Version("2.1.0i1")
+            ),
+        ),
+    )
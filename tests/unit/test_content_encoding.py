@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright (C) 2021 Checkmk GmbH - License: GNU General Public License v2
+# This file is part of Checkmk (https://checkmk.com). It is subject to the
+# terms and conditions defined in the file COPYING, which is part of this
+# source code package.
+
+"""Tests for content codings."""
+
+from typing import Optional
+
+import pytest
+
+from checkmk_kube_agent.content_encoding import (
+    METRIC_NAMES_DICTIONARY,
+    ZSTD,
+    SizeLimitExceeded,
+    compress,
+    compress_stream,
+    decompress,
+    decompress_bounded,
+    supported_encodings,
+)
+from checkmk_kube_agent.type_defs import ContentEncoding
+
+
+@pytest.mark.parametrize("encoding", supported_encodings())
+def test_concatenated_members(encoding: ContentEncoding) -> None:
+    """Separately compressed pieces decompress to their concatenation"""
+    pieces = [b"<<<<node>>>>\n", b"<<<df>>>\n" * 100, b"<<<<>>>>\n"]
+
+    assert decompress(
+        b"".join(compress(piece, encoding) for piece in pieces), encoding
+    ) == b"".join(pieces)
+
+
+@pytest.mark.parametrize("encoding", supported_encodings())
+def test_compress_stream(encoding: ContentEncoding) -> None:
+    """A compressed stream decompresses to the concatenation of its chunks,
+    also when decompressed as a single member or frame"""
+    chunks = [b'{"container_metrics":[', b'{"metric_name":"x"},' * 1000, b"]}"]
+    content = b"".join(chunks)
+
+    assert (
+        decompress_bounded(
+            b"".join(compress_stream(chunks, encoding)),
+            encoding,
+            max_size=len(content),
+        )
+        == content
+    )
+
+
+@pytest.mark.parametrize("encoding", supported_encodings())
+def test_decompress_bounded_concatenated_members(encoding: ContentEncoding) -> None:
+    """All concatenated members or frames are decompressed, within the size
+    limit of their concatenation"""
+    content = compress(b'{"a":', encoding) + compress(b"1}", encoding)
+
+    assert decompress_bounded(content, encoding, max_size=7) == b'{"a":1}'
+    with pytest.raises(SizeLimitExceeded):
+        decompress_bounded(content, encoding, max_size=6)
+
+
+@pytest.mark.parametrize(
+    "encoding",
+    [
+        encoding
+        for encoding in supported_encodings()
+        if encoding is not ContentEncoding.IDENTITY
+    ],
+)
+def test_decompress_bounded_trailing_data(encoding: ContentEncoding) -> None:
+    """Data following the last member or frame is rejected"""
+    with pytest.raises(ValueError):
+        decompress_bounded(
+            compress(b"ok", encoding) + b"garbage", encoding, max_size=100
+        )
+
+
+@pytest.mark.skipif(ZSTD is None, reason="Python was built without zstd")
+def test_zstd_is_supported() -> None:
+    """zstd is offered whenever the Python build supports it"""
+    assert ContentEncoding.ZSTD in supported_encodings()
+
+
+def test_unknown_zstd_dictionary() -> None:
+    """Unknown zstd dictionaries are rejected"""
+    with pytest.raises(ValueError) as exception:
+        decompress_bounded(
+            b"",
+            ContentEncoding.ZSTD,
+            max_size=1,
+            zstd_dictionary="unknown",
+        )
+    assert str(exception.value) == "Unknown zstd dictionary: unknown"
+
+
+@pytest.mark.skipif(ZSTD is None, reason="Python was built without zstd")
+@pytest.mark.parametrize("zstd_dictionary", [None, METRIC_NAMES_DICTIONARY])
+def test_zstd_decompress_bounded(zstd_dictionary: Optional[str]) -> None:
+    """zstd content is decompressed up to the size limit, with or without
+    dictionary"""
+    content = b'{"metric_name":"container_memory_cache"}' * 10
+    compressed = compress(
+        content, ContentEncoding.ZSTD, zstd_dictionary=zstd_dictionary
+    )
+
+    assert (
+        decompress_bounded(
+            compressed,
+            ContentEncoding.ZSTD,
+            max_size=len(content),
+            zstd_dictionary=zstd_dictionary,
+        )
+        == content
+    )
+    with pytest.raises(SizeLimitExceeded):
+        decompress_bounded(
+            compressed,
+            ContentEncoding.ZSTD,
+            max_size=len(content) - 1,
+            zstd_dictionary=zstd_dictionary,
+        )
+    with pytest.raises(ValueError):
+        decompress_bounded(
+            compressed[:-1],
+            ContentEncoding.ZSTD,
+            max_size=len(content),
+            zstd_dictionary=zstd_dictionary,
+        )
+    with pytest.raises(ValueError):
+        decompress_bounded(b"foo", ContentEncoding.ZSTD, max_size=len(content))
@@ -113,6 +113,76 @@ def test_add_existing_entry(
     }
 
 
+def test_replace_entry(
+    dedup_ttl_cache: DedupTTLCache,
+    entries: Sequence[Entry],
+) -> None:
+    """Overwritten element is returned by the .replace method"""
+    for entry in entries:
+        assert dedup_ttl_cache.replace(entry) is None
+
+    assert dedup_ttl_cache.replace(Entry(key="fookey", value="aardvark")) == Entry(
+        key="fookey", value="foo"
+    )
+    assert dedup_ttl_cache["fookey"] == Entry(key="fookey", value="aardvark")
+
+
+def test_replace_expired_entry() -> None:
+    """Entries exceeding time to live (seconds) are not returned by the
+    .replace method"""
+    cache = DedupTTLCache[str, str](key=lambda k: k, ttl=1)
+    cache.put("foo")
+    time.sleep(1)
+
+    assert cache.replace("foo") is None
+
+
+def test_find_entry(
+    dedup_ttl_cache: DedupTTLCache,
+    entries: Sequence[Entry],
+) -> None:
+    """Entries are found by their key"""
+    for entry in entries:
+        dedup_ttl_cache.put(entry)
+
+    assert dedup_ttl_cache.find("fookey") == Entry(key="fookey", value="foo")
+    assert dedup_ttl_cache.find("aardvark") is None
+
+
+def test_refresh_entries() -> None:
+    """Refreshing entries resets their time to live, and reports entries that
+    already expired"""
+    cache = DedupTTLCache[str, str](key=lambda k: k, ttl=2)
+    cache.put("foo")
+    cache.put("bar")
+    time.sleep(1)
+
+    assert cache.refresh(["foo"]) is True
+    time.sleep(1.5)
+    assert cache.get_all() == ["foo"]
+    assert cache.refresh(["foo", "bar"]) is False
+    assert cache.get_all() == ["foo"]
+
+
+def test_transaction() -> None:
+    """Expired entries are removed when a transaction starts, and writes of
+    other threads wait for it to finish"""
+    cache = DedupTTLCache[str, str](key=lambda k: k, ttl=1)
+    cache.put("foo")
+    time.sleep(1)
+
+    with cache.transaction():
+        assert cache.currsize == 0
+        writer = Thread(target=cache.put, args=("bar",))
+        writer.start()
+        writer.join(0.1)
+        assert writer.is_alive()
+        cache.put("baz")
+    writer.join()
+
+    assert cache.get_all() == ["baz", "bar"]
+
+
 def test_dedup_ttl_cache_maxsize(
     maxsized_dedup_ttl_cache: DedupTTLCache,
     maxsize_entries: Sequence[str],
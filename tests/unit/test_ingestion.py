@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright (C) 2021 Checkmk GmbH - License: GNU General Public License v2
+# This file is part of Checkmk (https://checkmk.com). It is subject to the
+# terms and conditions defined in the file COPYING, which is part of this
+# source code package.
+
+"""Tests for the ingestion writer."""
+
+from contextlib import contextmanager
+from functools import partial
+from threading import Event
+from typing import Iterator, List
+
+import pytest
+
+from checkmk_kube_agent.ingestion import (
+    AdmissionControl,
+    IngestionOverloaded,
+    IngestionWriter,
+    UploadPhases,
+)
+
+
+def test_invalid_maxsize() -> None:
+    """The ingestion queue has to hold at least one write"""
+    with pytest.raises(ValueError):
+        IngestionWriter(maxsize=0)
+
+
+def test_writes_applied_in_order() -> None:
+    """Writes are applied in the order they were submitted, and their futures
+    resolve to their results"""
+    writer = IngestionWriter(maxsize=10)
+    applied: List[int] = []
+
+    def write(value: int) -> int:
+        applied.append(value)
+        return value
+
+    futures = [writer.submit(partial(write, value)) for value in range(10)]
+    writer.join()
+
+    assert applied == list(range(10))
+    assert [future.result() for future in futures] == list(range(10))
+    writer.stop()
+
+
+def test_failed_write() -> None:
+    """A failing write is reported through its future and does not stop the
+    writer"""
+    writer = IngestionWriter(maxsize=2)
+
+    def fail() -> None:
+        raise RuntimeError("write failed")
+
+    failed = writer.submit(fail)
+    succeeded = writer.submit(lambda: 42)
+
+    with pytest.raises(RuntimeError):
+        failed.result(timeout=5)
+    assert succeeded.result(timeout=5) == 42
+    writer.stop()
+
+
+def test_group_commit() -> None:
+    """Writes queued while the writer is busy are applied as one group, within
+    a single transaction"""
+    transactions: List[List[int]] = []
+
+    @contextmanager
+    def transaction() -> Iterator[None]:
+        transactions.append([])
+        yield
+
+    writer = IngestionWriter(maxsize=5, transaction=transaction)
+    started = Event()
+    blocked = Event()
+
+    def block() -> None:
+        started.set()
+        blocked.wait(5)
+
+    def write(value: int) -> None:
+        transactions[-1].append(value)
+
+    writer.submit(block)
+    started.wait(5)
+    futures = [writer.submit(partial(write, value)) for value in range(3)]
+    blocked.set()
+    writer.join()
+
+    assert transactions == [[], [0, 1, 2]]
+    assert all(future.done() for future in futures)
+    writer.stop()
+
+
+def test_failed_transaction() -> None:
+    """If a transaction fails, all writes of its group fail, and the writer
+    carries on"""
+    fail = True
+
+    @contextmanager
+    def transaction() -> Iterator[None]:
+        if fail:
+            raise RuntimeError("transaction failed")
+        yield
+
+    writer = IngestionWriter(maxsize=5, transaction=transaction)
+    with pytest.raises(RuntimeError):
+        writer.submit(lambda: 42).result(timeout=5)
+
+    fail = False
+    assert writer.submit(lambda: 42).result(timeout=5) == 42
+    writer.stop()
+
+
+def test_health() -> None:
+    """Queued writes are counted until they are applied"""
+    writer = IngestionWriter(maxsize=5)
+    assert writer.health().queue_depth == 0
+
+    blocked = Event()
+    writer.submit(lambda: blocked.wait(5))
+    queued = writer.submit(lambda: None)
+    assert writer.health().queue_depth >= 1
+    assert writer.health().maxsize == 5
+
+    blocked.set()
+    queued.result(timeout=5)
+    health = writer.health()
+    assert health.queue_depth == 0
+    assert health.queued_bytes == 0
+    assert health.lag > 0
+    writer.stop()
+
+
+def test_stop() -> None:
+    """Stopping applies the queued writes, the writer is restarted by the next
+    write"""
+    writer = IngestionWriter(maxsize=5)
+    writer.stop()
+
+    applied: List[str] = []
+    writer.submit(lambda: applied.append("before"))
+    writer.stop()
+    assert applied == ["before"]
+
+    writer.submit(lambda: applied.append("after")).result(timeout=5)
+    assert applied == ["before", "after"]
+    writer.stop()
+
+
+def test_full_queue() -> None:
+    """Writes are rejected instead of waiting while the queue is full"""
+    writer = IngestionWriter(maxsize=1)
+    started = Event()
+    blocked = Event()
+
+    def block() -> None:
+        started.set()
+        blocked.wait(5)
+
+    writer.submit(block, size=10)
+    started.wait(5)
+    writer.submit(lambda: None, size=10)
+    with pytest.raises(IngestionOverloaded) as exception:
+        writer.submit(lambda: None, size=10)
+    assert exception.value.retry_after == 1
+    assert writer.queued_bytes() == 20
+
+    blocked.set()
+    writer.join()
+    assert writer.queued_bytes() == 0
+    writer.stop()
+
+
+def test_admission_in_flight() -> None:
+    """Uploads are rejected while `max_in_flight` uploads are admitted"""
+    admission_control = AdmissionControl(
+        IngestionWriter(maxsize=5), max_in_flight=1, max_queued_bytes=100
+    )
+
+    with admission_control.admit():
+        with pytest.raises(IngestionOverloaded) as exception:
+            admission_control.admit()
+    assert exception.value.retry_after == 1
+
+    with admission_control.admit():
+        pass
+
+
+def test_admission_queued_bytes() -> None:
+    """Received uploads are rejected if they exceed `max_queued_bytes` together
+    with the uploads in the queue of the writer, unless it is empty"""
+    writer = IngestionWriter(maxsize=5)
+    admission_control = AdmissionControl(writer, max_in_flight=10, max_queued_bytes=100)
+    admission_control.accept(1000)
+
+    blocked = Event()
+    writer.submit(lambda: blocked.wait(5), size=60)
+    assert writer.queued_bytes() == 60
+    admission_control.accept(40)
+    with pytest.raises(IngestionOverloaded):
+        admission_control.accept(41)
+
+    blocked.set()
+    writer.join()
+    assert writer.queued_bytes() == 0
+    admission_control.accept(1000)
+    writer.stop()
+
+
+def test_admission_invalid_max_in_flight() -> None:
+    """At least one upload has to be admitted at a time"""
+    with pytest.raises(ValueError):
+        AdmissionControl(
+            IngestionWriter(maxsize=5), max_in_flight=0, max_queued_bytes=100
+        )
+
+
+def test_upload_phases_refresh() -> None:
+    """The known node collectors are looked up again once the refresh
+    interval passed"""
+    known = ["a", "c"]
+    phases = UploadPhases(lambda: known, refresh_interval=3600)
+    assert phases.phase("c") == 0.5
+
+    known.append("b")
+    assert phases.phase("c") == 0.5
+    assert UploadPhases(lambda: known, refresh_interval=0).phase("c") == 2 / 3
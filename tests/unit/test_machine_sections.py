@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright (C) 2021 Checkmk GmbH - License: GNU General Public License v2
+# This file is part of Checkmk (https://checkmk.com). It is subject to the
+# terms and conditions defined in the file COPYING, which is part of this
+# source code package.
+
+"""Tests for machine sections uploaded as plain Checkmk agent output."""
+
+from checkmk_kube_agent.api import app
+from checkmk_kube_agent.type_defs import MachineSectionsCollection
+
+
+def test_machine_sections_raw(
+    cluster_collector_client,
+    machine_sections_collection: MachineSectionsCollection,
+) -> None:
+    """Write plain agent output into machine sections queue, then read it
+    again as agent output with piggyback headers, and as JSON."""
+
+    response = cluster_collector_client.post(
+        "/update_machine_sections_raw",
+        headers={
+            "Authorization": "Bearer superdupertoken",
+            "Content-Type": "text/plain",
+            "Checkmk-Node-Collector-Metadata": (
+                machine_sections_collection.metadata.model_dump_json()
+            ),
+        },
+        content=b"<<<section_name>>>\nsection_data 1\n",
+    )
+    app.state.ingestion_writer.join()
+    assert response.status_code == 200
+    assert response.json() == {
+        "keyframe_required": False,
+        "metadata_required": False,
+        "metadata_digest": None,
+        "upload_phase": 0.0,
+    }
+
+    for accept_encoding in ("gzip", "identity"):
+        response = cluster_collector_client.get(
+            "/machine_sections_raw",
+            headers={
+                "Authorization": "Bearer superdupertoken",
+                "Accept-Encoding": accept_encoding,
+            },
+        )
+        assert response.status_code == 200
+        assert response.headers["Content-Type"] == "text/plain; charset=utf-8"
+        assert response.headers.get("Content-Encoding", "identity") == accept_encoding
+        assert response.content == (
+            b"<<<<nebukadnezar>>>>\n<<<section_name>>>\nsection_data 1\n<<<<>>>>\n"
+        )
+
+    response = cluster_collector_client.get(
+        "/machine_sections",
+        headers={"Authorization": "Bearer superdupertoken"},
+    )
+    assert response.status_code == 200
+    assert response.json() == [
+        {
+            "node_name": "nebukadnezar",
+            "sections": "<<<section_name>>>\nsection_data 1\n",
+        }
+    ]
+
+
+def test_machine_sections_raw_invalid_metadata(cluster_collector_client) -> None:
+    """Invalid node collector metadata of plain agent output is rejected"""
+
+    response = cluster_collector_client.post(
+        "/update_machine_sections_raw",
+        headers={
+            "Authorization": "Bearer superdupertoken",
+            "Content-Type": "text/plain",
+            "Checkmk-Node-Collector-Metadata": "{}",
+        },
+        content=b"<<<section_name>>>\nsection_data 1\n",
+    )
+    app.state.ingestion_writer.join()
+    assert response.status_code == 422
+    assert app.state.machine_sections_queue.size() == 0
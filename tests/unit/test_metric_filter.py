@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright (C) 2021 Checkmk GmbH - License: GNU General Public License v2
+# This file is part of Checkmk (https://checkmk.com). It is subject to the
+# terms and conditions defined in the file COPYING, which is part of this
+# source code package.
+
+"""Tests for the metric filter of node collectors."""
+
+import os
+from pathlib import Path
+
+from checkmk_kube_agent.metric_filter import MetricFilter, load_metric_filter
+
+
+def test_allowlist_and_denylist() -> None:
+    """Only allowed metrics are kept, unless they are denied"""
+    metric_filter = MetricFilter(
+        allow=["container_cpu_*", "container_memory_*"],
+        deny=["container_memory_failures_total"],
+    )
+
+    assert [
+        metric_filter.keep(metric_name)
+        for metric_name in (
+            "container_cpu_usage_seconds_total",
+            "container_memory_cache",
+            "container_memory_failures_total",
+            "container_last_seen",
+            "container_last_seen",
+        )
+    ] == [True, True, False, False, False]
+    assert metric_filter.dropped == {
+        "container_memory_failures_total": 1,
+        "container_last_seen": 2,
+    }
+
+
+def test_load_metric_filter_from_flags(tmp_path: Path) -> None:
+    """Without a metric filter file, the filter is configured by flags, and
+    kept as long as they do not change"""
+    metric_filter = load_metric_filter(
+        [], ["container_spec_*"], str(tmp_path / "missing.json")
+    )
+
+    assert metric_filter.deny == ("container_spec_*",)
+    assert load_metric_filter([], ["container_spec_*"]) is metric_filter
+    assert load_metric_filter([], []) is not metric_filter
+
+
+def test_load_metric_filter_from_file(tmp_path: Path) -> None:
+    """The metric filter file takes precedence over flags, and is read again
+    once it changes"""
+    path = tmp_path / "metric_filter.json"
+    path.write_text('{"deny": ["container_spec_*"]}')
+    os.utime(path, ns=(0, 1))
+
+    metric_filter = load_metric_filter([], ["container_last_seen"], str(path))
+    assert metric_filter.deny == ("container_spec_*",)
+    assert load_metric_filter([], [], str(path)) is metric_filter
+
+    path.write_text('{"allow": ["container_cpu_*"]}')
+    os.utime(path, ns=(0, 2))
+
+    metric_filter = load_metric_filter([], [], str(path))
+    assert (metric_filter.allow, metric_filter.deny) == (("container_cpu_*",), ())
+
+
+def test_load_invalid_metric_filter_file(tmp_path: Path) -> None:
+    """An invalid metric filter file is ignored"""
+    path = tmp_path / "metric_filter.json"
+    path.write_text('{"deny": "container_spec_*"')
+
+    assert load_metric_filter([], ["container_last_seen"], str(path)).deny == (
+        "container_last_seen",
+    )
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright (C) 2021 Checkmk GmbH - License: GNU General Public License v2
+# This file is part of Checkmk (https://checkmk.com). It is subject to the
+# terms and conditions defined in the file COPYING, which is part of this
+# source code package.
+
+"""Tests for the invariants cached across the cycles of node collectors."""
+
+import os
+from pathlib import Path
+from typing import List
+
+from checkmk_kube_agent.container_metadata import (
+    METADATA_DIGEST_HEADER,
+    metadata_digest,
+)
+from checkmk_kube_agent.node_collector_context import NodeCollectorContext
+from checkmk_kube_agent.type_defs import (
+    CollectorMetadata,
+    CollectorType,
+    Components,
+    UploadResponse,
+    Version,
+)
+
+
+def test_token_read_again_once_modified(tmp_path: Path) -> None:
+    """The token is only read again once its file was modified"""
+    path = tmp_path / "token"
+    path.write_text("first")
+    os.utime(path, ns=(0, 1))
+    context = NodeCollectorContext(token_path=str(path))
+
+    assert context.headers() == {"Authorization": "Bearer first"}
+
+    path.write_text("second")
+    os.utime(path, ns=(0, 1))
+    assert context.token() == "first"
+
+    os.utime(path, ns=(0, 2))
+    assert context.token() == "second"
+
+
+def test_metadata_rebuilt_once_components_change(
+    collector_metadata: CollectorMetadata,
+) -> None:
+    """The collector metadata is read once, and the node collector metadata
+    is only rebuilt once its components change"""
+    reads: List[CollectorMetadata] = []
+
+    def read_collector_metadata() -> CollectorMetadata:
+        reads.append(collector_metadata.model_copy())
+        return reads[-1]
+
+    context = NodeCollectorContext(read_collector_metadata=read_collector_metadata)
+    components = Components(cadvisor_version=Version("v0.43.0"))
+
+    metadata = context.metadata(CollectorType.CONTAINER_METRICS, components)
+    assert metadata.node == collector_metadata.node
+    assert metadata.components == components
+    assert (
+        context.metadata(
+            CollectorType.CONTAINER_METRICS,
+            Components(cadvisor_version=Version("v0.43.0")),
+        )
+        is metadata
+    )
+
+    updated = context.metadata(
+        CollectorType.CONTAINER_METRICS,
+        Components(cadvisor_version=Version("v0.44.0")),
+    )
+    assert updated.components.cadvisor_version == Version("v0.44.0")
+    assert len(reads) == 1
+
+
+def test_metadata_acknowledged_by_digest(
+    tmp_path: Path, collector_metadata: CollectorMetadata
+) -> None:
+    """Requests carry the digest of the metadata, which is known to the
+    cluster collector until it changes"""
+    path = tmp_path / "token"
+    path.write_text("token")
+    context = NodeCollectorContext(
+        token_path=str(path), read_collector_metadata=lambda: collector_metadata
+    )
+    assert METADATA_DIGEST_HEADER not in context.headers()
+    assert not context.metadata_known()
+
+    metadata = context.metadata(
+        CollectorType.CONTAINER_METRICS,
+        Components(cadvisor_version=Version("v0.43.0")),
+    )
+    digest = metadata_digest(metadata)
+    assert context.headers()[METADATA_DIGEST_HEADER] == digest
+    context.acknowledge_metadata(UploadResponse(metadata_digest=digest))
+    assert context.metadata_known()
+
+    context.metadata(
+        CollectorType.CONTAINER_METRICS,
+        Components(cadvisor_version=Version("v0.44.0")),
+    )
+    assert not context.metadata_known()
+
+
+def test_cadvisor_version_refreshed_after_interval() -> None:
+    """The version of cAdvisor is only queried again after the interval"""
+    versions = iter([Version("v0.43.0"), Version("v0.44.0")])
+
+    cached = NodeCollectorContext(cadvisor_version_interval=3600)
+    assert cached.cadvisor_version(lambda: next(versions)) == Version("v0.43.0")
+    assert cached.cadvisor_version(lambda: next(versions)) == Version("v0.43.0")
+
+    refreshed = NodeCollectorContext(cadvisor_version_interval=0)
+    assert refreshed.cadvisor_version(lambda: next(versions)) == Version("v0.44.0")
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright (C) 2021 Checkmk GmbH - License: GNU General Public License v2
+# This file is part of Checkmk (https://checkmk.com). It is subject to the
+# terms and conditions defined in the file COPYING, which is part of this
+# source code package.
+
+"""Tests for the polling schedule of node collectors."""
+
+import pytest
+
+from checkmk_kube_agent.polling_schedule import Cycle, PollingSchedule, node_phase
+
+
+def test_cycles_do_not_drift() -> None:
+    """Cycles start on the grid, regardless of how long the previous cycle
+    took"""
+    schedule = PollingSchedule(60, 0.0, now=0.0, wall_time=0.0)
+    start = 0.0
+    for duration in (0.4, 59.9, 12.7, 0.0):
+        cycle = schedule.next_cycle(after=start, now=start + duration)
+        assert cycle == Cycle(start + 60, 0)
+        start = cycle.start
+
+
+def test_grid_aligned_to_epoch() -> None:
+    """Node collectors started at different times share the same grid: both
+    cycles start at the wall time 1035"""
+    first = PollingSchedule(60, 0.25, now=100.0, wall_time=1000.0)
+    second = PollingSchedule(60, 0.25, now=5000.0, wall_time=1033.0)
+
+    assert first.next_cycle(after=100.0, now=100.0) == Cycle(135.0, 0)
+    assert second.next_cycle(after=5000.0, now=5000.0) == Cycle(5002.0, 0)
+
+
+def test_overrun_cycles_are_skipped() -> None:
+    """A cycle overrunning the interval does not cause cycles to be run back
+    to back"""
+    schedule = PollingSchedule(60, 0.0, now=0.0, wall_time=0.0)
+    assert schedule.next_cycle(after=60.0, now=185.0) == Cycle(240.0, 2)
+
+
+def test_adopt_phase() -> None:
+    """A changed phase takes effect with the next cycle"""
+    schedule = PollingSchedule(60, 0.5, now=0.0, wall_time=0.0)
+    assert schedule.next_cycle(after=30.0, now=31.0) == Cycle(90.0, 0)
+
+    schedule.phase = 0.75
+    assert schedule.next_cycle(after=90.0, now=91.0) == Cycle(105.0, 0)
+
+
+def test_node_phase_spread() -> None:
+    """Node phases are spread over the interval"""
+    phases = sorted(node_phase(f"worker-{i}") for i in range(1000))
+    assert phases[0] < 0.01
+    assert phases[-1] > 0.99
+    assert 0.4 < phases[500] < 0.6
+
+
+def test_invalid_interval() -> None:
+    """The interval has to be positive"""
+    with pytest.raises(ValueError):
+        PollingSchedule(0, 0.0, now=0.0, wall_time=0.0)
@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright (C) 2021 Checkmk GmbH - License: GNU General Public License v2
+# This file is part of Checkmk (https://checkmk.com). It is subject to the
+# terms and conditions defined in the file COPYING, which is part of this
+# source code package.
+
+"""Tests for the text exposition format of cAdvisor."""
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, List
+
+from checkmk_kube_agent.prometheus_text import map_in_order, parsing_pool
+
+
+def test_parsing_pool() -> None:
+    """Batches are scanned by the workers of the pool, which is kept"""
+    pool = parsing_pool(2, 0)
+
+    assert [
+        scanned.label_sets
+        for scanned in pool.scan([b'm{name="a"} 1', b'm{id="/",name="b"} 2'])
+    ] == [[{"name": "a"}], [{"name": "b"}]]
+    assert parsing_pool(2, 0) is pool
+
+
+def test_map_in_order_bounded() -> None:
+    """Arguments are only consumed as the results are"""
+    consumed: List[int] = []
+
+    def arguments() -> Iterator[int]:
+        for argument in range(10):
+            consumed.append(argument)
+            yield argument
+
+    with ThreadPoolExecutor(1) as executor:
+        results = map_in_order(executor, str, arguments(), max_pending=3)
+
+        assert next(results) == "0"
+        assert consumed == [0, 1, 2]
@@ -7,21 +7,48 @@
 
 """Tests for Node Collector."""
 
-from typing import Sequence
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event
+from typing import Iterator, List, Optional, Sequence, Tuple, Union
 
 import pytest
+import requests
+from pydantic import BaseModel
 
-from checkmk_kube_agent.send_metrics import parse_arguments, parse_raw_response
+import checkmk_kube_agent.send_metrics
+from checkmk_kube_agent.metric_delta import DeltaEncoder
+from checkmk_kube_agent.metric_filter import MetricFilter
+from checkmk_kube_agent.metric_table import decode_metric_table
+from checkmk_kube_agent.polling_schedule import PollingSchedule
+from checkmk_kube_agent.prometheus_text import ParsingPool
+from checkmk_kube_agent.send_metrics import (
+    LabelSetCache,
+    _run_cycles,
+    iter_cadvisor_metrics,
+    iter_container_metrics,
+    parse_arguments,
+    parse_raw_response,
+)
 from checkmk_kube_agent.type_defs import (
     ContainerMetric,
+    ContainerMetricDelta,
     ContainerName,
     LabelValue,
+    MetricCollection,
     MetricName,
+    MetricTableCollection,
     MetricValueString,
     Namespace,
+    NodeCollectorMetadata,
     PodName,
     PodUid,
     Timestamp,
+    UploadResponse,
+)
+from checkmk_kube_agent.upload_requests import (
+    container_metrics_upload,
+    iter_metric_collection_json,
+    upload_container_metric_delta,
 )
 
 # pylint: disable=redefined-outer-name
@@ -120,6 +147,17 @@ def argv() -> Sequence[str]:
         "--verify-ssl",
         "--ca-cert",
         "/myca",
+        "--raw-machine-sections",
+        "--upload-format",
+        "v2",
+        "--metric-denylist",
+        "container_spec_*",
+        "--metric-denylist",
+        "container_last_seen",
+        "--parsing-workers",
+        "4",
+        "--parallel-parsing-threshold",
+        "1048576",
     ]
 
 
@@ -134,6 +172,13 @@ def test_parse_arguments(argv: Sequence[str]) -> None:
     assert args.max_retries == 20
     assert args.verify_ssl is True
     assert args.ca_cert == "/myca"
+    assert args.raw_machine_sections is True
+    assert args.upload_format == "v2"
+    assert args.metric_allowlist == []
+    assert args.metric_denylist == ["container_spec_*", "container_last_seen"]
+    assert args.metric_filter_file is None
+    assert args.parsing_workers == 4
+    assert args.parallel_parsing_threshold == 1048576
 
 
 def test_parse_raw_response_skip_comments(commentary_text: str) -> None:
@@ -208,3 +253,364 @@ def test_parse_raw_response_system_containers(
             timestamp=Timestamp(1638960636.719),
         )
     ]
+
+
+def test_parse_raw_response_special_characters() -> None:
+    """Label values may contain separators and escaped characters"""
+    assert parse_raw_response(
+        "container_memory_cache{"
+        'container_label_annotation_description="a,b=c} \\"d\\" \\\\",'
+        'container_label_io_kubernetes_pod_name="mypod",'
+        'container_label_io_kubernetes_pod_namespace="mynamespace",'
+        'container_label_io_kubernetes_pod_uid="123",'
+        'name="k8s_POD_mypod_mynamespace_123_0",'
+        "} 42 1638960636719\n",
+        Timestamp(0.0),
+    ) == [
+        ContainerMetric(
+            container_name=ContainerName(LabelValue("k8s_POD_mypod_mynamespace_123_0")),
+            namespace=Namespace(LabelValue("mynamespace")),
+            pod_uid=PodUid(LabelValue("123")),
+            pod_name=PodName(LabelValue("mypod")),
+            metric_name=MetricName("container_memory_cache"),
+            metric_value_string=MetricValueString("42"),
+            timestamp=Timestamp(1638960636.719),
+        )
+    ]
+
+
+def test_parse_raw_response_label_sets(container_metrics: str) -> None:
+    """Memoizing label sets does not change the parsed container metrics, and
+    the label sets of containers which disappeared are evicted"""
+    label_sets = LabelSetCache()
+
+    for _ in range(2):
+        assert parse_raw_response(
+            container_metrics, Timestamp(0.0), label_sets
+        ) == parse_raw_response(container_metrics, Timestamp(0.0))
+        assert len(label_sets) == 2
+
+    parse_raw_response(container_metrics.split("\n")[0], Timestamp(0.0), label_sets)
+    assert len(label_sets) == 1
+
+
+def test_iter_container_metrics(container_metrics: str) -> None:
+    """Lines are parsed as they are received, and the label sets are only
+    swept once all of them are parsed"""
+    received: List[str] = []
+
+    def receive() -> Iterator[str]:
+        for line in container_metrics.splitlines():
+            received.append(line)
+            yield line
+
+    label_sets = LabelSetCache()
+    metrics = iter_container_metrics(receive(), Timestamp(0.0), label_sets)
+
+    assert next(metrics) == parse_raw_response(container_metrics, Timestamp(0.0))[0]
+    assert len(received) == 1
+    assert len(list(metrics)) == 1
+    assert len(received) == 2
+
+    assert len(label_sets) == 2
+    label_sets.sweep()
+    assert len(label_sets) == 0
+
+
+@pytest.mark.parametrize("threshold", [0, 1024 * 1024])
+def test_iter_container_metrics_parallel(
+    commentary_text: str,
+    container_metric_empty_label: str,
+    container_metrics: str,
+    system_container_metrics: str,
+    threshold: int,
+) -> None:
+    """Responses at least as large as the threshold of the pool are scanned
+    by it in batches, into the same container metrics"""
+    raw_response = (
+        commentary_text
+        + container_metric_empty_label
+        + container_metrics
+        + system_container_metrics
+    )
+    encoded = raw_response.encode("utf-8")
+    chunks = [encoded[index : index + 100] for index in range(0, len(encoded), 100)]
+
+    with ThreadPoolExecutor(2) as executor:
+        assert list(
+            iter_cadvisor_metrics(
+                chunks,
+                Timestamp(0.0),
+                metric_filter=MetricFilter(deny=["container_fs_*"]),
+                pool=ParsingPool(executor, 2, threshold, batch_size=200),
+            )
+        ) == parse_raw_response(
+            raw_response,
+            Timestamp(0.0),
+            metric_filter=MetricFilter(deny=["container_fs_*"]),
+        )
+
+
+@pytest.mark.parametrize("batch_size", [1, 2, 1000])
+def test_iter_metric_collection_json(
+    container_metrics: str, metadata: NodeCollectorMetadata, batch_size: int
+) -> None:
+    """The streamed JSON encoding of container metrics is the one of their
+    metric collection"""
+    parsed_metrics = parse_raw_response(container_metrics, Timestamp(0.0))
+
+    assert b"".join(
+        iter_metric_collection_json(
+            iter(parsed_metrics), metadata, batch_size=batch_size
+        )
+    ) == MetricCollection(
+        container_metrics=parsed_metrics, metadata=metadata
+    ).model_dump_json().encode(
+        "utf-8"
+    )
+    assert b"".join(
+        iter_metric_collection_json(iter(parsed_metrics), None, batch_size=batch_size)
+    ) == MetricCollection(
+        container_metrics=parsed_metrics, metadata=metadata
+    ).model_dump_json(
+        exclude={"metadata"}
+    ).encode(
+        "utf-8"
+    )
+
+
+def test_parse_raw_response_metric_filter(container_metrics: str) -> None:
+    """Metrics dropped by the metric filter are discarded and counted"""
+    metric_filter = MetricFilter(deny=["container_fs_*"])
+
+    assert [
+        metric.metric_name
+        for metric in parse_raw_response(
+            container_metrics, Timestamp(0.0), metric_filter=metric_filter
+        )
+    ] == ["container_cpu_cfs_periods_total"]
+    assert metric_filter.dropped == {"container_fs_io_time_seconds_total": 1}
+
+
+def test_label_set_cache_lru(container_metrics: str) -> None:
+    """The least recently used label set is evicted once the cache is full"""
+    label_sets = LabelSetCache(maxsize=1)
+    first, second = container_metrics.splitlines()
+
+    for line in (first, second, second):
+        container = label_sets.container(line, line.index("{") + 1, line.index("}"))
+        assert container is not None
+        assert len(label_sets) == 1
+
+    assert container is not None and container.pod_name == PodName(
+        LabelValue("kube-proxy-kvkls")
+    )
+
+    with pytest.raises(ValueError):
+        LabelSetCache(maxsize=0)
+
+
+def test_label_set_cache_capacity(
+    container_metrics: str, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """Sweeping makes room for all label sets which occurred since the
+    previous sweep, even if there are more than `maxsize`. Once the label sets
+    evicted within the first response are parsed once more, none of them is
+    parsed again."""
+    parsed: List[str] = []
+    parse_container = (
+        checkmk_kube_agent.send_metrics._parse_container  # pylint: disable=protected-access
+    )
+
+    def counting_parse_container(line: str, start: int):
+        parsed.append(line)
+        return parse_container(line, start)
+
+    monkeypatch.setattr(
+        checkmk_kube_agent.send_metrics, "_parse_container", counting_parse_container
+    )
+    label_sets = LabelSetCache(maxsize=1)
+
+    for _ in range(3):
+        parsed.clear()
+        for line in container_metrics.splitlines():
+            label_sets.container(line, line.index("{") + 1, line.index("}"))
+        label_sets.sweep()
+
+    assert not parsed
+    assert len(label_sets) == 2
+
+
+def test_container_metrics_upload_v2(
+    container_metrics: str, metadata: NodeCollectorMetadata
+) -> None:
+    """The v2 upload decodes to the container metrics of the v1 upload"""
+    metrics = parse_raw_response(container_metrics, Timestamp(1.0))
+
+    endpoint, v1 = container_metrics_upload(metrics, metadata, Timestamp(1.0), "v1")
+    assert endpoint == "update_container_metrics"
+    assert isinstance(v1, MetricCollection)
+
+    endpoint, v2 = container_metrics_upload(metrics, metadata, Timestamp(1.0), "v2")
+    assert endpoint == "v2/update_container_metrics"
+    assert isinstance(v2, MetricTableCollection)
+    assert v2.metadata == metadata
+    assert [row[3] for row in v2.container_metrics.rows] == [None, None]
+    assert decode_metric_table(v2.container_metrics) == v1.container_metrics
+
+
+def test_upload_container_metric_delta(
+    container_metrics: str, metadata: NodeCollectorMetadata
+) -> None:
+    """A keyframe is sent right away if the cluster collector cannot merge a
+    delta"""
+    uploads: List[ContainerMetricDelta] = []
+    keyframe_required = [False, True, False]
+
+    def post(endpoint: str, collection: BaseModel) -> bytes:
+        assert endpoint == "v2/update_container_metric_deltas"
+        assert isinstance(collection, ContainerMetricDelta)
+        uploads.append(collection)
+        return (
+            UploadResponse(keyframe_required=keyframe_required.pop(0))
+            .model_dump_json()
+            .encode("utf-8")
+        )
+
+    encoder = DeltaEncoder()
+    for now in (Timestamp(1.0), Timestamp(2.0)):
+        assert upload_container_metric_delta(
+            post,
+            encoder,
+            parse_raw_response(container_metrics, now),
+            metadata,
+            now,
+            keyframe_interval=10,
+        ) == UploadResponse(keyframe_required=False)
+
+    assert [upload.base_sequence for upload in uploads] == [None, 1, None]
+    assert uploads[1].unchanged == [(0, 0), (1, 1)]
+
+
+class FakeClock:  # pylint: disable=too-few-public-methods
+    """Monotonic clock, which only advances when told to"""
+
+    def __init__(self) -> None:
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class FakeEvent(Event):
+    """Event which is set after a number of waits, each of which advances the
+    clock instead of blocking"""
+
+    def __init__(self, clock: FakeClock, waits: int) -> None:
+        super().__init__()
+        self._clock = clock
+        self._waits = waits
+        self.waited: List[float] = []
+
+    def is_set(self) -> bool:
+        return len(self.waited) >= self._waits
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        assert timeout is not None
+        self.waited.append(timeout)
+        self._clock.now += timeout
+        return self.is_set()
+
+
+class FakeWorker:  # pylint: disable=too-few-public-methods
+    """Worker which takes the given seconds per cycle, and then returns the
+    given upload phase or raises the given error"""
+
+    def __init__(
+        self,
+        clock: FakeClock,
+        cycles: Sequence[Tuple[float, Union[Optional[float], Exception]]],
+    ) -> None:
+        self._clock = clock
+        self._cycles = cycles
+        self.started: List[float] = []
+
+    def __call__(self) -> Optional[float]:
+        duration, result = self._cycles[len(self.started)]
+        self.started.append(self._clock.now)
+        self._clock.now += duration
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+def overloaded(retry_after: Optional[str]) -> requests.HTTPError:
+    """Error of an upload the cluster collector rejected as it is overloaded"""
+    response = requests.Response()
+    response.status_code = 429
+    if retry_after is not None:
+        response.headers["Retry-After"] = retry_after
+    return requests.HTTPError(response=response)
+
+
+def test_run_cycles_adopts_phase() -> None:
+    """Cycles start at the phase the cluster collector assigned"""
+    clock = FakeClock()
+    worker = FakeWorker(clock, [(1.0, 0.5), (1.0, None)])
+    terminated = FakeEvent(clock, waits=2)
+
+    _run_cycles(
+        worker,
+        PollingSchedule(60, 0.0, now=0.0, wall_time=0.0),
+        terminated,
+        clock=clock,
+    )
+
+    assert worker.started == [0.0, 30.0]
+    assert terminated.waited == [29.0, 59.0]
+
+
+def test_run_cycles_skips_overrun_cycles(caplog: pytest.LogCaptureFixture) -> None:
+    """Cycles which are due while the worker overruns are skipped"""
+    clock = FakeClock()
+    worker = FakeWorker(clock, [(130.0, None), (1.0, None)])
+    terminated = FakeEvent(clock, waits=2)
+
+    _run_cycles(
+        worker,
+        PollingSchedule(60, 0.0, now=0.0, wall_time=0.0),
+        terminated,
+        clock=clock,
+    )
+
+    assert worker.started == [0.0, 180.0]
+    assert terminated.waited == [50.0, 59.0]
+    assert "skipped 2 cycles" in caplog.text
+
+
+def test_run_cycles_retries_overloaded() -> None:
+    """Uploads rejected with a Retry-After header are retried after the delay
+    the cluster collector asked for, at most one polling interval later, and
+    other errors are raised"""
+    clock = FakeClock()
+    worker = FakeWorker(
+        clock,
+        [
+            (1.0, overloaded("3")),
+            (1.0, overloaded("300")),
+            (1.0, None),
+            (1.0, overloaded(None)),
+        ],
+    )
+    terminated = FakeEvent(clock, waits=4)
+
+    with pytest.raises(requests.HTTPError):
+        _run_cycles(
+            worker,
+            PollingSchedule(60, 0.0, now=0.0, wall_time=0.0),
+            terminated,
+            clock=clock,
+        )
+
+    assert worker.started == [0.0, 4.0, 65.0, 120.0]
+    assert terminated.waited == [3.0, 60.0, 54.0]
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright (C) 2021 Checkmk GmbH - License: GNU General Public License v2
+# This file is part of Checkmk (https://checkmk.com). It is subject to the
+# terms and conditions defined in the file COPYING, which is part of this
+# source code package.
+
+"""Tests for the uploads of node collectors."""
+
+from typing import List, Optional
+
+import pytest
+import requests
+
+from checkmk_kube_agent.container_metadata import metadata_digest
+from checkmk_kube_agent.content_encoding import (
+    METRIC_NAMES_DICTIONARY,
+    ZSTD,
+    decompress_bounded,
+)
+from checkmk_kube_agent.node_collector_context import NodeCollectorContext
+from checkmk_kube_agent.type_defs import (
+    ContentEncoding,
+    NodeCollectorMetadata,
+    UploadResponse,
+)
+from checkmk_kube_agent.upload_requests import (
+    encode_request_body,
+    overload_delay,
+    retry_after_seconds,
+    upload_with_metadata,
+)
+
+
+@pytest.mark.skipif(ZSTD is None, reason="Python was built without zstd")
+def test_encode_request_body_zstd_dictionary() -> None:
+    """The zstd dictionary used is announced in the request headers"""
+    body, headers = encode_request_body(
+        b"container_memory_cache", ContentEncoding.ZSTD, METRIC_NAMES_DICTIONARY
+    )
+
+    assert headers == {
+        "Content-Encoding": "zstd",
+        "Checkmk-Zstd-Dictionary": METRIC_NAMES_DICTIONARY,
+    }
+    assert (
+        decompress_bounded(
+            body,
+            ContentEncoding.ZSTD,
+            max_size=100,
+            zstd_dictionary=METRIC_NAMES_DICTIONARY,
+        )
+        == b"container_memory_cache"
+    )
+
+
+@pytest.mark.parametrize(
+    "headers, expected",
+    [
+        pytest.param({}, None, id="no Retry-After header"),
+        pytest.param({"Retry-After": "3"}, 3.0, id="seconds"),
+        pytest.param(
+            {"Retry-After": "Thu, 01 Jan 1970 00:00:10 GMT"}, 6.0, id="HTTP date"
+        ),
+        pytest.param(
+            {"Retry-After": "Thu, 01 Jan 1970 00:00:01 GMT"}, 0.0, id="past date"
+        ),
+        pytest.param({"Retry-After": "soon"}, None, id="invalid"),
+    ],
+)
+def test_retry_after_seconds(headers: dict, expected: Optional[float]) -> None:
+    """The Retry-After header of a rejected request holds the seconds to wait,
+    or the HTTP date to wait for"""
+    response = requests.Response()
+    response.status_code = 429
+    response.headers.update(headers)
+
+    assert retry_after_seconds(response, now=4.0) == expected
+    assert retry_after_seconds(None, now=4.0) is None
+
+
+def test_overload_delay() -> None:
+    """Rejected requests are retried after the time requested by the cluster
+    collector, at most one polling interval later"""
+    response = requests.Response()
+    response.status_code = 429
+
+    error = requests.HTTPError(response=response)
+    with pytest.raises(requests.HTTPError) as exception:
+        overload_delay(error, polling_interval=60)
+    assert exception.value is error
+
+    response.headers["Retry-After"] = "3"
+    assert overload_delay(error, polling_interval=60) == 3.0
+    response.headers["Retry-After"] = "300"
+    assert overload_delay(error, polling_interval=60) == 60.0
+
+
+def test_upload_with_metadata(metadata: NodeCollectorMetadata) -> None:
+    """The metadata is omitted once the cluster collector acknowledged its
+    digest, and sent again right away if the cluster collector requests it"""
+    context = NodeCollectorContext(read_collector_metadata=lambda: metadata)
+    digest = metadata_digest(
+        context.metadata(metadata.collector_type, metadata.components)
+    )
+    responses = [
+        # A cluster collector that does not support metadata digests
+        UploadResponse(),
+        UploadResponse(metadata_digest=digest),
+        UploadResponse(metadata_digest=digest),
+        UploadResponse(metadata_required=True),
+        UploadResponse(metadata_digest=digest),
+        UploadResponse(metadata_required=True),
+    ]
+    posted: List[bool] = []
+
+    def post(include_metadata: bool) -> bytes:
+        posted.append(include_metadata)
+        return responses[len(posted) - 1].model_dump_json().encode("utf-8")
+
+    for _ in range(4):
+        upload_with_metadata(post, context)
+    assert posted == [True, True, False, False, True]
+
+    upload_with_metadata(post, context, retry=False)
+    assert posted[5:] == [False]
+    assert not context.metadata_known()
+
+
+def test_upload_with_metadata_digest_mismatch(metadata: NodeCollectorMetadata) -> None:
+    """The metadata keeps being sent if the cluster collector computes another
+    digest for it, e.g. as it is of a different version"""
+    context = NodeCollectorContext(read_collector_metadata=lambda: metadata)
+    posted: List[bool] = []
+
+    def post(include_metadata: bool) -> bytes:
+        posted.append(include_metadata)
+        return UploadResponse(metadata_digest="other").model_dump_json().encode()
+
+    for _ in range(3):
+        upload_with_metadata(post, context)
+    assert posted == [True, True, True]